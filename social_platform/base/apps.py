@@ -3,4 +3,8 @@ from django.apps import AppConfig
 
 class BaseConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'base'
\ No newline at end of file
+    name = 'base'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        from core import dbpool  # noqa: F401  Registers the connection pool gauges
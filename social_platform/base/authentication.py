@@ -0,0 +1,112 @@
+"""
+Token authentication backed by a process-local principal cache.
+
+Both DRF (CachedTokenAuthentication) and the WebSocket TokenAuthMiddleware
+resolve a token key through `principal_cache`, so a burst of reconnects or
+REST calls with the same token costs one query per TTL instead of one per
+request. Entries are invalidated when the Token is deleted or the user is
+saved (deactivated, renamed, ...), see signals.py.
+"""
+
+from collections import namedtuple
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from .cache import TTLCache
+
+DEFAULTS = {
+    'MAX_ENTRIES': 10000,
+    'TTL': 300,
+}
+
+
+class Principal(namedtuple('Principal', ['key', 'user_id', 'username', 'is_active'])):
+    """The authenticated user behind a token, without the full User row."""
+
+    def as_user(self):
+        # A User with only id/username/is_active loaded; other fields are
+        # deferred and fetched on first access, so save() stays safe.
+        return User.from_db(
+            DEFAULT_DB_ALIAS,
+            ['id', 'username', 'is_active'],
+            [self.user_id, self.username, self.is_active],
+        )
+
+    def as_token(self):
+        return Token.from_db(DEFAULT_DB_ALIAS, ['key', 'user_id'], [self.key, self.user_id])
+
+
+class PrincipalCache:
+    def __init__(self, max_entries, ttl):
+        self._by_key = TTLCache(max_entries, ttl)
+        # DRF tokens are one per user, so user id -> key is enough to invalidate
+        self._key_by_user = TTLCache(max_entries, ttl)
+
+    @classmethod
+    def from_settings(cls):
+        conf = {**DEFAULTS, **getattr(settings, 'AUTH_TOKEN_CACHE', {})}
+        return cls(conf['MAX_ENTRIES'], conf['TTL'])
+
+    def get(self, key):
+        """Return the Principal for `key`, or None if the token does not exist."""
+        principal = self._by_key.get(key)
+        if principal is None:
+            row = Token.objects.filter(key=key).values_list(
+                'user_id', 'user__username', 'user__is_active'
+            ).first()
+            if row is None:
+                return None
+            principal = Principal(key, *row)
+            self._by_key.set(key, principal)
+            self._key_by_user.set(principal.user_id, key)
+        return principal
+
+    async def aget(self, key):
+        principal = self._by_key.get(key)
+        if principal is None:
+            row = await Token.objects.filter(key=key).values_list(
+                'user_id', 'user__username', 'user__is_active'
+            ).afirst()
+            if row is None:
+                return None
+            principal = Principal(key, *row)
+            self._by_key.set(key, principal)
+            self._key_by_user.set(principal.user_id, key)
+        return principal
+
+    def invalidate_token(self, key):
+        principal = self._by_key.pop(key)
+        if principal is not None:
+            self._key_by_user.pop(principal.user_id)
+
+    def invalidate_user(self, user_id):
+        key = self._key_by_user.pop(user_id)
+        if key is not None:
+            self._by_key.pop(key)
+
+    def clear(self):
+        self._by_key.clear()
+        self._key_by_user.clear()
+
+
+principal_cache = PrincipalCache.from_settings()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """Drop-in replacement for DRF's TokenAuthentication using principal_cache."""
+
+    def authenticate_credentials(self, key):
+        principal = principal_cache.get(key)
+        if principal is None:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+
+        if not principal.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+
+        return (principal.as_user(), principal.as_token())
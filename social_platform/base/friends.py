@@ -0,0 +1,85 @@
+"""
+Process-local cache of the accepted-friendship graph.
+
+Each entry maps a user id to {friend id: invitation id} for that user's
+accepted invitations, so friend lists, "are these two friends" checks and
+presence fan-out are dict lookups instead of an OR query on Invitation.
+Entries are dropped by the Invitation post_save/post_delete handlers in
+signals.py and expire after TTL seconds for changes made in other processes.
+`afriends_of` is the async variant for consumers.
+"""
+
+from django.conf import settings
+from django.db.models import Q
+
+from .cache import TTLCache
+from .models import Invitation
+
+DEFAULTS = {
+    'MAX_ENTRIES': 10000,
+    'TTL': 300,
+}
+
+
+class FriendGraph:
+    def __init__(self, max_entries, ttl):
+        self._adjacency = TTLCache(max_entries, ttl)
+
+    @classmethod
+    def from_settings(cls):
+        conf = {**DEFAULTS, **getattr(settings, 'FRIEND_GRAPH', {})}
+        return cls(conf['MAX_ENTRIES'], conf['TTL'])
+
+    def friends_of(self, user_id):
+        """Return {friend id: invitation id} for `user_id` (one query on a miss)."""
+        return self.friends_of_many([user_id])[user_id]
+
+    async def afriends_of(self, user_id):
+        friends = self._adjacency.get(user_id)
+        if friends is None:
+            friends = self._load([user_id], [row async for row in self._accepted([user_id])])[user_id]
+        return friends
+
+    def friends_of_many(self, user_ids):
+        """Map each user id to {friend id: invitation id} with at most one query."""
+        found, missing = {}, []
+        for user_id in set(user_ids):
+            friends = self._adjacency.get(user_id)
+            if friends is None:
+                missing.append(user_id)
+            else:
+                found[user_id] = friends
+        if missing:
+            found.update(self._load(missing, self._accepted(missing)))
+        return found
+
+    @staticmethod
+    def _accepted(user_ids):
+        return Invitation.objects.filter(
+            Q(user_low_id__in=user_ids) | Q(user_high_id__in=user_ids),
+            status='accepted'
+        ).values_list('id', 'user_low_id', 'user_high_id')
+
+    def _load(self, user_ids, rows):
+        loaded = {user_id: {} for user_id in user_ids}
+        for invite_id, low_id, high_id in rows:
+            if low_id in loaded:
+                loaded[low_id][high_id] = invite_id
+            if high_id in loaded:
+                loaded[high_id][low_id] = invite_id
+        for user_id, friends in loaded.items():
+            self._adjacency.set(user_id, friends)
+        return loaded
+
+    def are_friends(self, user_id, other_id):
+        return other_id in self.friends_of(user_id)
+
+    def invalidate(self, *user_ids):
+        for user_id in user_ids:
+            self._adjacency.pop(user_id)
+
+    def clear(self):
+        self._adjacency.clear()
+
+
+friend_graph = FriendGraph.from_settings()
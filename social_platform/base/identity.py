@@ -0,0 +1,124 @@
+"""
+Process-local username <-> user id cache.
+
+Message persistence, history and the friends/invitation views only ever need
+a user's id and username, so they resolve users through `identity_cache`
+instead of querying auth_user on every call. Entries expire after TTL seconds
+and are invalidated by the User post_save/post_delete handlers in signals.py.
+
+The a-prefixed methods are for consumers: a hit costs no thread hop, a miss
+goes through Django's async ORM.
+"""
+
+from collections import namedtuple
+
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from .cache import TTLCache
+
+DEFAULTS = {
+    'MAX_ENTRIES': 10000,
+    'TTL': 300,
+}
+
+# The projection of a user that views and consumers actually serialize
+UserIdentity = namedtuple('UserIdentity', ['id', 'username'])
+
+
+class IdentityCache:
+    def __init__(self, max_entries, ttl):
+        self._by_id = TTLCache(max_entries, ttl)
+        self._by_username = TTLCache(max_entries, ttl)
+
+    @classmethod
+    def from_settings(cls):
+        conf = {**DEFAULTS, **getattr(settings, 'IDENTITY_CACHE', {})}
+        return cls(conf['MAX_ENTRIES'], conf['TTL'])
+
+    def _store(self, identity):
+        self._by_id.set(identity.id, identity)
+        self._by_username.set(identity.username, identity)
+        return identity
+
+    def get_by_username(self, username):
+        """Return the UserIdentity for `username`, or None if no such user exists."""
+        identity = self._by_username.get(username)
+        if identity is None:
+            row = User.objects.filter(username=username).values_list('id', 'username').first()
+            identity = self._store(UserIdentity(*row)) if row else None
+        return identity
+
+    async def aget_by_username(self, username):
+        identity = self._by_username.get(username)
+        if identity is None:
+            row = await User.objects.filter(username=username).values_list('id', 'username').afirst()
+            identity = self._store(UserIdentity(*row)) if row else None
+        return identity
+
+    def get_by_id(self, user_id):
+        """Return the UserIdentity for `user_id`, or None if no such user exists."""
+        identity = self._by_id.get(user_id)
+        if identity is None:
+            row = User.objects.filter(id=user_id).values_list('id', 'username').first()
+            identity = self._store(UserIdentity(*row)) if row else None
+        return identity
+
+    @staticmethod
+    def _cached(cache, keys):
+        found, missing = {}, []
+        for key in set(keys):
+            identity = cache.get(key)
+            if identity is None:
+                missing.append(key)
+            else:
+                found[key] = identity
+        return found, missing
+
+    def resolve_usernames(self, usernames):
+        """Map each known username to its UserIdentity with at most one query."""
+        found, missing = self._cached(self._by_username, usernames)
+        if missing:
+            for row in User.objects.filter(username__in=missing).values_list('id', 'username'):
+                identity = self._store(UserIdentity(*row))
+                found[identity.username] = identity
+        return found
+
+    async def aresolve_usernames(self, usernames):
+        found, missing = self._cached(self._by_username, usernames)
+        if missing:
+            async for row in User.objects.filter(username__in=missing).values_list('id', 'username'):
+                identity = self._store(UserIdentity(*row))
+                found[identity.username] = identity
+        return found
+
+    def resolve_ids(self, user_ids):
+        """Map each known user id to its UserIdentity with at most one query."""
+        found, missing = self._cached(self._by_id, user_ids)
+        if missing:
+            for row in User.objects.filter(id__in=missing).values_list('id', 'username'):
+                identity = self._store(UserIdentity(*row))
+                found[identity.id] = identity
+        return found
+
+    async def aresolve_ids(self, user_ids):
+        found, missing = self._cached(self._by_id, user_ids)
+        if missing:
+            async for row in User.objects.filter(id__in=missing).values_list('id', 'username'):
+                identity = self._store(UserIdentity(*row))
+                found[identity.id] = identity
+        return found
+
+    def invalidate(self, user_id, username=None):
+        identity = self._by_id.pop(user_id)
+        if identity is not None:
+            self._by_username.pop(identity.username)
+        if username is not None:
+            self._by_username.pop(username)
+
+    def clear(self):
+        self._by_id.clear()
+        self._by_username.clear()
+
+
+identity_cache = IdentityCache.from_settings()
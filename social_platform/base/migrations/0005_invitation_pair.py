@@ -0,0 +1,75 @@
+# Generated by Django 5.2.9 on 2026-10-17 21:02
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+# Which of several invitations between the same two users survives
+STATUS_PRIORITY = {'accepted': 2, 'pending': 1}
+
+
+def backfill_pairs(apps, schema_editor):
+    Invitation = apps.get_model('base', 'Invitation')
+
+    keep, duplicates, batch = {}, [], []
+    for invite in Invitation.objects.order_by('id').only('id', 'sender_id', 'receiver_id', 'status').iterator(chunk_size=2000):
+        invite.user_low_id, invite.user_high_id = sorted((invite.sender_id, invite.receiver_id))
+        pair = (invite.user_low_id, invite.user_high_id)
+        kept = keep.get(pair)
+        if kept is None:
+            keep[pair] = invite
+        elif STATUS_PRIORITY.get(invite.status, 0) > STATUS_PRIORITY.get(kept.status, 0):
+            duplicates.append(kept.id)
+            keep[pair] = invite
+        else:
+            duplicates.append(invite.id)
+
+    # Reverse-direction duplicates: keep the most advanced, then the oldest
+    Invitation.objects.filter(id__in=duplicates).delete()
+
+    for invite in keep.values():
+        batch.append(invite)
+        if len(batch) >= 2000:
+            Invitation.objects.bulk_update(batch, ['user_low', 'user_high'])
+            batch = []
+    Invitation.objects.bulk_update(batch, ['user_low', 'user_high'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0004_delete_message'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invitation',
+            name='user_low',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='invitation',
+            name='user_high',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(backfill_pairs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='invitation',
+            name='user_low',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='invitation',
+            name='user_high',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterUniqueTogether(
+            name='invitation',
+            unique_together=set(),
+        ),
+        migrations.AddConstraint(
+            model_name='invitation',
+            constraint=models.UniqueConstraint(fields=('user_low', 'user_high'), name='base_invitation_pair'),
+        ),
+    ]
@@ -13,9 +13,29 @@ class Invitation(models.Model):
     receiver = models.ForeignKey(User, related_name="received_invitations", on_delete=models.CASCADE)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
     timestamp = models.DateTimeField(auto_now_add=True)
+    # Unordered pair key (lower user id, higher user id), filled in by save()
+    user_low = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', editable=False)
+    user_high = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', editable=False)
 
     class Meta:
-        unique_together = ('sender', 'receiver')
+        constraints = [
+            # One relationship per pair of users, whichever of them sent it
+            models.UniqueConstraint(fields=['user_low', 'user_high'], name='base_invitation_pair'),
+        ]
+
+    @staticmethod
+    def pair(user_a_id, user_b_id):
+        return tuple(sorted((user_a_id, user_b_id)))
+
+    @classmethod
+    def between(cls, user_a_id, user_b_id):
+        """The relationship between two users, in either direction, as one index probe."""
+        low, high = cls.pair(user_a_id, user_b_id)
+        return cls.objects.filter(user_low_id=low, user_high_id=high)
+
+    def save(self, *args, **kwargs):
+        self.user_low_id, self.user_high_id = self.pair(self.sender_id, self.receiver_id)
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.sender.username} to {self.receiver.username} ({self.status})"
@@ -0,0 +1,190 @@
+"""
+In-process username search shared by the base and chat search endpoints.
+
+`user_search` keeps every username in an n-gram index (all 1-, 2- and
+3-character substrings of the lowercased name). A query of up to three
+characters is a single posting-list lookup; a longer one intersects the
+postings of its trigrams and confirms the substring, so results match
+`username__icontains` without scanning auth_user. Hits are ranked exact
+match, then prefix, then substring, shorter names first.
+
+The index is loaded with one query on first use, kept current by the User
+post_save/post_delete handlers in signals.py and rebuilt every
+REBUILD_INTERVAL seconds to pick up changes made by other processes. A
+rebuild runs in one request thread at a time while the others search the
+previous index, and saves or deletes signalled during it are replayed onto
+the new index before it is swapped in.
+
+Every worker process holds its own copy, roughly 30 postings per username:
+about 200MB per worker at 100k users, and twice that for the moment a
+rebuild and the index it replaces coexist. Past a few hundred thousand
+users, move search to the database (a trigram index) instead.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import Q
+
+from .identity import UserIdentity
+from .models import Invitation
+
+DEFAULTS = {
+    'MAX_RESULTS': 20,
+    'REBUILD_INTERVAL': 300,
+}
+
+GRAM_SIZE = 3
+
+
+def _grams(name):
+    return {
+        name[start:start + size]
+        for size in range(1, GRAM_SIZE + 1)
+        for start in range(len(name) - size + 1)
+    }
+
+
+def _index(names, postings, user_id, username):
+    names[user_id] = username
+    for gram in _grams(username.lower()):
+        postings.setdefault(gram, set()).add(user_id)
+
+
+def _unindex(names, postings, user_id):
+    username = names.pop(user_id, None)
+    if username is None:
+        return
+    for gram in _grams(username.lower()):
+        ids = postings.get(gram)
+        if ids is not None:
+            ids.discard(user_id)
+            if not ids:
+                del postings[gram]
+
+
+class UserSearchIndex:
+    def __init__(self, max_results, rebuild_interval):
+        self.max_results = max_results
+        self.rebuild_interval = rebuild_interval
+        self._names = {}     # user id -> username
+        self._postings = {}  # n-gram -> set of user ids
+        self._loaded_at = None
+        self._changes = None  # user id -> username (None: deleted) seen while rebuilding
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        conf = {**DEFAULTS, **getattr(settings, 'USER_SEARCH', {})}
+        return cls(conf['MAX_RESULTS'], conf['REBUILD_INTERVAL'])
+
+    def _is_fresh(self):
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.rebuild_interval
+
+    def _ensure_loaded(self):
+        if self._is_fresh():
+            return
+        # One thread rebuilds; the others keep searching the stale index
+        # meanwhile, and only wait if there is no index yet
+        if not self._rebuild_lock.acquire(blocking=self._loaded_at is None):
+            return
+        try:
+            if not self._is_fresh():  # Rebuilt while this thread waited
+                self._rebuild()
+        finally:
+            self._rebuild_lock.release()
+
+    def _rebuild(self):
+        with self._lock:
+            self._changes = {}
+        try:
+            names, postings = {}, {}
+            for user_id, username in User.objects.values_list('id', 'username'):
+                _index(names, postings, user_id, username)
+            with self._lock:
+                # Saves and deletes that raced the query win over its rows
+                for user_id, username in self._changes.items():
+                    _unindex(names, postings, user_id)
+                    if username is not None:
+                        _index(names, postings, user_id, username)
+                self._names, self._postings = names, postings
+                self._loaded_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._changes = None
+
+    def warm(self):
+        """Load the index now (if missing or stale) rather than in the next search."""
+        self._ensure_loaded()
+
+    def update(self, user_id, username):
+        """Index a created or renamed user (no-op until the index is first used)."""
+        with self._lock:
+            if self._changes is not None:
+                self._changes[user_id] = username
+            if self._loaded_at is None or self._names.get(user_id) == username:
+                return
+            _unindex(self._names, self._postings, user_id)
+            _index(self._names, self._postings, user_id, username)
+
+    def remove(self, user_id):
+        with self._lock:
+            if self._changes is not None:
+                self._changes[user_id] = None
+            _unindex(self._names, self._postings, user_id)
+
+    def clear(self):
+        with self._lock:
+            self._names, self._postings = {}, {}
+            self._loaded_at = None
+
+    def search(self, query, exclude_id=None, limit=None):
+        """Return up to `limit` UserIdentity whose username contains `query`, best first."""
+        needle = query.lower()
+        if not needle:
+            return []
+        self._ensure_loaded()
+        limit = min(limit or self.max_results, self.max_results)
+
+        with self._lock:
+            if len(needle) <= GRAM_SIZE:
+                candidates = set(self._postings.get(needle, ()))
+            else:
+                postings = sorted(
+                    (self._postings.get(needle[i:i + GRAM_SIZE], set())
+                     for i in range(len(needle) - GRAM_SIZE + 1)),
+                    key=len
+                )
+                candidates = set(postings[0]).intersection(*postings[1:])
+            names = {user_id: self._names[user_id] for user_id in candidates}
+
+        candidates.discard(exclude_id)
+        hits = []
+        for user_id in candidates:
+            name = names[user_id].lower()
+            if needle not in name:
+                continue
+            rank = 0 if name == needle else 1 if name.startswith(needle) else 2
+            hits.append((rank, len(name), name, user_id))
+        hits.sort()
+        return [UserIdentity(user_id, names[user_id]) for *_, user_id in hits[:limit]]
+
+
+def relationship_statuses(user, other_ids):
+    """Map each of `other_ids` to its invitation status with `user` ('none' if none), in one query."""
+    statuses = {other_id: 'none' for other_id in other_ids}
+    if not statuses:
+        return statuses
+    rows = Invitation.objects.filter(
+        Q(user_low=user, user_high_id__in=statuses) | Q(user_high=user, user_low_id__in=statuses)
+    ).values_list('user_low_id', 'user_high_id', 'status')
+    for low_id, high_id, invite_status in rows:
+        other_id = high_id if low_id == user.id else low_id
+        statuses[other_id] = invite_status
+    return statuses
+
+
+user_search = UserSearchIndex.from_settings()
@@ -0,0 +1,43 @@
+"""
+Cache and search index invalidation hooks, connected in BaseConfig.ready().
+"""
+
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .authentication import principal_cache
+from .friends import friend_graph
+from .identity import identity_cache
+from .models import Invitation
+from .search import user_search
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_identity(sender, instance, update_fields=None, **kwargs):
+    # Logins only touch last_login, which is not part of the cached identity
+    if update_fields and set(update_fields) <= {'last_login'}:
+        return
+    identity_cache.invalidate(instance.pk, instance.username)
+    user_search.update(instance.pk, instance.username)
+    # Covers deactivation: the next request re-reads is_active
+    principal_cache.invalidate_user(instance.pk)
+
+
+@receiver(post_delete, sender=User)
+def forget_user_identity(sender, instance, **kwargs):
+    identity_cache.invalidate(instance.pk, instance.username)
+    user_search.remove(instance.pk)
+    principal_cache.invalidate_user(instance.pk)
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_token_principal(sender, instance, **kwargs):
+    principal_cache.invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=Invitation)
+@receiver(post_delete, sender=Invitation)
+def invalidate_friend_graph(sender, instance, **kwargs):
+    friend_graph.invalidate(instance.sender_id, instance.receiver_id)
@@ -1,6 +1,18 @@
-from django.test import TestCase
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.db import IntegrityError, transaction
+from django.test import TestCase, override_settings
 from django.contrib.auth.models import User
-from .models import Invitation, Message, Profile
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from chat.models import Message
+from core.metrics import MetricsRegistry
+from .authentication import principal_cache
+from .friends import friend_graph
+from .identity import identity_cache
+from .models import Invitation, Profile
+from .search import user_search
 
 class InvitationModelTest(TestCase):
     def setUp(self):
@@ -16,6 +28,18 @@ class InvitationModelTest(TestCase):
         self.assertEqual(invitation.status, 'pending')
         self.assertEqual(str(invitation), 'user1 to user2 (pending)')
 
+    def test_reverse_invitation_is_rejected(self):
+        Invitation.objects.create(sender=self.user2, receiver=self.user1)
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Invitation.objects.create(sender=self.user1, receiver=self.user2)
+        self.assertEqual(Invitation.between(self.user1.id, self.user2.id).get().sender, self.user2)
+
+        client = APIClient()
+        client.force_authenticate(self.user1)
+        response = client.post('/api/invitations/send/', {'receiver_id': self.user2.id})
+        self.assertEqual(response.status_code, 400)
+
 class MessageModelTest(TestCase):
     def setUp(self):
         self.user1 = User.objects.create_user(username='user1', password='pass123')
@@ -29,4 +53,196 @@ class MessageModelTest(TestCase):
         )
         self.assertEqual(message.content, 'Hello!')
         self.assertEqual(message.sender, self.user1)
-        self.assertEqual(message.receiver, self.user2)
\ No newline at end of file
+        self.assertEqual(message.receiver, self.user2)
+
+class IdentityCacheTest(TestCase):
+    def setUp(self):
+        identity_cache.clear()
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+
+    def test_lookup_is_cached(self):
+        with self.assertNumQueries(1):
+            identity_cache.get_by_username('user1')
+        with self.assertNumQueries(0):
+            identity = identity_cache.get_by_id(self.user1.id)
+        self.assertEqual(identity, (self.user1.id, 'user1'))
+
+    def test_resolve_only_queries_misses(self):
+        identity_cache.get_by_username('user1')
+        with self.assertNumQueries(1):
+            users = identity_cache.resolve_ids([self.user1.id, self.user2.id, 999])
+        self.assertEqual(users[self.user2.id].username, 'user2')
+        self.assertNotIn(999, users)
+
+    def test_async_lookups_share_the_cache(self):
+        async def run():
+            await identity_cache.aget_by_username('user1')
+            return await identity_cache.aresolve_usernames(['user1', 'user2', 'ghost'])
+
+        users = async_to_sync(run)()
+        self.assertEqual(set(users), {'user1', 'user2'})
+        with self.assertNumQueries(0):
+            identity_cache.resolve_usernames(['user1', 'user2'])
+
+    def test_user_save_invalidates(self):
+        identity_cache.get_by_username('user1')
+        self.user1.username = 'renamed'
+        self.user1.save()
+        self.assertIsNone(identity_cache.get_by_username('user1'))
+        self.assertEqual(identity_cache.get_by_id(self.user1.id).username, 'renamed')
+
+class CachedTokenAuthenticationTest(TestCase):
+    def setUp(self):
+        principal_cache.clear()
+        self.user = User.objects.create_user(username='user1', password='pass123')
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def test_token_lookup_is_cached(self):
+        self.assertEqual(self.client.get('/api/invitations/').status_code, 200)
+        # Only the invitations query itself, no token/user lookup
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get('/api/invitations/').status_code, 200)
+
+    def test_deleted_token_is_rejected(self):
+        self.client.get('/api/invitations/')
+        self.token.delete()
+        self.assertEqual(self.client.get('/api/invitations/').status_code, 401)
+
+    def test_deactivated_user_is_rejected(self):
+        self.client.get('/api/invitations/')
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/api/invitations/').status_code, 401)
+
+class FriendGraphTest(TestCase):
+    def setUp(self):
+        identity_cache.clear()
+        friend_graph.clear()
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.user3 = User.objects.create_user(username='user3', password='pass123')
+        self.invite = Invitation.objects.create(sender=self.user1, receiver=self.user2, status='accepted')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user1)
+
+    def test_friend_list_is_cached(self):
+        self.client.get('/api/friends/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/friends/')
+        self.assertEqual(response.json(), [{'id': self.user2.id, 'username': 'user2', 'invite_id': self.invite.id}])
+
+    def test_invitation_changes_invalidate(self):
+        self.assertTrue(friend_graph.are_friends(self.user2.id, self.user1.id))
+        invite = Invitation.objects.create(sender=self.user3, receiver=self.user1)
+        self.assertEqual(set(friend_graph.friends_of(self.user1.id)), {self.user2.id})
+        invite.status = 'accepted'
+        invite.save()
+        self.assertEqual(set(friend_graph.friends_of(self.user1.id)), {self.user2.id, self.user3.id})
+
+    def test_remove_friend(self):
+        self.client.force_authenticate(self.user3)
+        self.assertEqual(self.client.delete(f'/api/friends/remove/{self.invite.id}/').status_code, 403)
+        self.client.force_authenticate(self.user1)
+        self.assertEqual(self.client.delete(f'/api/friends/remove/{self.invite.id}/').status_code, 200)
+        self.assertFalse(friend_graph.are_friends(self.user2.id, self.user1.id))
+        self.assertEqual(self.client.delete(f'/api/friends/remove/{self.invite.id}/').status_code, 404)
+
+    def test_remove_friend_ignores_a_stale_graph(self):
+        # Changed by another process: no signal reached this one's cache
+        friend_graph.friends_of(self.user1.id)
+        Invitation.objects.filter(id=self.invite.id).update(status='rejected')
+        self.assertEqual(self.client.delete(f'/api/friends/remove/{self.invite.id}/').status_code, 404)
+        self.assertTrue(Invitation.objects.filter(id=self.invite.id).exists())
+
+        (invite,) = Invitation.objects.bulk_create([Invitation(
+            sender=self.user3, receiver=self.user1, status='accepted', user_low=self.user1, user_high=self.user3
+        )])
+        self.assertEqual(self.client.delete(f'/api/friends/remove/{invite.id}/').status_code, 200)
+
+class UserSearchTest(TestCase):
+    def setUp(self):
+        user_search.clear()
+        self.me = User.objects.create_user(username='alice', password='pass123')
+        self.bob = User.objects.create_user(username='bob', password='pass123')
+        self.bobby = User.objects.create_user(username='bobby', password='pass123')
+        self.jimbob = User.objects.create_user(username='jimbob', password='pass123')
+        Invitation.objects.create(sender=self.me, receiver=self.bobby, status='accepted')
+        Invitation.objects.create(sender=self.jimbob, receiver=self.me)
+        self.client = APIClient()
+        self.client.force_authenticate(self.me)
+
+    def test_results_are_ranked(self):
+        self.assertEqual([hit.username for hit in user_search.search('BOB')], ['bob', 'bobby', 'jimbob'])
+        self.assertEqual([hit.username for hit in user_search.search('mbob')], ['jimbob'])
+        self.assertEqual(user_search.search('bobx'), [])
+
+    def test_index_follows_user_changes(self):
+        user_search.search('bob')
+        self.bob.username = 'robert'
+        self.bob.save()
+        User.objects.create_user(username='bobcat', password='pass123')
+        self.bobby.delete()
+        self.assertEqual([hit.username for hit in user_search.search('bob')], ['bobcat', 'jimbob'])
+
+    def test_changes_during_a_rebuild_are_kept(self):
+        rows = list(User.objects.values_list('id', 'username'))
+
+        def rows_read_before_the_changes(*args):
+            User.objects.create_user(username='bobcat', password='pass123')
+            self.bob.delete()
+            return rows
+
+        with mock.patch.object(User.objects, 'values_list', side_effect=rows_read_before_the_changes):
+            user_search.search('bob')
+        self.assertEqual([hit.username for hit in user_search.search('bob')], ['bobby', 'bobcat', 'jimbob'])
+
+    def test_warm_loads_the_index(self):
+        user_search.warm()
+        with self.assertNumQueries(0):
+            self.assertEqual([hit.username for hit in user_search.search('bob')], ['bob', 'bobby', 'jimbob'])
+
+    def test_search_endpoint_resolves_status_in_one_query(self):
+        user_search.search('bob')
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/users/', {'search': 'bob'})
+        self.assertEqual(
+            [(u['username'], u['status']) for u in response.json()],
+            [('bob', 'none'), ('bobby', 'accepted'), ('jimbob', 'pending')]
+        )
+
+class MetricsTest(TestCase):
+    def test_histogram_buckets_are_cumulative(self):
+        registry = MetricsRegistry()
+        latency = registry.histogram('test_latency_ms', 'Test latency', buckets=(1, 10))
+        for value in (0.5, 5, 5, 50):
+            latency.observe(value)
+        output = registry.render()
+        self.assertIn('test_latency_ms_bucket{le="1"} 1', output)
+        self.assertIn('test_latency_ms_bucket{le="10"} 3', output)
+        self.assertIn('test_latency_ms_bucket{le="+Inf"} 4', output)
+        self.assertIn('test_latency_ms_count 4', output)
+
+    def test_registration_is_idempotent(self):
+        registry = MetricsRegistry()
+        self.assertIs(registry.counter('test_total', 'Test'), registry.counter('test_total', 'Test'))
+        with self.assertRaises(ValueError):
+            registry.histogram('test_total', 'Test')
+
+    @override_settings(METRICS_TOKEN='scrape-me')
+    def test_metrics_endpoint(self):
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 403)
+        self.assertEqual(self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.client.force_login(User.objects.create_user(username='user1', password='pass123'))
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 403)
+        self.client.force_login(User.objects.create_user(username='ops', password='pass123', is_staff=True))
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 200)
+        self.client.logout()
+
+        response = self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer scrape-me')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE chat_persist_queue_depth gauge', response.content)
+        # No pool on SQLite: the pool gauges are present and read 0
+        self.assertIn(b'db_pool_checkout_wait_ms 0', response.content)
@@ -6,6 +6,7 @@ from rest_framework_simplejwt.views import TokenObtainPairView
 urlpatterns = [
     # Health Check
     path('health/', views.health_check, name='health_check'),
+    path('metrics/', views.metrics, name='metrics'),
     
     # Auth
     path('register/', views.register_user, name='register'),
@@ -1,13 +1,27 @@
 # base/views.py
+import hmac
+
+from django.conf import settings
+from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
+from django.db import IntegrityError
 from django.db.models import Q
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views.decorators.http import require_GET
 from rest_framework import status
+from rest_framework.authtoken.models import Token
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
 from rest_framework_simplejwt.tokens import RefreshToken
 
+from chat.persistence import message_queue
+from core.metrics import registry
+
+from .friends import friend_graph
+from .identity import identity_cache
 from .models import Invitation
+from .search import relationship_statuses, user_search
 from .serializers import UserSerializer
 
 @api_view(['POST'])
@@ -29,19 +43,13 @@ def register_user(request):
 def search_users(request):
     query = request.query_params.get('search', '')
     if query:
-        users = User.objects.filter(username__icontains=query).exclude(id=request.user.id)
-        results = []
-        for user in users:
-            # Check for ANY existing relationship
-            invite = Invitation.objects.filter(
-                (Q(sender=request.user, receiver=user) | Q(sender=user, receiver=request.user))
-            ).first()
-            
-            results.append({
-                'id': user.id,
-                'username': user.username,
-                'status': invite.status if invite else 'none'
-            })
+        hits = user_search.search(query, exclude_id=request.user.id)
+        # Relationship status for every hit in one query
+        statuses = relationship_statuses(request.user, [hit.id for hit in hits])
+        results = [
+            {'id': hit.id, 'username': hit.username, 'status': statuses[hit.id]}
+            for hit in hits
+        ]
         return Response(results)
     return Response([])
 
@@ -50,30 +58,38 @@ def search_users(request):
 def send_invitation(request):
     receiver_id = request.data.get('receiver_id')
     try:
-        receiver = User.objects.get(id=receiver_id)
-        
-        # MUTUAL CHECK: Check if an invite exists in EITHER direction
-        existing_invite = Invitation.objects.filter(
-            (Q(sender=request.user, receiver=receiver) | 
-             Q(sender=receiver, receiver=request.user))
-        ).first()
-
-        if existing_invite:
-            if existing_invite.status == 'accepted':
-                return Response({'message': 'You are already friends!'}, status=400)
-            return Response({'message': 'An invitation is already pending.'}, status=400)
-            
-        Invitation.objects.create(sender=request.user, receiver=receiver)
-        return Response({'message': 'Invitation sent!'}, status=201)
-    except User.DoesNotExist:
+        receiver = identity_cache.get_by_id(int(receiver_id))
+    except (TypeError, ValueError):
+        receiver = None
+    if receiver is None:
         return Response({'error': 'User not found'}, status=404)
 
+    if friend_graph.are_friends(request.user.id, receiver.id):
+        return Response({'message': 'You are already friends!'}, status=400)
+
+    # MUTUAL CHECK: the pair key covers an invite in EITHER direction
+    if Invitation.between(request.user.id, receiver.id).exists():
+        return Response({'message': 'An invitation is already pending.'}, status=400)
+
+    try:
+        Invitation.objects.create(sender=request.user, receiver_id=receiver.id)
+    except IntegrityError:
+        # The other user invited us at the same moment
+        return Response({'message': 'An invitation is already pending.'}, status=400)
+    return Response({'message': 'Invitation sent!'}, status=201)
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def list_invitations(request):
     # Get pending invites sent TO the current user
-    invites = Invitation.objects.filter(receiver=request.user, status='pending')
-    data = [{'id': i.id, 'sender': i.sender.username} for i in invites]
+    invites = list(
+        Invitation.objects.filter(receiver=request.user, status='pending').values_list('id', 'sender_id')
+    )
+    senders = identity_cache.resolve_ids(sender_id for _, sender_id in invites)
+    data = [
+        {'id': invite_id, 'sender': senders[sender_id].username}
+        for invite_id, sender_id in invites if sender_id in senders
+    ]
     return Response(data)
 
 @api_view(['POST'])
@@ -93,55 +109,59 @@ def respond_to_invitation(request):
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def list_friends(request):
-    # FIXED: Removed double Q() wrapper
-    friends_invites = Invitation.objects.filter(
-        (Q(sender=request.user) | Q(receiver=request.user)),
-        status='accepted'
-    )
-    
+    # friend id -> accepted invitation id, usually without touching the database
+    friend_invites = friend_graph.friends_of(request.user.id)
+    users = identity_cache.resolve_ids(friend_invites)
+
     friends = []
-    for invite in friends_invites:
-        # Determine which user is the 'friend' (not the current user)
-        friend_user = invite.receiver if invite.sender == request.user else invite.sender
+    for friend_id, invite_id in friend_invites.items():
+        friend_user = users.get(friend_id)
+        if friend_user is None:
+            continue
         friends.append({
             'id': friend_user.id,
             'username': friend_user.username,
-            'invite_id': invite.id # Needed for unfriending
+            'invite_id': invite_id # Needed for unfriending
         })
     return Response(friends)
 
 @api_view(['DELETE'])
 @permission_classes([IsAuthenticated])
 def remove_friend(request, invite_id):
-    try:
-        # Ensure the user is part of the invitation they are trying to delete
-        invite = Invitation.objects.get(
-            id=invite_id, 
-            status='accepted'
-        )
-        if invite.sender == request.user or invite.receiver == request.user:
-            invite.delete()
-            return Response({'message': 'Friend removed'}, status=200)
+    # Ensure the user is part of the invitation they are trying to delete. The
+    # database decides: friend_graph is per process and may be stale.
+    deleted, _ = Invitation.objects.filter(
+        Q(sender=request.user) | Q(receiver=request.user), id=invite_id, status='accepted'
+    ).delete()
+    if deleted:
+        return Response({'message': 'Friend removed'}, status=200)
+    if Invitation.objects.filter(id=invite_id, status='accepted').exists():
         return Response({'error': 'Unauthorized'}, status=403)
-    except Invitation.DoesNotExist:
-        return Response({'error': 'Invitation not found'}, status=404)  
-from django.contrib.auth import authenticate
-from rest_framework.authtoken.models import Token
-from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import AllowAny
-from rest_framework.response import Response
+    return Response({'error': 'Invitation not found'}, status=404)
 
-from django.contrib.auth import authenticate
-from rest_framework.authtoken.models import Token
-from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import AllowAny
-from rest_framework.response import Response
+def _may_scrape(request):
+    # Prometheus sends METRICS_TOKEN as a bearer token; staff can look from a browser session
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if token and hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()):
+        return True
+    return request.user.is_staff
+
+@require_GET
+def metrics(request):
+    """Prometheus scrape endpoint for this process's metrics"""
+    if not _may_scrape(request):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def health_check(request):
     """Health check endpoint for monitoring"""
-    return Response({'status': 'healthy', 'service': 'social_platform'}, status=200)
+    return Response({
+        'status': 'healthy',
+        'service': 'social_platform',
+        'persistence_queue': message_queue.stats(),
+    }, status=200)
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
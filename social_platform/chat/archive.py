@@ -0,0 +1,193 @@
+"""
+Archival of cold messages into compressed per-conversation monthly segments.
+
+`archive_before(cutoff)` moves every message older than `cutoff` out of
+chat_message into ArchiveSegment rows: one per conversation (unordered user
+pair) per calendar month, holding the month's messages as zlib-compressed
+JSON, merged into the existing segment if that month was partly archived
+already. Each conversation is moved a month at a time, one transaction per
+month, so a reader sees a message either in the hot table or in a segment,
+never both.
+
+Archived messages keep their ids, and since only messages older than the
+horizon are moved, every archived id in a conversation is lower than every
+hot one. MessageHistoryView therefore reads the hot table first and only
+continues into segments (`archived_rows`) when a page runs past the oldest
+hot message. Archived messages leave the keyword search index and the
+reconnect replay, which only cover the hot table.
+
+Run by `manage.py archive_messages` (once, or --loop as a background job).
+"""
+
+import json
+import logging
+import zlib
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from core.metrics import registry
+
+from .models import ArchiveSegment, Message
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'HORIZON_DAYS': 180,
+    'MAX_CONVERSATIONS': 500,  # per run
+    'INTERVAL': 3600,          # seconds between runs with --loop
+}
+
+DELETE_CHUNK = 1000
+
+MESSAGES_ARCHIVED = registry.counter('chat_messages_archived_total', 'Messages moved into archive segments')
+SEGMENTS_READ = registry.counter('chat_archive_segments_read_total', 'Archive segments decompressed for history and export')
+
+
+def archive_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_ARCHIVE', {})}
+
+
+def _encode(rows):
+    return zlib.compress(json.dumps(rows, separators=(',', ':')).encode(), 9)
+
+
+def _decode(data):
+    return json.loads(zlib.decompress(bytes(data)))
+
+
+def load_segment(segment_id):
+    """Rows of one segment, oldest first: [id, sender_id, seq, iso timestamp, content]."""
+    data = ArchiveSegment.objects.filter(id=segment_id).values_list('data', flat=True).get()
+    SEGMENTS_READ.inc()
+    return _decode(data)
+
+
+def archive_conversation(user_a_id, user_b_id, cutoff):
+    """
+    Move one conversation's messages older than `cutoff` into segments, a
+    month per transaction so memory stays bounded on a first run over a long
+    history. Returns how many.
+    """
+    low, high = sorted((user_a_id, user_b_id))
+    old = Message.objects.filter(
+        Q(sender_id=low, receiver_id=high) | Q(sender_id=high, receiver_id=low),
+        timestamp__lt=cutoff,
+    )
+    moved = 0
+    while True:
+        oldest = old.order_by('timestamp').values_list('timestamp', flat=True).first()
+        if oldest is None:
+            break
+        month_start = oldest.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        next_month = (month_start + timedelta(days=32)).replace(day=1)
+        moved += _archive_rows(low, high, old.filter(timestamp__lt=next_month))
+    return moved
+
+
+def _archive_rows(low, high, messages):
+    with transaction.atomic():
+        rows = list(messages.order_by('id').values_list('id', 'sender_id', 'seq', 'timestamp', 'content'))
+        if not rows:
+            return 0
+
+        by_month = {}
+        for message_id, sender_id, seq, timestamp, content in rows:
+            month = timestamp.date().replace(day=1)
+            by_month.setdefault(month, []).append([message_id, sender_id, seq, timestamp.isoformat(), content])
+
+        existing = {
+            segment.month: segment
+            for segment in ArchiveSegment.objects.select_for_update().filter(
+                user_low_id=low, user_high_id=high, month__in=list(by_month)
+            )
+        }
+        for month, month_rows in by_month.items():
+            segment = existing.get(month)
+            if segment is None:
+                segment = ArchiveSegment(user_low_id=low, user_high_id=high, month=month)
+            else:
+                merged = {row[0]: row for row in _decode(segment.data)}
+                merged.update((row[0], row) for row in month_rows)
+                month_rows = [merged[message_id] for message_id in sorted(merged)]
+            segment.first_id = month_rows[0][0]
+            segment.last_id = month_rows[-1][0]
+            segment.message_count = len(month_rows)
+            segment.data = _encode(month_rows)
+            segment.save()
+
+        ids = [row[0] for row in rows]
+        for start in range(0, len(ids), DELETE_CHUNK):
+            Message.objects.filter(id__in=ids[start:start + DELETE_CHUNK]).delete()
+
+    MESSAGES_ARCHIVED.inc(len(rows))
+    return len(rows)
+
+
+def archive_before(cutoff, max_conversations=None):
+    """
+    Archive messages older than `cutoff` for up to `max_conversations`
+    conversations. Returns (conversations, messages) archived.
+    """
+    if max_conversations is None:
+        max_conversations = archive_settings()['MAX_CONVERSATIONS']
+    pairs = set()
+    for sender_id, receiver_id in (
+        # order_by(): Message.Meta.ordering would add timestamp to the DISTINCT
+        Message.objects.filter(timestamp__lt=cutoff).order_by().values_list('sender_id', 'receiver_id').distinct()
+    ):
+        pairs.add(tuple(sorted((sender_id, receiver_id))))
+        if len(pairs) >= max_conversations:
+            break
+
+    moved = 0
+    for low, high in sorted(pairs):
+        try:
+            moved += archive_conversation(low, high, cutoff)
+        except Exception:
+            logger.exception("Failed to archive conversation %s/%s", low, high)
+    return len(pairs), moved
+
+
+def default_cutoff():
+    return timezone.now() - timedelta(days=archive_settings()['HORIZON_DAYS'])
+
+
+def archived_rows(user_a_id, user_b_id, before=None, after=None, limit=50):
+    """
+    Up to `limit` archived messages of a conversation, as history rows
+    (id, sender_id, content, timestamp). Newest first below `before`, or
+    oldest first above `after`. Only the segments needed are decompressed.
+    """
+    low, high = sorted((user_a_id, user_b_id))
+    segments = ArchiveSegment.objects.filter(user_low_id=low, user_high_id=high)
+    if after is not None:
+        segments = segments.filter(last_id__gt=after).order_by('last_id')
+    else:
+        if before is not None:
+            segments = segments.filter(first_id__lt=before)
+        segments = segments.order_by('-last_id')
+
+    rows = []
+    for segment_id in segments.values_list('id', flat=True):
+        if len(rows) >= limit:
+            break
+        decoded = load_segment(segment_id)
+        if after is not None:
+            selected = [row for row in decoded if row[0] > after]
+        else:
+            selected = [row for row in reversed(decoded) if before is None or row[0] < before]
+        rows.extend(selected[:limit - len(rows)])
+
+    return [
+        {
+            'id': message_id,
+            'sender_id': sender_id,
+            'content': content,
+            'timestamp': datetime.fromisoformat(timestamp),
+        }
+        for message_id, sender_id, _, timestamp, content in rows
+    ]
@@ -0,0 +1,134 @@
+"""
+REST endpoint benchmarks with query-count and latency budgets.
+
+Each endpoint is called for a sample of users: the best-connected ones
+(where an N+1 shows up first) plus random ones. Queries are counted on a
+cold call, with the identity, friend-graph and token caches cleared, so the
+count covers the full cost of a request and cannot hide behind a warm
+cache. Latency is then measured over `iterations` warm calls.
+
+A query budget is a constant: it must hold for a user with 3 friends and
+for one with 3000. Run against seeded data (manage.py seed_data) with
+manage.py bench_rest; `run_benchmarks` returns the report and the list of
+budget violations.
+"""
+
+import random
+import time
+from collections import namedtuple
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from base.authentication import principal_cache
+from base.friends import friend_graph
+from base.identity import identity_cache
+from base.search import user_search
+
+from .models import ConversationSummary
+
+Endpoint = namedtuple('Endpoint', ['name', 'url', 'max_queries', 'p95_ms'])
+
+# Query budgets include the token lookup of a cold call. `url` is formatted
+# with the sampled user's `username`, busiest `counterpart` and a 3-letter
+# `prefix` of their username.
+ENDPOINTS = [
+    Endpoint('get_friends', '/api/chat/friends/', 3, 150),
+    Endpoint('message_history', '/api/chat/messages/{counterpart}/', 5, 50),
+    Endpoint('search_users', '/api/users/?search={prefix}', 2, 50),
+    Endpoint('chat_search_users', '/api/chat/users/?search={prefix}', 1, 50),
+    Endpoint('list_friends', '/api/friends/', 3, 150),
+    Endpoint('list_invitations', '/api/invitations/', 3, 100),
+]
+
+
+def clear_request_caches():
+    """Clear the process caches a request may hit, so the next call is cold."""
+    identity_cache.clear()
+    friend_graph.clear()
+    principal_cache.clear()
+
+
+def sample_users(sample, rng=None):
+    """Half the sample from the most-connected users, half at random."""
+    rng = rng or random.Random(0)
+    busiest = list(
+        User.objects.annotate(
+            degree=Count('sent_invitations', distinct=True) + Count('received_invitations', distinct=True)
+        )
+        .order_by('-degree').values_list('id', flat=True)[:(sample + 1) // 2]
+    )
+    ids = list(User.objects.exclude(id__in=busiest).values_list('id', flat=True))
+    return busiest + rng.sample(ids, min(len(ids), sample - len(busiest)))
+
+
+def _url_params(user):
+    counterpart = (
+        ConversationSummary.objects.filter(owner=user)
+        .order_by('-last_activity').values_list('counterpart__username', flat=True).first()
+    )
+    return {'username': user.username, 'counterpart': counterpart, 'prefix': user.username[:3]}
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_benchmarks(sample=10, iterations=5, check_latency=True, endpoints=ENDPOINTS):
+    """
+    Returns (report, violations): per endpoint the worst query count and
+    latency percentiles over the sample, and a message per broken budget.
+    """
+    client = APIClient()
+    users = User.objects.in_bulk(sample_users(sample))
+    user_search.warm()  # Build the index outside the measured calls
+
+    timings = {endpoint.name: [] for endpoint in endpoints}
+    queries = {endpoint.name: [] for endpoint in endpoints}
+    for user in users.values():
+        params = _url_params(user)
+        token, _ = Token.objects.get_or_create(user=user)
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+        for endpoint in endpoints:
+            if '{counterpart}' in endpoint.url and params['counterpart'] is None:
+                continue
+            url = endpoint.url.format(**params)
+
+            clear_request_caches()
+            with CaptureQueriesContext(connection) as captured:
+                response = client.get(url)
+            if response.status_code != 200:
+                raise RuntimeError(f"{url} returned {response.status_code} for {user.username}")
+            queries[endpoint.name].append(len(captured))
+
+            for _ in range(iterations):
+                started = time.perf_counter()
+                client.get(url)
+                timings[endpoint.name].append((time.perf_counter() - started) * 1000)
+
+    report, violations = {}, []
+    for endpoint in endpoints:
+        if not queries[endpoint.name]:
+            continue
+        worst = max(queries[endpoint.name])
+        latencies = timings[endpoint.name]
+        p95 = _percentile(latencies, 0.95) if latencies else None
+        report[endpoint.name] = {
+            'calls': len(queries[endpoint.name]),
+            'max_queries': worst,
+            'query_budget': endpoint.max_queries,
+            'p50_ms': round(_percentile(latencies, 0.50), 2) if latencies else None,
+            'p95_ms': round(p95, 2) if latencies else None,
+            'p95_budget_ms': endpoint.p95_ms,
+        }
+        if worst > endpoint.max_queries:
+            violations.append(f"{endpoint.name}: {worst} queries (budget {endpoint.max_queries})")
+        if check_latency and p95 is not None and p95 > endpoint.p95_ms:
+            violations.append(f"{endpoint.name}: p95 {p95:.1f}ms (budget {endpoint.p95_ms}ms)")
+    return report, violations
@@ -0,0 +1,137 @@
+"""
+Wire formats for the chat and status sockets.
+
+JSON text frames are the default. Clients that offer the `msgpack` WebSocket
+subprotocol during the handshake get binary MessagePack frames instead, with
+the long JSON field names replaced by the short keys in SHORT_KEYS (the same
+m/s/t/id already used for channel-layer events). Incoming frames are decoded
+by frame type, so a msgpack client may still send JSON text and vice versa.
+
+Broadcasts are encoded once, in every format, by the sending consumer
+(encode_frames) and each recipient just sends the frame for its own codec,
+so fan-out to a room costs no serialization per connection.
+"""
+
+import json
+
+import msgpack
+
+from .outbound import CONTROL, OVERFLOW_CLOSE_CODE, OutboundQueue
+
+MSGPACK_SUBPROTOCOL = 'msgpack'
+
+# JSON field name -> MessagePack key
+SHORT_KEYS = {
+    'type': 'y',
+    'message': 'm',
+    'sender': 's',
+    'timestamp': 't',
+    'clientMsgId': 'id',
+    'clientSendTs': 'cs',
+    'typing': 'g',
+    'reader': 'r',
+    'user': 'u',
+    'status': 'st',
+    'error': 'e',
+    'seq': 'q',
+}
+LONG_KEYS = {short: long for long, short in SHORT_KEYS.items()}
+
+
+def _rename(value, keys):
+    if isinstance(value, dict):
+        return {keys.get(k, k): _rename(v, keys) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_rename(v, keys) for v in value]
+    return value
+
+
+class JSONCodec:
+    name = 'json'
+    subprotocol = None
+
+    def encode(self, payload):
+        return json.dumps(payload)
+
+
+class MsgPackCodec:
+    name = 'msgpack'
+    subprotocol = MSGPACK_SUBPROTOCOL
+
+    def encode(self, payload):
+        return msgpack.packb(_rename(payload, SHORT_KEYS))
+
+
+JSON = JSONCodec()
+MSGPACK = MsgPackCodec()
+CODECS = (JSON, MSGPACK)
+
+
+def negotiate(scope):
+    """Pick the codec for a connection from the subprotocols the client offered."""
+    if MSGPACK_SUBPROTOCOL in scope.get('subprotocols', ()):
+        return MSGPACK
+    return JSON
+
+
+def encode_frames(payload):
+    """Encode a payload once per codec, keyed by codec name, for a channel-layer event."""
+    return {codec.name: codec.encode(payload) for codec in CODECS}
+
+
+def decode_frame(text_data=None, bytes_data=None):
+    """Decode an incoming frame into a payload with long (JSON) keys."""
+    if bytes_data is not None:
+        return _rename(msgpack.unpackb(bytes_data), LONG_KEYS)
+    return json.loads(text_data)
+
+
+class CodecMixin:
+    """
+    Adds codec negotiation and encoded sends to an AsyncWebsocketConsumer.
+    Once accepted, every send goes through the connection's OutboundQueue
+    (see outbound.py); `kind`, `key` and `seq` tell the queue how to treat
+    the frame when the client falls behind.
+    """
+
+    codec = JSON
+    outbound = None
+    resume_seq = None  # ?since= of the connection: the resume point until a chat frame is written
+
+    async def accept_negotiated(self):
+        self.codec = negotiate(self.scope)
+        await self.accept(subprotocol=self.codec.subprotocol)
+        self.outbound = OutboundQueue.from_settings(self.write_frame, self.outbound_overflow)
+        self.outbound.start()
+
+    async def close_outbound(self):
+        if self.outbound is not None:
+            await self.outbound.close()
+
+    async def write_frame(self, frame):
+        """Write an already encoded frame (str for JSON, bytes for MessagePack) to the socket."""
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    async def outbound_overflow(self, last_seq):
+        # The client fell too far behind: tell it where to resume from and hang up
+        if last_seq is None:
+            last_seq = self.resume_seq
+        notice = {'type': 'overflow'} if last_seq is None else {'type': 'overflow', 'lastSeq': last_seq}
+        await self.write_frame(self.codec.encode(notice))
+        await self.close(code=OVERFLOW_CLOSE_CODE)
+
+    async def send_frame(self, frame, kind=CONTROL, key=None, seq=None):
+        if self.outbound is None:
+            await self.write_frame(frame)
+        else:
+            self.outbound.put(frame, kind, key, seq)
+
+    async def send_payload(self, payload, kind=CONTROL, key=None, seq=None):
+        await self.send_frame(self.codec.encode(payload), kind, key, seq)
+
+    async def send_encoded(self, event, kind=CONTROL, key=None, seq=None):
+        """Send this connection's frame from an event built with encode_frames()."""
+        await self.send_frame(event[self.codec.name], kind, key, seq)
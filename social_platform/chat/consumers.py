@@ -1,183 +1,418 @@
-import json
-import time
 import asyncio
-from channels.generic.websocket import AsyncWebsocketConsumer
+import logging
+import time
+from collections import Counter
+from urllib.parse import parse_qs
 from channels.db import database_sync_to_async
-from django.contrib.auth.models import User
-from .models import Message
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from core.metrics import registry, SIZE_BUCKETS_BYTES
+from .codec import CodecMixin, decode_frame, encode_frames
+from .dedup import MAX_ID_LENGTH, recent_client_ids
+from .outbound import CHAT, PRESENCE, RECEIPT, TYPING
+from base.identity import UserIdentity, identity_cache
+from .persistence import PendingMessage, message_queue
+from .presence import friend_identities, presence_group, presence_registry
+from . import ratelimit
+from .reads import read_pointers, unread_state
+from .sequences import allocate_for_usernames, messages_after, seq_gaps
+from .typing import TypingCoalescer
+
+logger = logging.getLogger(__name__)
+
+# Metrics (served at /api/metrics/)
+FRAMES_RECEIVED = registry.counter('chat_frames_received_total', 'WebSocket frames received by ChatConsumer')
+MESSAGES_BROADCAST = registry.counter('chat_messages_broadcast_total', 'Chat messages broadcast to a room')
+MESSAGE_SIZE = registry.histogram('chat_message_size_bytes', 'Size of received chat frames', SIZE_BUCKETS_BYTES)
+NETWORK_LATENCY = registry.histogram('chat_client_network_latency_ms', 'Client-reported send time to server receive')
+RECEIVE_TO_BROADCAST = registry.histogram('chat_receive_to_broadcast_ms', 'Frame received to group_send completed')
+BROADCAST_TO_SEND = registry.histogram('chat_broadcast_to_send_ms', 'Message broadcast to frame sent to a recipient')
+BATCH_SIZE = registry.histogram('chat_batch_events', 'Events per batched client frame', (1, 2, 5, 10, 25, 50, 100))
+
+# Acks held back until their echo is queued; beyond this the oldest is sent early
+MAX_ACKS_AFTER_ECHO = 64
 
 # 1. CHAT CONSUMER: Handles Real-time Messaging
-class ChatConsumer(AsyncWebsocketConsumer):
+class ChatConsumer(CodecMixin, AsyncWebsocketConsumer):
+    acks_after_echo = None  # Set in connect(); handlers also run on bare instances (bench_fanout)
+
     async def connect(self):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
         self.room_group_name = f'chat_{self.room_name}'
+
+        # Only the two participants may join (and be replayed) a conversation
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated or user.username not in self.room_name.split('_'):
+            await self.close(code=4001)
+            return
+
+        self.typing = TypingCoalescer.from_settings(self._broadcast_typing)
+        self.limiter = ratelimit.ConnectionLimiter(user.id)
+        self.acks_after_echo = {}  # seq -> ack, sent once the echo of that message is queued
+        # Join the room before replaying so nothing falls between replay and live
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
+        await self.accept_negotiated()
+
+        # Resume handshake: ?since=<last seq seen> replays only the gap
+        since = parse_qs(self.scope.get('query_string', b'').decode()).get('since', [None])[0]
+        if since is not None and since.isdigit():
+            self.resume_seq = int(since)
+            await self._replay(self.resume_seq)
+
+        await self._send_unread()
+
+    async def _send_unread(self):
+        # The connecting user's badge for this conversation, from their summary row
+        user = self.scope.get('user')
+        users = self.room_name.split('_')
+        if user is None or not user.is_authenticated or user.username not in users:
+            return
+        counterpart = users[1] if users[0] == user.username else users[0]
+        other = await identity_cache.aget_by_username(counterpart)
+        if other is None:
+            return
+        last_read_seq, count = await unread_state(user.id, other.id)
+        await self.send_payload({'type': 'unread', 'with': counterpart, 'count': count, 'lastReadSeq': last_read_seq})
+
+    async def _replay(self, since):
+        # Make sure the messages this process queued so far are readable first
+        await message_queue.drain()
+        limit = getattr(settings, 'CHAT_RESUME_MAX_REPLAY', 500)
+        users = self.room_name.split('_')
+        frames, truncated, last_reserved = await messages_after(users[0], users[-1], since, limit)
+
+        # Seqs reserved but not stored yet were most likely broadcast by another
+        # worker whose write-behind queue has not flushed: look once more
+        gaps = [] if truncated else seq_gaps(frames, since, last_reserved)
+        if gaps:
+            await asyncio.sleep(getattr(settings, 'CHAT_RESUME_RECHECK_DELAY', 0.25))
+            frames, truncated, last_reserved = await messages_after(users[0], users[-1], since, limit)
+            gaps = [] if truncated else seq_gaps(frames, since, last_reserved)
+
+        for frame in frames:
+            await self.send_payload(frame, CHAT, seq=frame['seq'])
+        # truncated: the gap is too large, the client should refetch history instead.
+        # lastSeq stops before the first remaining gap, so resuming from it
+        # checks for the missing messages again.
+        last_seq = frames[-1]['seq'] if frames else since
+        if gaps:
+            last_seq = gaps[0][0] - 1
+        await self.send_payload({
+            'type': 'resume',
+            'since': since,
+            'replayed': len(frames),
+            'lastSeq': last_seq,
+            'truncated': truncated,
+            'gaps': gaps,
+        })
 
     async def disconnect(self, close_code):
+        if not hasattr(self, 'typing'):
+            return  # Rejected in connect()
+        # Don't leave a typing indicator stuck on for the other side
+        await self.typing.close()
+        await self.close_outbound()
+        self.acks_after_echo.clear()
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
 
-    async def receive(self, text_data):
-        # PROFILING: Track when message hits server
+    def typing_event(self, sender, typing):
+        return {
+            'type': 'typing_indicator',
+            'k': sender,  # Send-queue coalescing key
+            **encode_frames({
+                'type': 'typing',
+                'sender': sender,
+                'typing': typing
+            })
+        }
+
+    async def _broadcast_typing(self, sender, typing):
+        await self.channel_layer.group_send(self.room_group_name, self.typing_event(sender, typing))
+
+    async def receive(self, text_data=None, bytes_data=None):
+        # METRICS: Track when message hits server
         t_receive = time.time()
-        msg_len = len(text_data)
-        
-        data = json.loads(text_data)
-        message_type = data.get('type', 'chat_message')
-        
-        # Extract client timestamp if present
-        client_send_ts = data.get('clientSendTs')
-        if client_send_ts:
-            network_latency = (t_receive * 1000) - client_send_ts
-            print(f"📊 Network latency: {network_latency:.1f}ms, size: {msg_len}B")
-        
-        # Handle typing indicator
-        if message_type == 'typing':
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'typing_indicator',
-                    'sender': data.get('sender'),
-                    'typing': data.get('typing', False)
-                }
-            )
+        FRAMES_RECEIVED.inc()
+        MESSAGE_SIZE.observe(len(text_data if text_data is not None else bytes_data))
+
+        # A client that has used up every bucket is turned away before decoding
+        if self.limiter.exhausted():
+            return
+
+        data = decode_frame(text_data, bytes_data)
+
+        # Batch frame: a list of chat/typing/read events handled as one unit
+        if isinstance(data, list):
+            await self._receive_batch(data, t_receive)
+            return
+
+        room_events, pending, acks, errors = await self._handle_events([data], t_receive)
+        if errors:
+            await self.send_payload(errors[0])
+            return
+        for event in room_events:
+            await self.channel_layer.group_send(self.room_group_name, event)
+        await self._after_broadcast(room_events, pending, t_receive)
+        # Only sends with a clientMsgId are acked: new, or a retry of one already sent
+        for ack in acks:
+            if ack['status'] == 'new' and ack['seq'] is not None:
+                self.acks_after_echo[ack['seq']] = ack
+            else:
+                await self.send_payload({'type': 'ack', 'acks': [ack], 'errors': []})
+        # An echo dropped by the send queue never releases its ack: send the oldest early
+        while len(self.acks_after_echo) > MAX_ACKS_AFTER_ECHO:
+            oldest = self.acks_after_echo.pop(next(iter(self.acks_after_echo)))
+            await self.send_payload({'type': 'ack', 'acks': [oldest], 'errors': []})
+
+    async def _receive_batch(self, events, t_receive):
+        max_events = getattr(settings, 'CHAT_MAX_BATCH_EVENTS', 100)
+        if len(events) > max_events:
+            await self.send_payload({'type': 'ack', 'acks': [], 'errors': [
+                {'error': f'Batch exceeds {max_events} events'}
+            ]})
             return
-        
-        # Handle read receipt
-        if message_type == 'read_receipt':
+        BATCH_SIZE.observe(len(events))
+
+        room_events, pending, acks, errors = await self._handle_events(events, t_receive)
+
+        # One channel-layer send for the whole batch, one persistence hand-off
+        if len(room_events) == 1:
+            await self.channel_layer.group_send(self.room_group_name, room_events[0])
+        elif room_events:
             await self.channel_layer.group_send(
                 self.room_group_name,
-                {
-                    'type': 'read_receipt_message',
-                    'reader': data.get('sender')
-                }
+                {'type': 'event_batch', 'events': room_events}
             )
-            return
-        
-        # Handle regular chat message
-        message_content = data.get('message')
-        sender_username = data.get('sender')
-        client_msg_id = data.get('clientMsgId')  # For round-trip tracking
-        
-        if not message_content or not sender_username:
-            await self.send(text_data=json.dumps({
-                'error': 'Missing message or sender'
-            }))
-            return
+        await self._after_broadcast(room_events, pending, t_receive)
+
+        await self.send_payload({'type': 'ack', 'acks': acks, 'errors': errors})
+
+    async def _handle_events(self, events, t_receive):
+        """
+        Turn decoded client events into room events and messages to persist.
+        Returns (room_events, pending_messages, acks, errors); sends nothing.
+        """
+        room_events, chats, reads, acks, errors = [], [], [], [], []
+        for data in events:
+            if not isinstance(data, dict):
+                errors.append({'error': 'Event must be an object'})
+                continue
+
+            message_type = data.get('type', 'chat_message')
+
+            # Rate limits apply before any sequence allocation or channel-layer work
+            kind = (ratelimit.TYPING if message_type == 'typing'
+                    else ratelimit.READ if message_type == 'read_receipt' else ratelimit.CHAT)
+            retry_after = self.limiter.allow(kind)
+            if retry_after is not None:
+                # Throttled typing and read events are dropped silently
+                if kind == ratelimit.CHAT:
+                    errors.append(self.rate_limited_notice(retry_after, data.get('clientMsgId')))
+                continue
+
+            # Extract client timestamp if present
+            client_send_ts = data.get('clientSendTs')
+            if isinstance(client_send_ts, (int, float)):
+                NETWORK_LATENCY.observe((t_receive * 1000) - client_send_ts)
+
+            # Handle typing indicator (only state changes reach the room)
+            if message_type == 'typing':
+                sender = self.scope['user'].username  # Never the claimed sender
+                typing = bool(data.get('typing', False))
+                if self.typing.update(sender, typing):
+                    room_events.append(self.typing_event(sender, typing))
+                continue
+
+            # Handle read receipt (seq: last message read, omitted for "everything")
+            if message_type == 'read_receipt':
+                # The reader is whoever the socket belongs to, never the claimed sender
+                user = self.scope['user']
+                reader = user.username
+                if not user.is_authenticated or reader not in self.room_name.split('_'):
+                    continue
+                read_seq = data.get('seq') if isinstance(data.get('seq'), int) else None
+                receipt = {'type': 'read_receipt', 'reader': reader}
+                if read_seq is not None:
+                    receipt['seq'] = read_seq
+                room_events.append({'type': 'read_receipt_message', 'k': reader, **encode_frames(receipt)})
+                reads.append((reader, read_seq))
+                continue
+
+            # Handle regular chat message
+            message_content = data.get('message')
+            # Sent as the socket's user, whatever the frame claims (connect() admits participants only)
+            sender_username = self.scope['user'].username
+            client_msg_id = data.get('clientMsgId')  # For round-trip tracking
+
+            if not message_content:
+                errors.append({'error': 'Missing message', 'clientMsgId': client_msg_id})
+                continue
+
+            # Retried sends reuse the clientMsgId: ack them, don't broadcast again
+            dedup_id = str(client_msg_id) if isinstance(client_msg_id, (str, int)) and client_msg_id != '' else None
+            if dedup_id is not None and len(dedup_id) > MAX_ID_LENGTH:
+                errors.append({'error': f'clientMsgId longer than {MAX_ID_LENGTH} characters'})
+                continue
+            ack = None
+            if dedup_id is not None:
+                original = recent_client_ids.claim(self.scope['user'].id, dedup_id)
+                if original is not None:
+                    acks.append({'clientMsgId': client_msg_id, 'status': 'duplicate', **original})
+                    continue
+                ack = {'clientMsgId': client_msg_id, 'status': 'new'}
+                acks.append(ack)
+
+            # A sent message ends the sender's typing state on every client
+            self.typing.reset(sender_username)
+
+            # Determine receiver from room name (format: user1_user2)
+            users = self.room_name.split('_')
+            receiver_username = users[1] if users[0] == sender_username else users[0]
+
+            # Use compact timestamp (Unix ms instead of ISO string)
+            timestamp = int(time.time() * 1000)
 
-        # Determine receiver from room name (format: user1_user2)
+            chats.append((len(room_events), sender_username, receiver_username, message_content,
+                          client_msg_id, dedup_id, ack, timestamp))
+            room_events.append(None)  # Filled in once sequence numbers are reserved
+
+        if reads:
+            await self._record_reads(reads)
+
+        # One round trip reserves sequence numbers for every message in the frame
+        # (in a transaction, so in the sync worker thread rather than the async ORM)
+        pending = []
+        if chats:
+            try:
+                next_seq = await database_sync_to_async(allocate_for_usernames)(
+                    Counter((sender, receiver) for _, sender, receiver, *_ in chats)
+                )
+            except Exception:
+                # Nothing was sent: report the messages as failed and let the
+                # client's retry through instead of acking it as in flight
+                logger.exception("Failed to allocate sequence numbers for %d messages", len(chats))
+                for index, sender, receiver, content, client_msg_id, dedup_id, ack, timestamp in chats:
+                    room_events[index] = None
+                    if ack is not None:
+                        recent_client_ids.release(self.scope['user'].id, dedup_id)
+                        acks.remove(ack)
+                    errors.append({'error': 'Message could not be sent, please retry', 'clientMsgId': client_msg_id})
+                return [event for event in room_events if event is not None], pending, acks, errors
+            for index, sender, receiver, content, client_msg_id, dedup_id, ack, timestamp in chats:
+                seq = next_seq[(sender, receiver)]
+                if seq is not None:
+                    next_seq[(sender, receiver)] = seq + 1
+                room_events[index] = self.chat_event(content, sender, timestamp, client_msg_id, seq)
+                pending.append(PendingMessage(sender, receiver, content, seq, dedup_id))
+                if ack is not None:
+                    ack.update(timestamp=timestamp, seq=seq)
+                    recent_client_ids.record(self.scope['user'].id, dedup_id, timestamp, seq)
+
+        return room_events, pending, acks, errors
+
+    @staticmethod
+    def rate_limited_notice(retry_after, client_msg_id=None):
+        # No 'error' key: the client treats that as a broken connection
+        notice = {'type': 'rate_limited', 'code': 'rate_limited', 'retryAfterMs': int(retry_after * 1000) + 1}
+        if client_msg_id is not None:
+            notice['clientMsgId'] = client_msg_id
+        return notice
+
+    async def _record_reads(self, reads):
+        # Coalesced and written in batches by read_pointers
         users = self.room_name.split('_')
-        receiver_username = users[1] if users[0] == sender_username else users[0]
-
-        # Use compact timestamp (Unix ms instead of ISO string)
-        timestamp = int(time.time() * 1000)
-        
-        # PROFILING: Track broadcast start
-        t_broadcast_start = time.time()
-        
-        # Broadcast immediately with MINIMAL payload
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'm': message_content,  # Shortened key
-                's': sender_username,
-                't': timestamp,
-                'id': client_msg_id  # Echo back for ack
-            }
-        )
-        
-        # PROFILING: Log broadcast time
-        broadcast_time = (time.time() - t_broadcast_start) * 1000
-        total_time = (time.time() - t_receive) * 1000
-        print(f"⚡ Broadcast: {broadcast_time:.1f}ms | Total: {total_time:.1f}ms | Msg: {msg_len}B")
-        
-        # Save to DB truly async without blocking
-        asyncio.create_task(self._save_message_async(sender_username, receiver_username, message_content))
+        identities = await identity_cache.aresolve_usernames(users)
+        for reader, read_seq in reads:
+            counterpart = users[1] if users[0] == reader else users[0]
+            if reader in identities and counterpart in identities:
+                read_pointers.mark_read(identities[reader].id, identities[counterpart].id, read_seq)
+
+    async def _after_broadcast(self, room_events, pending, t_receive):
+        if pending:
+            # METRICS: Receive -> broadcast time
+            MESSAGES_BROADCAST.inc(len(pending))
+            RECEIVE_TO_BROADCAST.observe((time.time() - t_receive) * 1000)
+
+            # Hand off to the write-behind queue (waits only if the queue is full)
+            await message_queue.put_many(pending)
+
+    @staticmethod
+    def chat_event(message, sender, timestamp, client_msg_id, seq=None):
+        """Channel-layer event for a chat message, with the client frame pre-encoded"""
+        return {
+            'type': 'chat_message',
+            't': timestamp,
+            'q': seq,
+            **encode_frames({
+                'message': message,
+                'sender': sender,
+                'timestamp': timestamp,
+                'clientMsgId': client_msg_id,  # Echo back for ack
+                'seq': seq  # Position in the conversation, for resume
+            })
+        }
+
+    # Handlers below only forward the frame encoded by the sender's consumer
 
     # Method to send chat message to WebSocket
     async def chat_message(self, event):
-        # PROFILING: Track when we send to client
-        t_send = time.time()
-        
-        # Expand compact keys back to full format for client
-        await self.send(text_data=json.dumps({
-            'message': event['m'],
-            'sender': event['s'],
-            'timestamp': event['t'],
-            'clientMsgId': event.get('id')  # For ack tracking
-        }))
-        
-        print(f"📤 Sent to client at t={t_send*1000:.0f}ms")
+        # METRICS: Broadcast timestamp -> send to this client
+        BROADCAST_TO_SEND.observe(time.time() * 1000 - event['t'])
+        await self.send_encoded(event, CHAT, seq=event.get('q'))
+        ack = self.acks_after_echo.pop(event.get('q'), None) if self.acks_after_echo else None
+        if ack is not None:
+            await self.send_payload({'type': 'ack', 'acks': [ack], 'errors': []})
     
     # Method to send typing indicator to WebSocket
     async def typing_indicator(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'typing',
-            'sender': event['sender'],
-            'typing': event['typing']
-        }))
+        await self.send_encoded(event, TYPING, key=event.get('k'))
     
     # Method to send read receipt to WebSocket
     async def read_receipt_message(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'read_receipt',
-            'reader': event['reader']
-        }))
-    
-    # Async DB save - properly non-blocking
-    async def _save_message_async(self, sender_username, receiver_username, content):
-        """Async task to save message to DB without blocking WebSocket"""
-        try:
-            t_db_start = time.time()
-            await self._db_save(sender_username, receiver_username, content)
-            db_time = (time.time() - t_db_start) * 1000
-            print(f"💾 DB save: {db_time:.1f}ms")
-        except Exception as e:
-            print(f"❌ DB save failed: {str(e)}")
-    
-    @database_sync_to_async
-    def _db_save(self, sender_username, receiver_username, content):
-        """Actual DB operation wrapped for async"""
-        s = User.objects.get(username=sender_username)
-        r = User.objects.get(username=receiver_username)
-        Message.objects.create(sender=s, receiver=r, content=content)
+        await self.send_encoded(event, RECEIPT, key=event.get('k'))
 
+    # Batched room events: one frame per event so every client understands them
+    async def event_batch(self, event):
+        handlers = {
+            'chat_message': self.chat_message,
+            'typing_indicator': self.typing_indicator,
+            'read_receipt_message': self.read_receipt_message,
+        }
+        for room_event in event['events']:
+            await handlers[room_event['type']](room_event)
 
-# 2. STATUS CONSUMER: Handles Online/Offline Indicators
-class StatusConsumer(AsyncWebsocketConsumer):
+
+# 2. STATUS CONSUMER: Handles Online/Offline Indicators for a user's friends
+class StatusConsumer(CodecMixin, AsyncWebsocketConsumer):
     async def connect(self):
-        self.username = self.scope['url_route']['kwargs']['username']
-        self.status_group_name = 'user_status'
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            await self.close(code=4001)
+            return
+
+        # Presence is keyed by the authenticated user, not the URL
+        self.identity = UserIdentity(user.id, user.username)
+        self.status_group_name = presence_group(user.id)
 
         await self.channel_layer.group_add(self.status_group_name, self.channel_name)
-        await self.accept()
-
-        # Broadcast that user is online
-        await self.channel_layer.group_send(
-            self.status_group_name,
-            {
-                'type': 'status_update',
-                'user': self.username,
-                'status': 'online'
-            }
-        )
+        await self.accept_negotiated()
+
+        # Tell this socket which friends are online right now
+        for friend in await friend_identities(user.id):
+            if presence_registry.is_online(friend.id):
+                await self.send_payload({'user': friend.username, 'status': 'online'}, PRESENCE, key=friend.username)
+
+        # Friends hear about it on the next presence flush (only if this is the first tab)
+        presence_registry.connect(self.identity)
 
     async def disconnect(self, close_code):
-        # Broadcast that user is offline
-        await self.channel_layer.group_send(
-            self.status_group_name,
-            {
-                'type': 'status_update',
-                'user': self.username,
-                'status': 'offline'
-            }
-        )
+        if not hasattr(self, 'identity'):
+            return
+        await self.close_outbound()
+        presence_registry.disconnect(self.identity)
         await self.channel_layer.group_discard(self.status_group_name, self.channel_name)
 
-    async def status_update(self, event):
-        # Send status update to all connected clients
-        await self.send(text_data=json.dumps({
-            'user': event['user'],
-            'status': event['status']
-        }))
\ No newline at end of file
+    async def status_batch(self, event):
+        # One frame per update so every client understands them (pre-encoded by the registry)
+        for update in event['updates']:
+            await self.send_encoded(update, PRESENCE, key=update.get('k'))
@@ -0,0 +1,65 @@
+"""
+Short-lived window of recently accepted clientMsgIds.
+
+A client that resends after a reconnect reuses the clientMsgId of the
+original send. ChatConsumer claims each (user id, clientMsgId) here before
+allocating a seq or broadcasting, and a retry that finds its id already
+claimed is acked as a duplicate and never reaches the room. The window is
+per process and only WINDOW seconds long; the unique constraint on
+Message(sender, client_msg_id) is the backstop for retries that land on
+another worker or arrive later (see persistence.write_messages).
+"""
+
+from django.conf import settings
+
+from base.cache import TTLCache
+from core.metrics import registry
+
+DEFAULTS = {
+    'WINDOW': 300,  # seconds
+    'MAX_ENTRIES': 100000,
+}
+
+DUPLICATES = registry.counter('chat_duplicate_sends_total', 'Chat sends dropped as retries before fan-out')
+
+MAX_ID_LENGTH = 64  # Message.client_msg_id
+
+# Claimed, but the seq is not allocated yet
+_PENDING = object()
+
+
+class RecentClientIds:
+    def __init__(self, max_entries, window):
+        self._ids = TTLCache(max_entries, window)
+
+    @classmethod
+    def from_settings(cls):
+        conf = {**DEFAULTS, **getattr(settings, 'CHAT_DEDUP', {})}
+        return cls(conf['MAX_ENTRIES'], conf['WINDOW'])
+
+    def claim(self, sender, client_msg_id):
+        """
+        Returns None if the id is new (and claims it), else the ack of the
+        original send: {'timestamp', 'seq'}, empty while it is in flight.
+        """
+        key = (sender, client_msg_id)
+        original = self._ids.get(key)
+        if original is not None:
+            DUPLICATES.inc()
+            return {} if original is _PENDING else original
+        self._ids.set(key, _PENDING)
+        return None
+
+    def record(self, sender, client_msg_id, timestamp, seq):
+        self._ids.set((sender, client_msg_id), {'timestamp': timestamp, 'seq': seq})
+
+    def release(self, sender, client_msg_id):
+        """Drop a claim whose send failed, so a retry is accepted as new."""
+        if self._ids.get((sender, client_msg_id)) is _PENDING:
+            self._ids.pop((sender, client_msg_id))
+
+    def clear(self):
+        self._ids.clear()
+
+
+recent_client_ids = RecentClientIds.from_settings()
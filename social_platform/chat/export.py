@@ -0,0 +1,111 @@
+"""
+Streaming NDJSON export of a user's messages.
+
+`export_chunks` yields the export as byte chunks, one JSON object per line:
+first the archived messages (segment by segment, see archive.py), then the
+hot table in id order. The hot table is read in keyset chunks of CHUNK_SIZE
+rows (id > last id seen), each one indexed range query, so memory stays
+constant however long the conversation is, and no cursor has to stay open
+between chunks.
+
+Under ASGI (daphne) the view streams through `aiter_chunks`, which fetches
+each chunk in the sync worker thread; a plain sync iterator would make
+Django buffer the whole response first.
+"""
+
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Q
+
+from base.identity import identity_cache
+
+from .archive import load_segment
+from .models import ArchiveSegment, Message
+
+DEFAULTS = {
+    'CHUNK_SIZE': 2000,
+}
+
+
+def export_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_EXPORT', {})}
+
+
+class _Names:
+    """Username lookup that resolves each chunk's unknown ids in one call."""
+
+    def __init__(self):
+        self._names = {}
+
+    def load(self, user_ids):
+        missing = set(user_ids) - self._names.keys()
+        if missing:
+            found = identity_cache.resolve_ids(missing)
+            for user_id in missing:
+                self._names[user_id] = found[user_id].username if user_id in found else None
+
+    def __getitem__(self, user_id):
+        return self._names[user_id]
+
+
+def _lines(rows, names):
+    names.load(user_id for row in rows for user_id in (row[1], row[2]))
+    return ''.join(
+        json.dumps({
+            'id': message_id,
+            'sender': names[sender_id],
+            'receiver': names[receiver_id],
+            'content': content,
+            'timestamp': timestamp,
+            'seq': seq,
+        }) + '\n'
+        for message_id, sender_id, receiver_id, seq, timestamp, content in rows
+    ).encode()
+
+
+def export_chunks(user_id, counterpart_id=None, chunk_size=None):
+    """
+    NDJSON chunks of every message of `user_id` (or only the conversation
+    with `counterpart_id`), archived messages first.
+    """
+    chunk_size = chunk_size or export_settings()['CHUNK_SIZE']
+    names = _Names()
+
+    if counterpart_id is not None:
+        low, high = sorted((user_id, counterpart_id))
+        segments = ArchiveSegment.objects.filter(user_low_id=low, user_high_id=high)
+        messages = Message.objects.filter(
+            Q(sender_id=low, receiver_id=high) | Q(sender_id=high, receiver_id=low)
+        )
+    else:
+        segments = ArchiveSegment.objects.filter(Q(user_low_id=user_id) | Q(user_high_id=user_id))
+        messages = Message.objects.filter(Q(sender_id=user_id) | Q(receiver_id=user_id))
+
+    for segment_id, low, high in segments.order_by('first_id').values_list('id', 'user_low_id', 'user_high_id'):
+        rows = [
+            (message_id, sender_id, high if sender_id == low else low, seq, timestamp, content)
+            for message_id, sender_id, seq, timestamp, content in load_segment(segment_id)
+        ]
+        yield _lines(rows, names)
+
+    last_id = 0
+    while True:
+        rows = list(
+            messages.filter(id__gt=last_id).order_by('id')
+            .values_list('id', 'sender_id', 'receiver_id', 'seq', 'timestamp', 'content')[:chunk_size]
+        )
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield _lines([(*row[:4], row[4].isoformat(), row[5]) for row in rows], names)
+
+
+async def aiter_chunks(chunks):
+    """Drive a sync chunk generator from async code, one thread hop per chunk."""
+    while True:
+        chunk = await sync_to_async(next)(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
@@ -0,0 +1,45 @@
+"""
+Move messages older than the archive horizon into compressed segments.
+
+    python manage.py archive_messages                  # once, CHAT_ARCHIVE horizon
+    python manage.py archive_messages --days 90
+    python manage.py archive_messages --loop           # background job
+
+See chat/archive.py for the segment format and how history reads it.
+"""
+
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.archive import archive_before, archive_settings
+
+
+class Command(BaseCommand):
+    help = "Archive cold chat messages into per-conversation monthly segments"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help="Archive messages older than this many days")
+        parser.add_argument('--max-conversations', type=int, help="Conversations per run")
+        parser.add_argument('--loop', action='store_true', help="Keep running every CHAT_ARCHIVE['INTERVAL'] seconds")
+
+    def handle(self, *args, **options):
+        conf = archive_settings()
+        days = options['days'] if options['days'] is not None else conf['HORIZON_DAYS']
+        max_conversations = options['max_conversations'] or conf['MAX_CONVERSATIONS']
+
+        while True:
+            cutoff = timezone.now() - timedelta(days=days)
+            started = time.perf_counter()
+            conversations, messages = archive_before(cutoff, max_conversations)
+            self.stdout.write(
+                f"Archived {messages} messages from {conversations} conversations "
+                f"older than {cutoff:%Y-%m-%d} in {time.perf_counter() - started:.1f}s"
+            )
+            if not options['loop']:
+                break
+            # A full batch means there is a backlog: go again straight away
+            if conversations < max_conversations:
+                time.sleep(conf['INTERVAL'])
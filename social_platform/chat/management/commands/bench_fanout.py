@@ -0,0 +1,79 @@
+"""
+Measure CPU per broadcast message as the room grows.
+
+Compares the current fan-out (the sending consumer encodes the frame once,
+recipients send it as-is) with the previous one (every recipient's
+chat_message handler re-ran json.dumps on the event). Recipient sockets are
+replaced by a no-op send, so only serialization and handler cost is timed.
+
+    python manage.py bench_fanout --sizes 1 10 100 1000 --messages 2000
+"""
+
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.codec import JSON, MSGPACK
+from chat.consumers import ChatConsumer
+
+
+async def _discard(**frame):
+    pass
+
+
+def _recipients(count):
+    consumers = []
+    for i in range(count):
+        consumer = ChatConsumer()
+        consumer.codec = MSGPACK if i % 2 else JSON  # mixed room
+        consumer.send = _discard
+        consumers.append(consumer)
+    return consumers
+
+
+async def _encode_once(recipients, messages):
+    for i in range(messages):
+        event = ChatConsumer.chat_event(f'message number {i}', 'user1', int(time.time() * 1000), f'c{i}')
+        for consumer in recipients:
+            await consumer.chat_message(event)
+
+
+async def _encode_per_recipient(recipients, messages):
+    # The pre-change handler: compact event, expanded and dumped per recipient
+    for i in range(messages):
+        event = {'type': 'chat_message', 'm': f'message number {i}', 's': 'user1',
+                 't': int(time.time() * 1000), 'id': f'c{i}'}
+        for consumer in recipients:
+            await consumer.send(text_data=json.dumps({
+                'message': event['m'],
+                'sender': event['s'],
+                'timestamp': event['t'],
+                'clientMsgId': event.get('id')
+            }))
+
+
+def _cpu_us_per_message(coro_fn, recipients, messages):
+    start = time.process_time()
+    asyncio.run(coro_fn(recipients, messages))
+    return (time.process_time() - start) / messages * 1e6
+
+
+class Command(BaseCommand):
+    help = 'Benchmark CPU per broadcast message against room connection count'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100, 1000],
+                            help='Room connection counts to measure')
+        parser.add_argument('--messages', type=int, default=2000,
+                            help='Messages broadcast per room size')
+
+    def handle(self, *args, **options):
+        messages = options['messages']
+        self.stdout.write(f"{'connections':>12} {'per-recipient us/msg':>22} {'encode-once us/msg':>20} {'speedup':>8}")
+        for size in options['sizes']:
+            recipients = _recipients(size)
+            before = _cpu_us_per_message(_encode_per_recipient, recipients, messages)
+            after = _cpu_us_per_message(_encode_once, recipients, messages)
+            self.stdout.write(f"{size:>12} {before:>22.1f} {after:>20.1f} {before / after:>7.1f}x")
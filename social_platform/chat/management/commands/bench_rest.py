@@ -0,0 +1,44 @@
+"""
+Benchmark the REST endpoints against the current database and fail if any
+query-count or latency budget is exceeded (see chat/benchmarks.py).
+
+    python manage.py seed_data --users 100000 --messages 2000000
+    python manage.py bench_rest --sample 20 --output bench.json
+"""
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from chat.benchmarks import run_benchmarks
+
+
+class Command(BaseCommand):
+    help = "Time the REST endpoints for a sample of users and check query and latency budgets"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sample', type=int, default=10, help="Users to benchmark")
+        parser.add_argument('--iterations', type=int, default=5, help="Warm calls per user and endpoint")
+        parser.add_argument('--no-latency', action='store_true', help="Only check query budgets")
+        parser.add_argument('--output', help="Write the report as JSON to this file")
+
+    def handle(self, *args, **options):
+        # The test client talks to 'testserver', which has to be an allowed host
+        setup_test_environment()
+        try:
+            report, violations = run_benchmarks(
+                sample=options['sample'],
+                iterations=options['iterations'],
+                check_latency=not options['no_latency'],
+            )
+        finally:
+            teardown_test_environment()
+
+        result = {'endpoints': report, 'violations': violations}
+        self.stdout.write(json.dumps(result, indent=2))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(result, f, indent=2)
+        if violations:
+            raise CommandError(f"{len(violations)} budget(s) exceeded:\n" + '\n'.join(violations))
@@ -0,0 +1,308 @@
+"""
+Load-test the chat WebSocket stack.
+
+Spins up simulated clients in rooms of the given sizes (sockets per room,
+split between the room's two users) and drives a mix of chat, typing and
+read-receipt frames at a fixed rate per client. Chat frames carry a
+clientMsgId; the echo back to the sender gives the end-to-end latency.
+Once sending stops, the database is polled until every acked message is
+persisted, and persistence lag is measured from send time to
+Message.timestamp.
+
+By default the clients talk to core.asgi.application in-process through
+channels' WebsocketCommunicator. With --url they connect to a running server
+instead (needs the `websockets` package); persistence lag is then only
+meaningful if this process uses the same database as the server.
+
+    python manage.py loadtest_chat --clients 200 --room-sizes 2 10 --duration 30
+    python manage.py loadtest_chat --url ws://localhost:8000 --output result.json
+"""
+
+import asyncio
+import itertools
+import json
+import random
+import time
+from functools import partial
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.authtoken.models import Token
+
+from chat.models import Message
+
+USER_PREFIX = 'loadtest'
+
+
+def percentiles(values):
+    if not values:
+        return {'count': 0}
+    ordered = sorted(values)
+
+    def pick(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 2)
+
+    return {
+        'count': len(ordered),
+        'mean': round(sum(ordered) / len(ordered), 2),
+        'p50': pick(0.50),
+        'p90': pick(0.90),
+        'p99': pick(0.99),
+        'max': round(ordered[-1], 2),
+    }
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in ('chat', 'typing', 'read'):
+            raise CommandError(f"Unknown traffic kind {kind!r} in --mix")
+        mix[kind] = float(weight)
+    return mix
+
+
+class InProcessTransport:
+    def __init__(self, application, path):
+        from channels.testing import WebsocketCommunicator
+        self.communicator = WebsocketCommunicator(application, path)
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise CommandError("In-process connection was rejected")
+
+    async def send(self, text):
+        await self.communicator.send_to(text_data=text)
+
+    async def receive(self, timeout):
+        # The communicator cancels the application when its own timeout expires
+        return await asyncio.wait_for(self.communicator.receive_from(timeout=None), timeout)
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class RemoteTransport:
+    def __init__(self, base_url, path):
+        self.url = base_url.rstrip('/') + path
+        self.socket = None
+
+    async def connect(self):
+        import websockets
+        self.socket = await websockets.connect(self.url, max_queue=None)
+
+    async def send(self, text):
+        await self.socket.send(text)
+
+    async def receive(self, timeout):
+        return await asyncio.wait_for(self.socket.recv(), timeout)
+
+    async def close(self):
+        await self.socket.close()
+
+
+class SimulatedClient:
+    def __init__(self, client_id, transport, username, stats):
+        self.client_id = client_id
+        self.transport = transport
+        self.username = username
+        self.stats = stats
+        self.pending = {}  # clientMsgId -> send time (ms)
+        self.sent_at = {}  # clientMsgId -> send time (ms), kept for persistence lag
+
+    async def send_loop(self, rate, mix, deadline):
+        kinds, weights = zip(*mix.items())
+        counter = itertools.count()
+        interval = 1 / rate
+        next_send = time.monotonic()
+        while time.monotonic() < deadline:
+            kind = random.choices(kinds, weights)[0]
+            now_ms = time.time() * 1000
+            if kind == 'chat':
+                msg_id = f'{self.client_id}-{next(counter)}'
+                frame = {'message': f'load {msg_id}', 'sender': self.username,
+                         'clientMsgId': msg_id, 'clientSendTs': now_ms}
+                self.pending[msg_id] = self.sent_at[msg_id] = now_ms
+            elif kind == 'typing':
+                frame = {'type': 'typing', 'sender': self.username, 'typing': random.random() < 0.8}
+            else:
+                frame = {'type': 'read_receipt', 'sender': self.username}
+            await self.transport.send(json.dumps(frame))
+            self.stats['sent'][kind] += 1
+
+            next_send += interval
+            await asyncio.sleep(max(0.0, next_send - time.monotonic()))
+
+    async def receive_loop(self, stop):
+        while not (stop.is_set() and not self.pending):
+            try:
+                text = await self.transport.receive(timeout=0.5)
+            except (asyncio.TimeoutError, TimeoutError):
+                continue
+            except Exception:
+                self.stats['errors'] += 1
+                return
+            self.stats['frames_received'] += 1
+            if not isinstance(text, str):
+                continue
+            data = json.loads(text)
+            if data.get('error') or data.get('type') == 'rate_limited':
+                self.stats['errors'] += 1
+            sent = self.pending.pop(data.get('clientMsgId'), None)
+            if sent is not None and data.get('sender') == self.username:
+                self.stats['latencies'].append(time.time() * 1000 - sent)
+
+
+class Command(BaseCommand):
+    help = "Drive simulated chat clients against the ASGI app and report throughput and latency"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=50, help="Simulated sockets")
+        parser.add_argument('--room-sizes', type=int, nargs='+', default=[2],
+                            help="Sockets per room, cycled over the rooms")
+        parser.add_argument('--duration', type=float, default=10.0, help="Seconds of traffic")
+        parser.add_argument('--rate', type=float, default=2.0, help="Frames per second per client")
+        parser.add_argument('--mix', default='chat=0.6,typing=0.3,read=0.1',
+                            help="Traffic mix weights, e.g. chat=0.6,typing=0.3,read=0.1")
+        parser.add_argument('--url', help="Base ws:// URL of a running server (default: in-process)")
+        parser.add_argument('--drain-timeout', type=float, default=30.0,
+                            help="Seconds to wait for echoes and persistence after sending stops")
+        parser.add_argument('--output', help="Write the result as JSON to this file")
+        parser.add_argument('--keep-data', action='store_true', help="Keep the load-test users and messages")
+
+    def handle(self, *args, **options):
+        mix = parse_mix(options['mix'])
+        if options['url']:
+            try:
+                import websockets  # noqa: F401
+            except ImportError:
+                raise CommandError("--url needs the 'websockets' package (pip install websockets)")
+
+        rooms = self._plan_rooms(options['clients'], options['room_sizes'])
+        usernames = sorted({name for room, _ in rooms for name in room.split('_')})
+        users = [User.objects.get_or_create(username=name)[0] for name in usernames]
+        Message.objects.filter(sender__in=users).delete()
+        # Chat sockets only accept the room's participants
+        tokens = {user.username: Token.objects.get_or_create(user=user)[0].key for user in users}
+
+        try:
+            result = asyncio.run(self._run(rooms, tokens, mix, options))
+        finally:
+            if not options['keep_data']:
+                User.objects.filter(id__in=[user.id for user in users]).delete()
+
+        result['config'] = {
+            key: options[key] for key in ('clients', 'room_sizes', 'duration', 'rate', 'url')
+        }
+        result['config']['mix'] = mix
+        self.stdout.write(json.dumps(result, indent=2))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(result, f, indent=2)
+
+    @staticmethod
+    def _plan_rooms(clients, room_sizes):
+        """[(room name, sockets)] covering `clients` sockets."""
+        rooms = []
+        for index in itertools.count():
+            if clients <= 0:
+                return rooms
+            size = min(room_sizes[index % len(room_sizes)], clients)
+            rooms.append((f'{USER_PREFIX}{index}a_{USER_PREFIX}{index}b', size))
+            clients -= size
+
+    async def _run(self, rooms, tokens, mix, options):
+        stats = {
+            'sent': {'chat': 0, 'typing': 0, 'read': 0},
+            'frames_received': 0,
+            'errors': 0,
+            'latencies': [],
+        }
+        if options['url']:
+            make_transport = partial(RemoteTransport, options['url'])
+        else:
+            from core.asgi import application
+            make_transport = partial(InProcessTransport, application)
+
+        clients = []
+        for room, size in rooms:
+            room_users = room.split('_')
+            for seat in range(size):
+                username = room_users[seat % 2]
+                client = SimulatedClient(len(clients), make_transport(f'/ws/chat/{room}/?token={tokens[username]}'),
+                                         username, stats)
+                await client.transport.connect()
+                clients.append(client)
+
+        stop = asyncio.Event()
+        receivers = [asyncio.create_task(client.receive_loop(stop)) for client in clients]
+        started = time.monotonic()
+        deadline = started + options['duration']
+        await asyncio.gather(*(client.send_loop(options['rate'], mix, deadline) for client in clients))
+        sending_s = time.monotonic() - started
+        stop.set()
+
+        # Let outstanding echoes arrive, then give up on them
+        try:
+            await asyncio.wait_for(asyncio.gather(*receivers), options['drain_timeout'])
+        except asyncio.TimeoutError:
+            for task in receivers:
+                task.cancel()
+        lost = sum(len(client.pending) for client in clients)
+        persisted, lags = await self._persistence_lag(clients, options['drain_timeout'])
+
+        for client in clients:
+            try:
+                await client.transport.close()
+            except Exception:
+                pass
+        if not options['url']:
+            from chat.persistence import message_queue
+            await message_queue.close()
+
+        acked = len(stats['latencies'])
+        return {
+            'sockets': len(clients),
+            'rooms': len(rooms),
+            'sending_seconds': round(sending_s, 2),
+            'sent': stats['sent'],
+            'acked': acked,
+            'lost': lost,
+            'errors': stats['errors'],
+            'frames_received': stats['frames_received'],
+            'throughput': {
+                'chat_msgs_per_s': round(acked / sending_s, 1),
+                'frames_sent_per_s': round(sum(stats['sent'].values()) / sending_s, 1),
+                'frames_received_per_s': round(stats['frames_received'] / sending_s, 1),
+            },
+            'latency_ms': percentiles(stats['latencies']),
+            'persisted': persisted,
+            'persist_lag_ms': percentiles(lags),
+        }
+
+    @staticmethod
+    async def _persistence_lag(clients, timeout):
+        """Wait until every sent chat message is in the database; lag is send -> Message.timestamp."""
+        sent_at = {f'load {msg_id}': ts for client in clients for msg_id, ts in client.sent_at.items()}
+        usernames = {client.username for client in clients}
+
+        @sync_to_async
+        def fetch():
+            return list(
+                Message.objects.filter(sender__username__in=usernames, content__startswith='load ')
+                .values_list('content', 'timestamp')
+            )
+
+        deadline = time.monotonic() + timeout
+        rows = await fetch()
+        while len(rows) < len(sent_at) and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+            rows = await fetch()
+
+        lags = [
+            timestamp.timestamp() * 1000 - sent_at[content]
+            for content, timestamp in rows if content in sent_at
+        ]
+        return len(rows), lags
@@ -0,0 +1,149 @@
+"""
+Seed the database with realistic volumes for benchmarking.
+
+Creates users with varied names, a friendship graph with a heavy-tailed
+degree distribution (some users have far more friends than most), and
+messages concentrated on a minority of busy conversations. Messages go
+through chat.persistence.write_messages, so sequence numbers, conversation
+summaries, unread counts and the search index are built exactly as in
+production.
+
+    python manage.py seed_data --users 100000 --messages 2000000 --friends 20
+
+Every seeded user has the password given by --password.
+"""
+
+import random
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from base.models import Invitation
+from chat.persistence import PendingMessage, write_messages
+
+FIRST_NAMES = [
+    'alex', 'sam', 'maria', 'li', 'omar', 'priya', 'jon', 'ana', 'kenji', 'fatima',
+    'lucas', 'emma', 'noah', 'aisha', 'ivan', 'sofia', 'mateo', 'yuki', 'arjun', 'zoe',
+]
+LAST_NAMES = [
+    'smith', 'garcia', 'chen', 'khan', 'patel', 'kim', 'nguyen', 'silva', 'muller', 'rossi',
+    'ivanova', 'sato', 'okafor', 'haddad', 'larsen', 'novak', 'costa', 'singh', 'brown', 'ali',
+]
+WORDS = (
+    'hey hi ok sure thanks lunch dinner tomorrow today tonight meeting call later soon '
+    'sounds good great cool see you there running late on my way did you get the file '
+    'let me know what time works for you weekend plans movie game coffee'
+).split()
+
+# Messages per write_messages call. The signal handlers build one clause
+# per conversation in the batch, which SQLite caps at ~1000 expressions.
+MESSAGE_BATCH = 1000
+
+# Invitation status mix for seeded relationships
+STATUS_WEIGHTS = {'accepted': 0.7, 'pending': 0.2, 'rejected': 0.1}
+
+# Rounds of pair draws that may add nothing before the graph is left as is
+MAX_FRUITLESS_DRAWS = 20
+
+
+class Command(BaseCommand):
+    help = "Generate users, friendships and messages at benchmark scale"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--friends', type=int, default=20, help="Average relationships per user")
+        parser.add_argument('--messages', type=int, default=20000)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--password', default='seedpass123')
+        parser.add_argument('--seed', type=int, help="Random seed, for repeatable data")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        batch_size = options['batch_size']
+
+        started = time.perf_counter()
+        users = self._create_users(rng, options['users'], options['password'], batch_size)
+        self.stdout.write(f"{len(users)} users in {time.perf_counter() - started:.1f}s")
+
+        started = time.perf_counter()
+        friendships = self._create_invitations(rng, users, options['friends'], batch_size)
+        self.stdout.write(f"{len(friendships)} accepted friendships in {time.perf_counter() - started:.1f}s")
+
+        started = time.perf_counter()
+        sent = self._create_messages(rng, users, friendships, options['messages'])
+        self.stdout.write(f"{sent} messages in {time.perf_counter() - started:.1f}s")
+
+    def _create_users(self, rng, count, password, batch_size):
+        """Returns [(id, username)] of the new users."""
+        hashed = make_password(password)  # Hash once; hashing per user would dominate
+        offset = User.objects.count()
+        created = []
+        for start in range(0, count, batch_size):
+            batch = []
+            for i in range(offset + start, offset + min(start + batch_size, count)):
+                username = f'{rng.choice(FIRST_NAMES)}{rng.choice(LAST_NAMES)}{i}'
+                batch.append(User(username=username, email=f'{username}@example.com', password=hashed))
+            created.extend((user.id, user.username) for user in User.objects.bulk_create(batch))
+        return created
+
+    def _create_invitations(self, rng, users, average, batch_size):
+        """Returns the accepted pairs as [(user id, user id)]."""
+        if len(users) < 2:
+            return []
+        ids = [user_id for user_id, _ in users]
+        # Heavy-tailed popularity: a few users attract most relationships
+        popularity = [rng.paretovariate(1.5) for _ in ids]
+        statuses, status_weights = zip(*STATUS_WEIGHTS.items())
+
+        pairs = set()
+        # No more pairs than a complete graph; the last few can take many draws
+        # to hit, so also stop once a run of draws adds nothing new
+        target = min(len(ids) * average // 2, len(ids) * (len(ids) - 1) // 2)
+        fruitless = 0
+        while len(pairs) < target and fruitless < MAX_FRUITLESS_DRAWS:
+            before = len(pairs)
+            for a, b in zip(rng.choices(ids, popularity, k=batch_size), rng.choices(ids, k=batch_size)):
+                if a != b:
+                    pairs.add((min(a, b), max(a, b)))
+            fruitless = fruitless + 1 if len(pairs) == before else 0
+
+        accepted, batch = [], []
+        for low, high in pairs:
+            status = rng.choices(statuses, status_weights)[0]
+            sender, receiver = (low, high) if rng.random() < 0.5 else (high, low)
+            # bulk_create skips Invitation.save(), so set the pair key here
+            batch.append(Invitation(sender_id=sender, receiver_id=receiver, status=status,
+                                    user_low_id=low, user_high_id=high))
+            if status == 'accepted':
+                accepted.append((low, high))
+            if len(batch) >= batch_size:
+                Invitation.objects.bulk_create(batch, ignore_conflicts=True)
+                batch = []
+        Invitation.objects.bulk_create(batch, ignore_conflicts=True)
+        return accepted
+
+    def _create_messages(self, rng, users, friendships, count):
+        if not friendships:
+            return 0
+        names = dict(users)
+        # Most traffic goes to a minority of busy conversations
+        activity = [rng.paretovariate(1.2) for _ in friendships]
+
+        sent, reported = 0, 0
+        while sent < count:
+            batch = []
+            while len(batch) < MESSAGE_BATCH and sent + len(batch) < count:
+                # Conversations come in bursts of back-and-forth messages
+                a, b = rng.choices(friendships, activity)[0]
+                for _ in range(min(rng.randint(1, 15), count - sent - len(batch))):
+                    sender, receiver = (a, b) if rng.random() < 0.5 else (b, a)
+                    content = ' '.join(rng.choices(WORDS, k=rng.randint(2, 14)))
+                    batch.append(PendingMessage(names[sender], names[receiver], content))
+            write_messages(batch)
+            sent += len(batch)
+            if sent - reported >= count // 10:
+                self.stdout.write(f"  {sent}/{count} messages")
+                reported = sent
+        return sent
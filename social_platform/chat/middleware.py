@@ -4,25 +4,23 @@ This middleware extracts the token from the WebSocket URL query string
 and authenticates the user.
 """
 
-from channels.db import database_sync_to_async
 from channels.middleware import BaseMiddleware
 from django.contrib.auth.models import AnonymousUser
-from rest_framework.authtoken.models import Token
 from django.conf import settings
 from urllib.parse import parse_qs
+from base.authentication import principal_cache
 
 
-@database_sync_to_async
-def get_user_from_token(token_key):
+async def get_user_from_token(token_key):
     """
     Retrieve user from the auth token.
-    Returns AnonymousUser if token is invalid or not found.
+    Returns AnonymousUser if token is invalid, not found or the user is inactive.
+    Cached tokens are resolved without a thread hop or a query.
     """
-    try:
-        token = Token.objects.get(key=token_key)
-        return token.user
-    except Token.DoesNotExist:
+    principal = await principal_cache.aget(token_key)
+    if principal is None or not principal.is_active:
         return AnonymousUser()
+    return principal.as_user()
 
 
 class TokenAuthMiddleware(BaseMiddleware):
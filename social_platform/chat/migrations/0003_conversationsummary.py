@@ -0,0 +1,57 @@
+# Generated by Django 5.2.9 on 2026-10-17 20:11
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_summaries(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    ConversationSummary = apps.get_model('chat', 'ConversationSummary')
+
+    latest = {}
+    rows = Message.objects.order_by('id').values_list('id', 'sender_id', 'receiver_id', 'content', 'timestamp')
+    for message_id, sender_id, receiver_id, content, timestamp in rows.iterator(chunk_size=2000):
+        latest[(sender_id, receiver_id)] = (message_id, content, timestamp)
+        latest[(receiver_id, sender_id)] = (message_id, content, timestamp)
+
+    ConversationSummary.objects.bulk_create(
+        [
+            ConversationSummary(
+                owner_id=owner_id,
+                counterpart_id=counterpart_id,
+                last_message_id=message_id,
+                last_preview=content[:100],
+                last_activity=timestamp,
+            )
+            for (owner_id, counterpart_id), (message_id, content, timestamp) in latest.items()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_message_pair_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_preview', models.CharField(blank=True, max_length=100)),
+                ('last_activity', models.DateTimeField()),
+                ('counterpart', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('last_message', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_summaries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['owner', '-last_activity'], name='chat_summary_recent_idx')],
+                'constraints': [models.UniqueConstraint(fields=('owner', 'counterpart'), name='chat_summary_owner_counterpart')],
+            },
+        ),
+        migrations.RunPython(backfill_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 5.2.9 on 2026-10-17 20:18
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_sequences(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    ConversationSequence = apps.get_model('chat', 'ConversationSequence')
+
+    last_seq = {}
+    batch = []
+    for message in Message.objects.order_by('id').only('id', 'sender_id', 'receiver_id').iterator(chunk_size=2000):
+        pair = tuple(sorted((message.sender_id, message.receiver_id)))
+        last_seq[pair] = message.seq = last_seq.get(pair, 0) + 1
+        batch.append(message)
+        if len(batch) >= 2000:
+            Message.objects.bulk_update(batch, ['seq'])
+            batch = []
+    Message.objects.bulk_update(batch, ['seq'])
+
+    ConversationSequence.objects.bulk_create(
+        [
+            ConversationSequence(user_low_id=low, user_high_id=high, last_seq=seq)
+            for (low, high), seq in last_seq.items()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_conversationsummary'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_seq', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'receiver', 'seq'], name='chat_msg_pair_seq_idx'),
+        ),
+        migrations.AddField(
+            model_name='conversationsequence',
+            name='user_high',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='conversationsequence',
+            name='user_low',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='conversationsequence',
+            constraint=models.UniqueConstraint(fields=('user_low', 'user_high'), name='chat_sequence_pair'),
+        ),
+        migrations.RunPython(backfill_sequences, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.9 on 2026-10-17 20:31
+
+import re
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def backfill_terms(apps, schema_editor):
+    # Same tokenization as chat.search.tokenize at the time of writing
+    Message = apps.get_model('chat', 'Message')
+    MessageTerm = apps.get_model('chat', 'MessageTerm')
+
+    batch = []
+    for message in Message.objects.order_by('id').only('id', 'sender_id', 'receiver_id', 'content').iterator(chunk_size=2000):
+        low, high = sorted((message.sender_id, message.receiver_id))
+        terms = dict.fromkeys(t[:64] for t in TOKEN_RE.findall(message.content.lower()) if len(t) >= 2)
+        batch.extend(
+            MessageTerm(term=term, user_low_id=low, user_high_id=high, message_id=message.id)
+            for term in terms
+        )
+        if len(batch) >= 5000:
+            MessageTerm.objects.bulk_create(batch)
+            batch = []
+    MessageTerm.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_presence'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.message')),
+                ('user_high', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user_low', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['term', 'user_low', 'message'], name='chat_term_low_idx'), models.Index(fields=['term', 'user_high', 'message'], name='chat_term_high_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_terms, migrations.RunPython.noop),
+    ]
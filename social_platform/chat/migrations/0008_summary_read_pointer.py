@@ -0,0 +1,43 @@
+# Generated by Django 5.2.9 on 2026-10-17 20:37
+
+from django.db import migrations, models
+
+
+def mark_history_read(apps, schema_editor):
+    # Existing conversations start fully read rather than with a badge for all history
+    ConversationSummary = apps.get_model('chat', 'ConversationSummary')
+    ConversationSequence = apps.get_model('chat', 'ConversationSequence')
+
+    last_seq = {
+        (low, high): seq
+        for low, high, seq in ConversationSequence.objects.values_list('user_low_id', 'user_high_id', 'last_seq')
+    }
+    batch = []
+    for summary in ConversationSummary.objects.only('id', 'owner_id', 'counterpart_id').iterator(chunk_size=2000):
+        summary.last_read_seq = last_seq.get(tuple(sorted((summary.owner_id, summary.counterpart_id))), 0)
+        batch.append(summary)
+        if len(batch) >= 2000:
+            ConversationSummary.objects.bulk_update(batch, ['last_read_seq'])
+            batch = []
+    ConversationSummary.objects.bulk_update(batch, ['last_read_seq'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_archivesegment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationsummary',
+            name='last_read_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversationsummary',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(mark_history_read, migrations.RunPython.noop),
+    ]
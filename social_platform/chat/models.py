@@ -1,6 +1,42 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from django.contrib.auth.models import User
 
+
+class ConversationSequence(models.Model):
+    """
+    Last sequence number handed out in a conversation between two users.
+    Stored once per unordered pair as (lower user id, higher user id).
+    """
+    user_low = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    user_high = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    last_seq = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_low', 'user_high'], name='chat_sequence_pair'),
+        ]
+
+    @classmethod
+    def allocate(cls, user_a_id, user_b_id, count=1):
+        """
+        Reserve `count` consecutive sequence numbers in the conversation
+        between two users and return the first one. The row stays locked
+        until the surrounding transaction ends, so numbers are never reused.
+        """
+        low, high = sorted((user_a_id, user_b_id))
+        pair = cls.objects.filter(user_low_id=low, user_high_id=high)
+        with transaction.atomic():
+            if not pair.update(last_seq=F('last_seq') + count):
+                _, created = cls.objects.get_or_create(
+                    user_low_id=low, user_high_id=high, defaults={'last_seq': count}
+                )
+                if not created:
+                    pair.update(last_seq=F('last_seq') + count)
+            last_seq = pair.values_list('last_seq', flat=True).get()
+        return last_seq - count + 1
+
+
 class Message(models.Model):
     sender = models.ForeignKey(
         User, 
@@ -14,9 +50,133 @@ class Message(models.Model):
     )
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
+    # Position in the conversation (see ConversationSequence), used to resume
+    seq = models.PositiveBigIntegerField(null=True, blank=True)
+    # Client-generated id of the send, unique per sender so retries are stored once
+    client_msg_id = models.CharField(max_length=64, null=True, blank=True)
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # History pages: one range scan per direction of the conversation
+            models.Index(fields=['sender', 'receiver', 'id'], name='chat_msg_pair_id_idx'),
+            # Reconnect replay: messages after a sequence number
+            models.Index(fields=['sender', 'receiver', 'seq'], name='chat_msg_pair_seq_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['sender', 'client_msg_id'],
+                condition=models.Q(client_msg_id__isnull=False),
+                name='chat_msg_sender_client_id',
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        # The socket path allocates seq before broadcasting; everything else gets one here
+        if self.seq is None and self._state.adding:
+            self.seq = ConversationSequence.allocate(self.sender_id, self.receiver_id)
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.sender.username} to {self.receiver.username}: {self.content[:20]}"
+
+class ConversationSummary(models.Model):
+    """
+    One row per (owner, counterpart): the inbox entry for a conversation.
+    Maintained incrementally as messages are persisted (see signals.py),
+    so the friends list is a single indexed read sorted by recency.
+    """
+    PREVIEW_LENGTH = 100
+
+    owner = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='conversation_summaries'
+    )
+    counterpart = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    last_message = models.ForeignKey(
+        Message,
+        on_delete=models.SET_NULL,
+        null=True,
+        related_name='+'
+    )
+    last_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True)
+    last_activity = models.DateTimeField()
+    # Owner's read pointer (a conversation seq) and messages from the
+    # counterpart after it; both maintained by signals.py and reads.py
+    last_read_seq = models.PositiveBigIntegerField(default=0)
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'counterpart'], name='chat_summary_owner_counterpart'),
+        ]
+        indexes = [
+            models.Index(fields=['owner', '-last_activity'], name='chat_summary_recent_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.owner.username} <-> {self.counterpart.username}"
+
+
+class Presence(models.Model):
+    """Last time a user's last status socket closed, written in batches by presence.py"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='presence')
+    last_seen = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.user.username} last seen {self.last_seen}"
+
+
+class MessageTerm(models.Model):
+    """
+    Inverted index row: `term` occurs in `message`, in the conversation
+    between user_low and user_high (lower and higher user id). Written by
+    the messages_persisted handler; see search.py.
+    """
+    TERM_LENGTH = 64
+
+    term = models.CharField(max_length=TERM_LENGTH)
+    user_low = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    user_high = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        indexes = [
+            # Either participant's side of a term lookup, newest message first
+            models.Index(fields=['term', 'user_low', 'message'], name='chat_term_low_idx'),
+            models.Index(fields=['term', 'user_high', 'message'], name='chat_term_high_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.term} -> {self.message_id}"
+
+
+class ArchiveSegment(models.Model):
+    """
+    Messages of one conversation in one calendar month, moved out of
+    chat_message by archive.py and stored as zlib-compressed JSON rows.
+    """
+    user_low = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    user_high = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    month = models.DateField()  # First day of the month
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    message_count = models.PositiveIntegerField()
+    data = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_low', 'user_high', 'month'], name='chat_archive_pair_month'),
+        ]
+        indexes = [
+            # History paging walks a conversation's segments by message id
+            models.Index(fields=['user_low', 'user_high', 'last_id'], name='chat_archive_pair_last_idx'),
+        ]
 
     def __str__(self):
-        return f"{self.sender.username} to {self.receiver.username}: {self.content[:20]}"
\ No newline at end of file
+        return f"{self.user_low_id}/{self.user_high_id} {self.month:%Y-%m} ({self.message_count})"
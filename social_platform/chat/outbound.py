@@ -0,0 +1,214 @@
+"""
+Bounded per-connection send queues for the chat and status sockets.
+
+Channel-layer handlers no longer write to the socket themselves: they put
+the frame on the connection's OutboundQueue and return, so the consumer
+keeps draining its channel (which channels_redis caps at `capacity`) even
+while a slow client is still reading. A writer task sends queued frames in
+order.
+
+The queue holds at most MAX_FRAMES. Ephemeral frames (typing, presence,
+read receipts) carry a key and replace a queued frame with the same key
+instead of queueing behind it. When the queue is full, the oldest
+ephemeral frame is dropped first. If only chat and control frames are left,
+OVERFLOW decides:
+
+- 'disconnect' (default): send a `{'type': 'overflow', 'lastSeq': ...}`
+  frame and close with code 4008. The client reconnects with ?since=lastSeq
+  and the resume handshake replays the gap. Before any chat frame was
+  written, lastSeq is the ?since the client connected with (omitted if none).
+- 'drop': drop the oldest queued frame.
+
+Frames that waited longer than DELAY_WARN_MS before being written are
+counted as delayed. A write that fails (the socket went away) is logged and
+closes the queue; later frames are dropped.
+
+channels_redis drops group messages to full channels with only an INFO
+log line. ChannelFullFilter (installed in ChatConfig.ready) counts those
+drops and raises the line to WARNING.
+"""
+
+import asyncio
+import logging
+import re
+import time
+from collections import deque
+
+from django.conf import settings
+
+from core.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'MAX_FRAMES': 256,
+    'OVERFLOW': 'disconnect',
+    'DELAY_WARN_MS': 1000,
+}
+
+# Frame kinds
+CHAT = 'chat'
+CONTROL = 'control'
+TYPING = 'typing'
+PRESENCE = 'presence'
+RECEIPT = 'receipt'
+EPHEMERAL = frozenset({TYPING, PRESENCE, RECEIPT})
+
+OVERFLOW_CLOSE_CODE = 4008
+
+FRAMES_DROPPED = registry.counter('ws_outbound_dropped_total', 'Outbound frames dropped by a full send queue')
+FRAMES_COALESCED = registry.counter('ws_outbound_coalesced_total', 'Outbound frames replaced by a newer one with the same key')
+FRAMES_DELAYED = registry.counter('ws_outbound_delayed_total', 'Outbound frames that waited longer than DELAY_WARN_MS')
+OVERFLOW_DISCONNECTS = registry.counter('ws_outbound_overflow_disconnects_total', 'Connections closed because their send queue overflowed')
+QUEUE_WAIT = registry.histogram('ws_outbound_wait_ms', 'Time a frame spent in the send queue')
+CHANNEL_FULL = registry.counter('channel_layer_full_total', 'Channel-layer messages dropped because the channel was full')
+
+
+class _Entry:
+    __slots__ = ('frame', 'kind', 'key', 'seq', 'queued_at')
+
+    def __init__(self, frame, kind, key, seq):
+        self.frame = frame
+        self.kind = kind
+        self.key = key
+        self.seq = seq
+        self.queued_at = time.monotonic()
+
+
+class OutboundQueue:
+    """
+    `send(frame)` is the coroutine that writes one encoded frame to the
+    socket; `on_overflow(last_seq)` is called once if the queue overflows
+    under the 'disconnect' policy.
+    """
+
+    def __init__(self, send, on_overflow, max_frames, overflow, delay_warn_ms):
+        self._send = send
+        self._on_overflow = on_overflow
+        self.max_frames = max_frames
+        self.overflow = overflow
+        self.delay_warn_ms = delay_warn_ms
+        self.last_seq = None  # Highest chat seq actually written
+        self._queue = deque()
+        self._keyed = {}  # key -> queued ephemeral entry
+        self._ready = asyncio.Event()
+        self._task = None
+        self._closed = False
+
+    @classmethod
+    def from_settings(cls, send, on_overflow):
+        conf = {**DEFAULTS, **getattr(settings, 'CHAT_OUTBOUND', {})}
+        return cls(send, on_overflow, conf['MAX_FRAMES'], conf['OVERFLOW'], conf['DELAY_WARN_MS'])
+
+    def __len__(self):
+        return len(self._queue)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def put(self, frame, kind=CONTROL, key=None, seq=None):
+        """Queue an encoded frame. Returns False if it was dropped."""
+        if self._closed:
+            return False
+
+        if key is not None:
+            queued = self._keyed.get((kind, key))
+            if queued is not None:
+                queued.frame = frame
+                FRAMES_COALESCED.inc()
+                return True
+
+        if len(self._queue) >= self.max_frames and not self._make_room(kind):
+            return False
+
+        entry = _Entry(frame, kind, key, seq)
+        self._queue.append(entry)
+        if key is not None:
+            self._keyed[(kind, key)] = entry
+        self._ready.set()
+        return True
+
+    def _make_room(self, kind):
+        for entry in self._queue:
+            if entry.kind in EPHEMERAL:
+                self._remove(entry)
+                FRAMES_DROPPED.inc()
+                return True
+
+        if kind in EPHEMERAL:
+            FRAMES_DROPPED.inc()
+            return False
+
+        if self.overflow == 'drop':
+            self._remove(self._queue[0])
+            FRAMES_DROPPED.inc()
+            return True
+
+        # 'disconnect': the client resumes from the last seq it was sent
+        FRAMES_DROPPED.inc(len(self._queue) + 1)
+        OVERFLOW_DISCONNECTS.inc()
+        self._closed = True
+        self._queue.clear()
+        self._keyed.clear()
+        asyncio.get_running_loop().create_task(self._on_overflow(self.last_seq))
+        return False
+
+    def _remove(self, entry):
+        self._queue.remove(entry)
+        if entry.key is not None:
+            self._keyed.pop((entry.kind, entry.key), None)
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            while self._queue:
+                entry = self._queue.popleft()
+                if entry.key is not None:
+                    self._keyed.pop((entry.kind, entry.key), None)
+                waited_ms = (time.monotonic() - entry.queued_at) * 1000
+                QUEUE_WAIT.observe(waited_ms)
+                if waited_ms > self.delay_warn_ms:
+                    FRAMES_DELAYED.inc()
+                try:
+                    await self._send(entry.frame)
+                except Exception:
+                    logger.warning("Send failed, closing the outbound queue", exc_info=True)
+                    FRAMES_DROPPED.inc(len(self._queue) + 1)
+                    self._closed = True
+                    self._queue.clear()
+                    self._keyed.clear()
+                    return
+                if entry.seq is not None:
+                    self.last_seq = entry.seq
+
+    async def close(self):
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class ChannelFullFilter(logging.Filter):
+    """Counts channels_redis 'over capacity' drops and logs them as warnings."""
+
+    pattern = re.compile(r'channels over capacity')
+
+    def filter(self, record):
+        if self.pattern.search(record.msg if isinstance(record.msg, str) else ''):
+            CHANNEL_FULL.inc(record.args[0] if record.args else 1)
+            record.levelno, record.levelname = logging.WARNING, 'WARNING'
+        return True
+
+
+def install_channel_full_filter():
+    redis_logger = logging.getLogger('channels_redis.core')
+    if not any(isinstance(f, ChannelFullFilter) for f in redis_logger.filters):
+        redis_logger.addFilter(ChannelFullFilter())
+    # The drop is logged at INFO; make sure the record is created at all
+    if redis_logger.getEffectiveLevel() > logging.INFO:
+        redis_logger.setLevel(logging.INFO)
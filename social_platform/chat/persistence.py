@@ -0,0 +1,345 @@
+"""
+Write-behind persistence for chat messages.
+
+ChatConsumer broadcasts a message first and then hands it to a single
+per-process queue instead of spawning one DB task per message. A background
+task drains the queue and writes each batch with one bulk_create, either when
+BATCH_SIZE messages are waiting or FLUSH_INTERVAL seconds after the first one
+arrived. The queue is bounded by MAX_PENDING: once full, put() waits, which
+slows down reads from the sending socket instead of piling up tasks.
+
+The messages of a batch were already broadcast and acked, so a failed write
+is retried up to RETRIES times, RETRY_BACKOFF seconds apart and doubling,
+before the batch is counted as lost. The worker waits meanwhile, so a short
+database outage backs up into the queue rather than dropping messages.
+"""
+
+import asyncio
+import atexit
+import logging
+import time
+from dataclasses import dataclass
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from base.identity import identity_cache
+from core.metrics import registry
+
+from .models import ConversationSequence, Message
+from .reads import read_pointers
+from .signals import messages_persisted
+
+logger = logging.getLogger(__name__)
+
+FLUSH_LATENCY = registry.histogram('chat_db_flush_ms', 'Time to write one batch of chat messages')
+MESSAGES_PERSISTED = registry.counter('chat_messages_persisted_total', 'Chat messages written to the database')
+DUPLICATES_DROPPED = registry.counter('chat_messages_duplicate_total', 'Retried messages not stored again (same sender and clientMsgId)')
+PERSIST_FAILURES = registry.counter('chat_messages_persist_failed_total', 'Chat messages lost to failed batch writes')
+
+DEFAULTS = {
+    'BATCH_SIZE': 100,
+    'FLUSH_INTERVAL': 0.05,
+    'MAX_PENDING': 5000,
+    'RETRIES': 3,
+    'RETRY_BACKOFF': 0.1,  # seconds before the first retry
+}
+
+
+@dataclass
+class PendingMessage:
+    sender: str
+    receiver: str
+    content: str
+    seq: int = None
+    client_msg_id: str = None
+
+
+def write_messages(batch):
+    """
+    Persist a batch of PendingMessage objects.
+    Costs one INSERT for the whole batch, plus one query to resolve any
+    usernames not already in the identity cache, plus whatever the
+    messages_persisted handlers do in the same transaction, plus one query
+    if any message has a client_msg_id.
+    Messages whose sender or receiver no longer exists are dropped, and so
+    are messages whose (sender, client_msg_id) is already stored.
+    """
+    users = identity_cache.resolve_usernames(
+        [p.sender for p in batch] + [p.receiver for p in batch]
+    )
+
+    messages = []
+    for pending in batch:
+        sender = users.get(pending.sender)
+        receiver = users.get(pending.receiver)
+        if sender is None or receiver is None:
+            logger.warning("Dropping message %s -> %s: unknown user", pending.sender, pending.receiver)
+            continue
+        messages.append(Message(
+            sender_id=sender.id, receiver_id=receiver.id, content=pending.content, seq=pending.seq,
+            client_msg_id=pending.client_msg_id or None,
+        ))
+
+    messages = _drop_duplicates(messages)
+    if not messages:
+        return []
+
+    # Messages that did not come through the socket path have no seq yet
+    unsequenced = {}
+    for message in messages:
+        if message.seq is None:
+            pair = tuple(sorted((message.sender_id, message.receiver_id)))
+            unsequenced.setdefault(pair, []).append(message)
+
+    with transaction.atomic():
+        for pair, group in unsequenced.items():
+            first_seq = ConversationSequence.allocate(*pair, count=len(group))
+            for offset, message in enumerate(group):
+                message.seq = first_seq + offset
+        if any(message.client_msg_id is not None for message in messages):
+            try:
+                with transaction.atomic():
+                    created = Message.objects.bulk_create(messages)
+            except IntegrityError:
+                # Another process stored one of the retries since we checked
+                created = Message.objects.bulk_create(_drop_duplicates(messages))
+        else:
+            created = Message.objects.bulk_create(messages)
+        if created:
+            messages_persisted.send(sender=Message, messages=created)
+    return created
+
+
+def _drop_duplicates(messages):
+    """Messages without a stored or earlier (sender, client_msg_id)."""
+    keyed = [m for m in messages if m.client_msg_id is not None]
+    if not keyed:
+        return messages
+    seen = set(
+        Message.objects.filter(
+            sender_id__in={m.sender_id for m in keyed},
+            client_msg_id__in={m.client_msg_id for m in keyed},
+        ).values_list('sender_id', 'client_msg_id')
+    )
+    unique = []
+    for message in messages:
+        if message.client_msg_id is not None:
+            key = (message.sender_id, message.client_msg_id)
+            if key in seen:
+                DUPLICATES_DROPPED.inc()
+                continue
+            seen.add(key)
+        unique.append(message)
+    return unique
+
+
+class MessageWriteQueue:
+    """
+    Bounded queue of messages waiting to be written, flushed in batches.
+    Must be used from a single event loop (one per daphne process).
+    """
+
+    def __init__(self, batch_size, flush_interval, max_pending, retries=0, retry_backoff=0.1):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+
+        # Created lazily so they bind to the running loop, not the import-time one
+        self._loop = None
+        self._queue = None
+        self._batch_ready = None
+        self._worker = None
+        self._draining = 0
+        # Messages queued and written (or given up on) since start; the queue is
+        # FIFO, so drain() waits until `_done` reaches the `_queued` it saw
+        self._queued = 0
+        self._done = 0
+        self._drain_waiters = []  # (target, future)
+
+        # Stats
+        self.flushes = 0
+        self.flushed = 0
+        self.failed = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    @classmethod
+    def from_settings(cls):
+        conf = {**DEFAULTS, **getattr(settings, 'CHAT_PERSISTENCE', {})}
+        return cls(conf['BATCH_SIZE'], conf['FLUSH_INTERVAL'], conf['MAX_PENDING'],
+                   conf['RETRIES'], conf['RETRY_BACKOFF'])
+
+    @property
+    def depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'max_pending': self.max_pending,
+            'flushes': self.flushes,
+            'flushed': self.flushed,
+            'failed': self.failed,
+            'last_flush_ms': round(self.last_flush_ms, 2),
+            'max_flush_ms': round(self.max_flush_ms, 2),
+        }
+
+    def _ensure_worker(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # First use, or a new event loop (tests, server restart in-process):
+            # rebind to it, carrying over anything still queued
+            leftover = []
+            while self._queue is not None and not self._queue.empty():
+                leftover.append(self._queue.get_nowait())
+            self._loop = loop
+            self._queue = asyncio.Queue(maxsize=max(self.max_pending, len(leftover)))
+            self._batch_ready = asyncio.Event()
+            self._worker = None
+            self._drain_waiters = []  # Futures of the old loop
+            self._queued = self._done + len(leftover)  # A batch the old worker held is gone
+            for pending in leftover:
+                self._queue.put_nowait(pending)
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._run())
+
+    async def put(self, sender, receiver, content):
+        """Queue a message for persistence, waiting for room if the queue is full."""
+        self._ensure_worker()
+        await self._queue.put(PendingMessage(sender, receiver, content))
+        self._queued += 1
+        if self._queue.qsize() >= self.batch_size:
+            self._batch_ready.set()
+
+    async def put_many(self, pending_messages):
+        """Queue several PendingMessage objects, e.g. from one batched client frame."""
+        self._ensure_worker()
+        for pending in pending_messages:
+            await self._queue.put(pending)
+            self._queued += 1
+        if self._queue.qsize() >= self.batch_size:
+            self._batch_ready.set()
+
+    async def drain(self):
+        """
+        Flush everything queued so far and wait until it is written. Messages
+        queued after the call are not waited for, so a busy process cannot keep
+        the caller blocked.
+        """
+        if self._queue is None or self._done >= self._queued:
+            return
+        self._ensure_worker()
+        waiter = self._loop.create_future()
+        self._drain_waiters.append((self._queued, waiter))
+        self._draining += 1
+        try:
+            self._batch_ready.set()
+            await waiter
+        finally:
+            self._draining -= 1
+
+    def _wake_drain_waiters(self):
+        waiting = []
+        for target, waiter in self._drain_waiters:
+            if target <= self._done:
+                if not waiter.done():
+                    waiter.set_result(None)
+            else:
+                waiting.append((target, waiter))
+        self._drain_waiters = waiting
+
+    async def close(self):
+        """Drain the queue and stop the background worker."""
+        await self.drain()
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        self._loop = self._queue = self._batch_ready = self._worker = None
+
+    def drain_sync(self):
+        """
+        Write whatever is still queued from outside the event loop.
+        Registered with atexit so a stopped server does not lose messages.
+        """
+        if self._queue is None:
+            return
+        batch = []
+        while not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        if batch:
+            write_messages(batch)
+            logger.info("Flushed %d queued messages on shutdown", len(batch))
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+
+            # Time trigger: give the batch FLUSH_INTERVAL to fill up,
+            # unless put() signals it is full or drain() is waiting on it
+            self._batch_ready.clear()
+            if not self._draining and self._queue.qsize() + 1 < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        t_start = time.perf_counter()
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    await database_sync_to_async(write_messages)(batch)
+                except Exception:
+                    if attempt == self.retries:
+                        raise
+                    logger.warning("Failed to persist %d messages, retrying", len(batch), exc_info=True)
+                    await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+                else:
+                    break
+            self.flushed += len(batch)
+            MESSAGES_PERSISTED.inc(len(batch))
+        except Exception:
+            self.failed += len(batch)
+            PERSIST_FAILURES.inc(len(batch))
+            logger.exception("Failed to persist %d messages", len(batch))
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+            self._done += len(batch)
+            self._wake_drain_waiters()
+
+        self.flushes += 1
+        self.last_flush_ms = (time.perf_counter() - t_start) * 1000
+        self.max_flush_ms = max(self.max_flush_ms, self.last_flush_ms)
+        FLUSH_LATENCY.observe(self.last_flush_ms)
+        logger.debug("Flushed %d messages in %.1fms (depth %d)", len(batch), self.last_flush_ms, self.depth)
+
+
+message_queue = MessageWriteQueue.from_settings()
+atexit.register(message_queue.drain_sync)
+registry.gauge('chat_persist_queue_depth', 'Chat messages waiting to be written', fn=lambda: message_queue.depth)
+
+
+async def lifespan(scope, receive, send):
+    """ASGI lifespan handler: drains the queue and read pointers on shutdown for servers that support it."""
+    while True:
+        event = await receive()
+        if event['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif event['type'] == 'lifespan.shutdown':
+            await message_queue.close()
+            await read_pointers.flush()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
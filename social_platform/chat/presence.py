@@ -0,0 +1,142 @@
+"""
+Friend-scoped presence for StatusConsumer.
+
+Every status socket joins its user's own `presence_<user id>` group. The
+registry ref-counts sockets per user, so a second tab does not announce
+"online" again and closing one of two tabs does not announce "offline".
+Transitions are collected for BATCH_WINDOW seconds (an online/offline flap
+inside the window cancels out), then published only to the user's accepted
+friends, with one group_send per friend carrying all of that friend's
+updates. Users that went offline get their last_seen written in the same
+batch.
+
+Ref counts are per process: with several daphne workers a user whose tabs
+landed on different workers is tracked by each of them separately.
+"""
+
+import asyncio
+import logging
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils import timezone
+
+from base.friends import friend_graph
+from base.identity import identity_cache
+from core.metrics import registry
+
+from .codec import encode_frames
+from .models import Presence
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'BATCH_WINDOW': 0.5,
+}
+
+ONLINE = 'online'
+OFFLINE = 'offline'
+
+PRESENCE_TRANSITIONS = registry.counter('chat_presence_transitions_total', 'Presence changes published to friends')
+PRESENCE_SENDS = registry.counter('chat_presence_group_sends_total', 'Channel-layer sends for presence batches')
+
+
+def presence_group(user_id):
+    return f'presence_{user_id}'
+
+
+async def friend_identities(user_id):
+    """UserIdentity of every accepted friend of `user_id`."""
+    return list((await identity_cache.aresolve_ids(await friend_graph.afriends_of(user_id))).values())
+
+
+def _record_batch(changes):
+    """Resolve friends for the changed users and write last_seen for those now offline."""
+    offline = [user_id for user_id, (_, status) in changes.items() if status == OFFLINE]
+    if offline:
+        now = timezone.now()
+        Presence.objects.bulk_create(
+            [Presence(user_id=user_id, last_seen=now) for user_id in offline],
+            update_conflicts=True,
+            unique_fields=['user'],
+            update_fields=['last_seen'],
+        )
+    return friend_graph.friends_of_many(list(changes))
+
+
+class PresenceRegistry:
+    def __init__(self, window):
+        self.window = window
+        self._connections = {}  # user id -> open status sockets in this process
+        self._published = {}    # user id -> last status sent to friends
+        self._pending = {}      # user id -> (username, status) waiting for the next flush
+        self._flush_handle = None
+
+    @classmethod
+    def from_settings(cls):
+        conf = {**DEFAULTS, **getattr(settings, 'PRESENCE', {})}
+        return cls(conf['BATCH_WINDOW'])
+
+    def is_online(self, user_id):
+        return self._connections.get(user_id, 0) > 0
+
+    def connect(self, identity):
+        count = self._connections.get(identity.id, 0) + 1
+        self._connections[identity.id] = count
+        if count == 1:
+            self._transition(identity, ONLINE)
+
+    def disconnect(self, identity):
+        count = self._connections.get(identity.id, 0) - 1
+        if count > 0:
+            self._connections[identity.id] = count
+            return
+        self._connections.pop(identity.id, None)
+        self._transition(identity, OFFLINE)
+
+    def _transition(self, identity, status):
+        if self._published.get(identity.id, OFFLINE) == status:
+            # Flapped back within the window: nothing to tell anyone
+            self._pending.pop(identity.id, None)
+        else:
+            self._pending[identity.id] = (identity.username, status)
+
+        if self._pending and self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self.window, lambda: loop.create_task(self.flush()))
+
+    async def flush(self):
+        self._flush_handle = None
+        changes, self._pending = self._pending, {}
+        if not changes:
+            return
+
+        try:
+            friends = await database_sync_to_async(_record_batch)(changes)
+        except Exception:
+            logger.exception("Failed to publish %d presence changes", len(changes))
+            return
+
+        # Group updates by recipient so each friend gets one send per window
+        updates = {}
+        for user_id, (username, status) in changes.items():
+            if status == ONLINE:
+                self._published[user_id] = status
+            else:
+                self._published.pop(user_id, None)
+            frame = {'k': username, **encode_frames({'user': username, 'status': status})}
+            for friend_id in friends.get(user_id, ()):
+                updates.setdefault(friend_id, []).append(frame)
+        PRESENCE_TRANSITIONS.inc(len(changes))
+
+        channel_layer = get_channel_layer()
+        for friend_id, frames in updates.items():
+            await channel_layer.group_send(
+                presence_group(friend_id),
+                {'type': 'status_batch', 'updates': frames}
+            )
+        PRESENCE_SENDS.inc(len(updates))
+
+
+presence_registry = PresenceRegistry.from_settings()
@@ -0,0 +1,150 @@
+"""
+Token-bucket rate limits for ChatConsumer.
+
+Each event kind (chat, typing, read) has its own bucket per connection and
+per user. An event passes only if both buckets have a token; the per-user
+bucket is shared by all of that user's sockets on this worker, so opening
+more tabs does not buy more throughput. Anonymous sockets only have the
+per-connection buckets.
+
+Limits are `(rate per second, burst)` pairs in CHAT_RATE_LIMITS. A kind
+with no limit (None) is never throttled; a rate must be positive, so a kind
+cannot be blocked outright.
+
+ChatConsumer checks `exhausted()` before decoding a frame, so a client that
+keeps sending after every bucket ran dry is turned away without parsing,
+and `allow()` per event before any sequence allocation or group_send.
+"""
+
+import time
+
+from django.conf import settings
+
+from base.cache import TTLCache
+from core.metrics import registry
+
+CHAT = 'chat'
+TYPING = 'typing'
+READ = 'read'
+KINDS = (CHAT, TYPING, READ)
+
+DEFAULTS = {
+    # Bursts leave room for a reconnecting client flushing its outbox in one batch
+    'CONNECTION': {CHAT: (10, 50), TYPING: (5, 10), READ: (10, 30)},
+    'USER': {CHAT: (20, 100), TYPING: (10, 20), READ: (20, 60)},
+    'MAX_USERS': 10000,
+}
+
+THROTTLED = {
+    kind: registry.counter(f'chat_throttled_{kind}_total', f'{kind.capitalize()} events rejected by a rate limit')
+    for kind in KINDS
+}
+FRAMES_THROTTLED = registry.counter(
+    'chat_throttled_frames_total', 'Frames rejected undecoded because every bucket of the connection was empty'
+)
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        if rate <= 0 or burst < 1:
+            raise ValueError(f"Token bucket needs a positive rate and a burst of at least 1, got ({rate}, {burst})")
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, now=None):
+        self._refill(time.monotonic() if now is None else now)
+        return self.tokens >= 1
+
+    def take(self, now=None):
+        if not self.available(now):
+            return False
+        self.tokens -= 1
+        return True
+
+    def retry_after(self):
+        """Seconds until the next token."""
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+def rate_limit_settings():
+    conf = {**DEFAULTS, **getattr(settings, 'CHAT_RATE_LIMITS', {})}
+    limits = {
+        'CONNECTION': {**DEFAULTS['CONNECTION'], **conf['CONNECTION']},
+        'USER': {**DEFAULTS['USER'], **conf['USER']},
+        'MAX_USERS': conf['MAX_USERS'],
+    }
+    # Fail at startup rather than in the first connect()
+    for scope in ('CONNECTION', 'USER'):
+        for kind, limit in limits[scope].items():
+            if limit is not None:
+                TokenBucket(*limit)
+    return limits
+
+
+class UserBuckets:
+    """Per-user buckets shared by the connections of this process."""
+
+    def __init__(self, max_users):
+        # A bucket idle for a minute is full again, so expiring it loses nothing
+        self._buckets = TTLCache(max_users, ttl=60)
+
+    def get(self, user_id, kind, limit):
+        key = (user_id, kind)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(*limit)
+        self._buckets.set(key, bucket)  # Refreshes the expiry while in use
+        return bucket
+
+    def clear(self):
+        self._buckets.clear()
+
+
+user_buckets = UserBuckets(rate_limit_settings()['MAX_USERS'])
+
+
+class ConnectionLimiter:
+    def __init__(self, user_id=None, limits=None):
+        limits = limits or rate_limit_settings()
+        self.user_id = user_id
+        self._user_limits = limits['USER']
+        self._buckets = {
+            kind: TokenBucket(*limit) for kind, limit in limits['CONNECTION'].items() if limit is not None
+        }
+
+    def exhausted(self):
+        """True if no kind has a connection token left (and every kind is limited)."""
+        if len(self._buckets) < len(KINDS):
+            return False
+        now = time.monotonic()
+        if any(bucket.available(now) for bucket in self._buckets.values()):
+            return False
+        FRAMES_THROTTLED.inc()
+        return True
+
+    def allow(self, kind):
+        """
+        Take a token for one event of `kind`. Returns None if allowed, else
+        the seconds until the event would have been allowed.
+        """
+        now = time.monotonic()
+        buckets = [self._buckets[kind]] if kind in self._buckets else []
+        limit = self._user_limits.get(kind)
+        if self.user_id is not None and limit is not None:
+            buckets.append(user_buckets.get(self.user_id, kind, limit))
+
+        blocked = [bucket for bucket in buckets if not bucket.available(now)]
+        if blocked:
+            THROTTLED[kind].inc()
+            return max(bucket.retry_after() for bucket in blocked)
+        for bucket in buckets:
+            bucket.take(now)
+        return None
@@ -0,0 +1,109 @@
+"""
+Persisted read pointers for ChatConsumer's read_receipt frames.
+
+A read pointer is the conversation seq (see sequences.py) up to which the
+owner has read; ConversationSummary stores it with the owner's unread
+count, which signals.py increments as messages are persisted. Receipts are
+sent on nearly every scroll, so `read_pointers` coalesces them in memory
+(latest pointer per owner and conversation) and writes them every
+FLUSH_INTERVAL seconds in one transaction. Pointers only move forward.
+
+A receipt without a seq means "read everything": the pointer jumps to the
+conversation's last reserved seq and the count resets without touching
+chat_message. Only a receipt for an older seq counts the messages after it.
+"""
+
+import asyncio
+import logging
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+from core.metrics import registry
+
+from .models import ConversationSequence, ConversationSummary, Message
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'FLUSH_INTERVAL': 1.0,
+}
+
+READ_RECEIPTS = registry.counter('chat_read_receipts_total', 'Read receipts received')
+READ_POINTER_WRITES = registry.counter('chat_read_pointer_writes_total', 'Read pointers written after coalescing')
+
+
+def apply_read_pointers(pointers):
+    """
+    Write {(owner_id, counterpart_id): seq or None} to ConversationSummary.
+    Returns {(owner_id, counterpart_id): (last_read_seq, unread_count)}.
+    """
+    results = {}
+    with transaction.atomic():
+        for (owner_id, counterpart_id), seq in pointers.items():
+            low, high = sorted((owner_id, counterpart_id))
+            latest = ConversationSequence.objects.filter(
+                user_low_id=low, user_high_id=high
+            ).values_list('last_seq', flat=True).first() or 0
+            target = latest if seq is None else min(seq, latest)
+
+            if target >= latest:
+                unread = 0
+            else:
+                unread = Message.objects.filter(
+                    sender_id=counterpart_id, receiver_id=owner_id, seq__gt=target
+                ).count()
+            ConversationSummary.objects.filter(
+                owner_id=owner_id, counterpart_id=counterpart_id, last_read_seq__lt=target
+            ).update(last_read_seq=target, unread_count=unread)
+            results[(owner_id, counterpart_id)] = (target, unread)
+    READ_POINTER_WRITES.inc(len(pointers))
+    return results
+
+
+async def unread_state(owner_id, counterpart_id):
+    """(last_read_seq, unread_count) of the owner's side of a conversation."""
+    return await ConversationSummary.objects.filter(
+        owner_id=owner_id, counterpart_id=counterpart_id
+    ).values_list('last_read_seq', 'unread_count').afirst() or (0, 0)
+
+
+class ReadPointerQueue:
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self._pending = {}  # (owner id, counterpart id) -> seq, or None for "everything"
+        self._flush_handle = None
+
+    @classmethod
+    def from_settings(cls):
+        conf = {**DEFAULTS, **getattr(settings, 'CHAT_READS', {})}
+        return cls(conf['FLUSH_INTERVAL'])
+
+    def mark_read(self, owner_id, counterpart_id, seq=None):
+        READ_RECEIPTS.inc()
+        key = (owner_id, counterpart_id)
+        if key in self._pending:
+            current = self._pending[key]
+            seq = None if current is None or seq is None else max(current, seq)
+        self._pending[key] = seq
+
+        if self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self.flush_interval, lambda: loop.create_task(self.flush()))
+
+    async def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pointers, self._pending = self._pending, {}
+        if not pointers:
+            return {}
+        try:
+            return await database_sync_to_async(apply_read_pointers)(pointers)
+        except Exception:
+            logger.exception("Failed to write %d read pointers", len(pointers))
+            return {}
+
+
+read_pointers = ReadPointerQueue.from_settings()
@@ -0,0 +1,103 @@
+"""
+Keyword search over a user's message history.
+
+Every persisted message is tokenized (lowercased word characters, at least
+MIN_TERM_LENGTH long, deduplicated) and one MessageTerm row per token is
+written in the same transaction by the messages_persisted handler in
+signals.py. A query is answered from MessageTerm alone: rows for the query
+terms in the user's conversations are grouped by message and only messages
+containing every term are kept, newest first, keyset-paged by message id.
+The message rows themselves are fetched afterwards for just one page.
+
+Only plain indexed lookups and GROUP BY are used, so it behaves the same on
+SQLite and PostgreSQL.
+"""
+
+import re
+
+from django.db.models import Count, Q
+
+from base.identity import identity_cache
+
+from .models import Message, MessageTerm
+
+MIN_TERM_LENGTH = 2
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """Distinct index terms in `text`, in order of first occurrence."""
+    terms = {}
+    for token in TOKEN_RE.findall(text.lower()):
+        if len(token) >= MIN_TERM_LENGTH:
+            terms.setdefault(token[:MessageTerm.TERM_LENGTH], None)
+    return list(terms)
+
+
+def index_messages(messages):
+    """Write the MessageTerm rows for freshly saved messages."""
+    rows = []
+    for message in messages:
+        low, high = sorted((message.sender_id, message.receiver_id))
+        rows.extend(
+            MessageTerm(term=term, user_low_id=low, user_high_id=high, message_id=message.id)
+            for term in tokenize(message.content)
+        )
+    MessageTerm.objects.bulk_create(rows, batch_size=1000)
+
+
+def search_messages(user_id, query, counterpart_id=None, before=None, limit=20, max_terms=8):
+    """
+    Messages of `user_id` containing every term of `query`, newest first.
+    Returns (rows, has_more); rows are dicts with id, sender_id, receiver_id,
+    content and timestamp.
+    """
+    terms = tokenize(query)[:max_terms]
+    if not terms:
+        return [], False
+
+    postings = MessageTerm.objects.filter(term__in=terms)
+    if counterpart_id is not None:
+        low, high = sorted((user_id, counterpart_id))
+        postings = postings.filter(user_low_id=low, user_high_id=high)
+    else:
+        postings = postings.filter(Q(user_low_id=user_id) | Q(user_high_id=user_id))
+    if before is not None:
+        postings = postings.filter(message_id__lt=before)
+
+    # Tokens are distinct per message, so a full match has one row per term
+    message_ids = list(
+        postings.values('message_id')
+        .annotate(matched=Count('id'))
+        .filter(matched=len(terms))
+        .order_by('-message_id')
+        .values_list('message_id', flat=True)[:limit + 1]
+    )
+    has_more = len(message_ids) > limit
+    message_ids = message_ids[:limit]
+
+    rows = Message.objects.filter(id__in=message_ids).values(
+        'id', 'sender_id', 'receiver_id', 'content', 'timestamp'
+    )
+    return sorted(rows, key=lambda m: m['id'], reverse=True), has_more
+
+
+def serialize_results(rows, user_id):
+    """Shape search rows for the API, naming the other participant of each message."""
+    users = identity_cache.resolve_ids(
+        user for m in rows for user in (m['sender_id'], m['receiver_id'])
+    )
+    data = []
+    for m in rows:
+        counterpart_id = m['receiver_id'] if m['sender_id'] == user_id else m['sender_id']
+        if m['sender_id'] not in users or counterpart_id not in users:
+            continue
+        data.append({
+            "id": m['id'],
+            "sender_username": users[m['sender_id']].username,
+            "conversation_with": users[counterpart_id].username,
+            "content": m['content'],
+            "timestamp": m['timestamp'].isoformat(),
+        })
+    return data
@@ -0,0 +1,82 @@
+"""
+Per-conversation sequence numbers for the socket path.
+
+ChatConsumer reserves sequence numbers before it broadcasts, so the number a
+client sees live is the one the message is later persisted with. On
+reconnect the client passes the last number it saw (?since=<seq>) and the
+consumer replays only the messages after it before going live.
+"""
+
+from django.db.models import Q
+
+from base.identity import identity_cache
+
+from .models import ConversationSequence, Message
+
+
+def allocate_for_usernames(pair_counts):
+    """
+    Reserve sequence numbers for several conversations at once.
+    `pair_counts` maps (sender_username, receiver_username) -> how many
+    messages; returns the same keys mapped to the first reserved number
+    (None if either user does not exist).
+    """
+    users = identity_cache.resolve_usernames(
+        [name for pair in pair_counts for name in pair]
+    )
+    first_seqs = {}
+    for (sender, receiver), count in pair_counts.items():
+        if sender in users and receiver in users:
+            first_seqs[(sender, receiver)] = ConversationSequence.allocate(
+                users[sender].id, users[receiver].id, count
+            )
+        else:
+            first_seqs[(sender, receiver)] = None
+    return first_seqs
+
+
+async def messages_after(username_a, username_b, since, limit):
+    """
+    Messages in the conversation with seq > since, oldest first, as
+    client frames. Returns (frames, truncated, last reserved seq).
+    """
+    users = await identity_cache.aresolve_usernames([username_a, username_b])
+    if username_a not in users or username_b not in users:
+        return [], False, since
+    a, b = users[username_a], users[username_b]
+    names = {a.id: a.username, b.id: b.username}
+    low, high = sorted((a.id, b.id))
+    last_reserved = await ConversationSequence.objects.filter(
+        user_low_id=low, user_high_id=high
+    ).values_list('last_seq', flat=True).afirst() or 0
+
+    rows = [
+        row async for row in Message.objects.filter(
+            Q(sender_id=a.id, receiver_id=b.id) | Q(sender_id=b.id, receiver_id=a.id),
+            seq__gt=since,
+        ).order_by('seq').values_list('seq', 'sender_id', 'content', 'timestamp')[:limit + 1]
+    ]
+    frames = [
+        {
+            'message': content,
+            'sender': names[sender_id],
+            'timestamp': int(timestamp.timestamp() * 1000),
+            'seq': seq,
+        }
+        for seq, sender_id, content, timestamp in rows[:limit]
+    ]
+    return frames, len(rows) > limit, last_reserved
+
+
+def seq_gaps(frames, since, last_reserved):
+    """
+    Reserved seqs after `since` missing from the replayed frames, as
+    [first, last] ranges: messages another worker has broadcast but not
+    written yet (or sends that were dropped as duplicates). With no frames
+    at all, that is everything from since + 1 to last_reserved.
+    """
+    seqs = [since] + [frame['seq'] for frame in frames]
+    gaps = [[prev + 1, seq - 1] for prev, seq in zip(seqs, seqs[1:]) if seq > prev + 1]
+    if last_reserved > seqs[-1]:
+        gaps.append([seqs[-1] + 1, last_reserved])
+    return gaps
@@ -0,0 +1,82 @@
+"""
+Chat signals and the handlers that keep derived tables in sync with Message.
+
+`messages_persisted` fires once per write with every new Message, whether it
+came from the write-behind queue (bulk_create, which sends no post_save) or
+from a plain Message.objects.create(). Handlers run inside the transaction
+that inserted the messages.
+"""
+
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.signals import post_save
+from django.dispatch import Signal, receiver
+
+from .models import ConversationSummary, Message
+from .search import index_messages
+
+# Sent with messages=[Message, ...] (saved, with ids)
+messages_persisted = Signal()
+
+
+@receiver(post_save, sender=Message)
+def announce_saved_message(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        messages_persisted.send(sender=Message, messages=[instance])
+
+
+@receiver(messages_persisted)
+def update_conversation_summaries(sender, messages, **kwargs):
+    # Latest message per (owner, counterpart), for both participants
+    latest = {}
+    for message in messages:
+        for owner_id, counterpart_id in (
+            (message.sender_id, message.receiver_id),
+            (message.receiver_id, message.sender_id),
+        ):
+            current = latest.get((owner_id, counterpart_id))
+            if current is None or message.id > current.id:
+                latest[(owner_id, counterpart_id)] = message
+
+    ConversationSummary.objects.bulk_create(
+        [
+            ConversationSummary(
+                owner_id=owner_id,
+                counterpart_id=counterpart_id,
+                last_message_id=message.id,
+                last_preview=message.content[:ConversationSummary.PREVIEW_LENGTH],
+                last_activity=message.timestamp,
+            )
+            for (owner_id, counterpart_id), message in latest.items()
+        ],
+        update_conflicts=True,
+        unique_fields=['owner', 'counterpart'],
+        update_fields=['last_message', 'last_preview', 'last_activity'],
+    )
+
+    # Receiver's unread count: messages above their read pointer, in one UPDATE.
+    # Seqs ascend per conversation, so the first threshold the pointer is
+    # below gives the number of messages after it.
+    incoming = {}
+    for message in messages:
+        if message.seq is not None:
+            incoming.setdefault((message.receiver_id, message.sender_id), []).append(message.seq)
+    if not incoming:
+        return
+    whens = []
+    for (owner_id, counterpart_id), seqs in incoming.items():
+        seqs.sort()
+        whens.extend(
+            When(owner_id=owner_id, counterpart_id=counterpart_id, last_read_seq__lt=seq, then=Value(len(seqs) - i))
+            for i, seq in enumerate(seqs)
+        )
+    pairs = Q()
+    for owner_id, counterpart_id in incoming:
+        pairs |= Q(owner_id=owner_id, counterpart_id=counterpart_id)
+    ConversationSummary.objects.filter(pairs).update(
+        unread_count=F('unread_count') + Case(*whens, default=Value(0))
+    )
+
+
+@receiver(messages_persisted)
+def update_message_index(sender, messages, **kwargs):
+    index_messages(messages)
@@ -1,6 +1,64 @@
-from django.test import TestCase
+import asyncio
+import json
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+import msgpack
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
-from .models import Message
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from base.authentication import principal_cache
+from base.friends import friend_graph
+from base.identity import identity_cache
+from base.models import Invitation
+from .archive import archive_before, default_cutoff
+from .benchmarks import ENDPOINTS, run_benchmarks
+from .codec import CodecMixin
+from .dedup import recent_client_ids
+from .export import aiter_chunks, export_chunks
+from .middleware import get_user_from_token
+from .outbound import OutboundQueue
+from .models import ArchiveSegment, ConversationSequence, ConversationSummary, Message
+from .presence import presence_registry
+from .ratelimit import ConnectionLimiter, rate_limit_settings, user_buckets
+from .reads import ReadPointerQueue, apply_read_pointers, read_pointers
+from .persistence import MessageWriteQueue, PendingMessage, message_queue, write_messages
+from .routing import websocket_urlpatterns
+from .sequences import seq_gaps
+from .typing import TypingCoalescer
+from core.metrics import registry
+
+application = URLRouter(websocket_urlpatterns)
+
+
+def chat_socket(user, path='/ws/chat/user1_user2/', **kwargs):
+    """A ChatConsumer communicator authenticated as `user`."""
+    communicator = WebsocketCommunicator(application, path, **kwargs)
+    communicator.scope['user'] = user
+    return communicator
+
+
+async def join(communicator):
+    """Connect and return the frames sent before the 'unread' badge that ends the handshake."""
+    connected, _ = await communicator.connect()
+    assert connected
+    frames = []
+    while True:
+        raw = await communicator.receive_from()
+        frame = json.loads(raw) if isinstance(raw, str) else msgpack.unpackb(raw)
+        if frame.get('type', frame.get('y')) == 'unread':
+            return frames
+        frames.append(frame)
+
 
 class MessageModelTest(TestCase):
     def setUp(self):
@@ -23,4 +81,823 @@ class MessageModelTest(TestCase):
         
         messages = Message.objects.all()
         self.assertEqual(messages[0], msg1)
-        self.assertEqual(messages[1], msg2)
\ No newline at end of file
+        self.assertEqual(messages[1], msg2)
+
+
+class WriteMessagesTest(TestCase):
+    def setUp(self):
+        identity_cache.clear()
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+
+    # Besides the writes themselves, each batch runs in a savepoint (2 queries).
+    # Messages from the socket path arrive with their seq already reserved.
+    def test_batch_uses_one_lookup_and_one_insert(self):
+        batch = [
+            PendingMessage('user1', 'user2', 'Hi', 1),
+            PendingMessage('user2', 'user1', 'Hey', 2),
+            PendingMessage('user1', 'user2', 'How are you?', 3),
+        ]
+        # User lookup, message INSERT, summary upsert, unread UPDATE, search terms INSERT
+        with self.assertNumQueries(2 + 5):
+            write_messages(batch)
+        self.assertEqual(Message.objects.count(), 3)
+
+    def test_warm_identity_cache_skips_user_lookup(self):
+        write_messages([PendingMessage('user1', 'user2', 'Hi', 1)])
+        with self.assertNumQueries(2 + 4):
+            write_messages([PendingMessage('user2', 'user1', 'Hey', 2)])
+
+    def test_missing_seq_is_allocated_per_conversation(self):
+        write_messages([PendingMessage('user1', 'user2', 'Hi'), PendingMessage('user2', 'user1', 'Hey')])
+        Message.objects.create(sender=self.user1, receiver=self.user2, content='Yo')
+        self.assertEqual(list(Message.objects.order_by('id').values_list('seq', flat=True)), [1, 2, 3])
+
+    def test_stored_client_msg_id_is_not_written_again(self):
+        write_messages([PendingMessage('user1', 'user2', 'Hi', 1, 'c1')])
+        write_messages([
+            PendingMessage('user1', 'user2', 'Hi', 2, 'c1'),
+            PendingMessage('user2', 'user1', 'Hi', 3, 'c1'),  # Ids are unique per sender
+            PendingMessage('user2', 'user1', 'Hi', 4, 'c1'),
+        ])
+        self.assertEqual(
+            sorted(Message.objects.values_list('sender__username', 'seq')), [('user1', 1), ('user2', 3)]
+        )
+
+    def test_unknown_user_is_dropped(self):
+        write_messages([PendingMessage('user1', 'ghost', 'Hello?'), PendingMessage('user1', 'user2', 'Hi')])
+        self.assertEqual(list(Message.objects.values_list('content', flat=True)), ['Hi'])
+
+
+class MessageWriteQueueTest(TransactionTestCase):
+    def setUp(self):
+        identity_cache.clear()
+        User.objects.create_user(username='user1', password='pass123')
+        User.objects.create_user(username='user2', password='pass123')
+
+    def test_close_flushes_pending_messages(self):
+        queue = MessageWriteQueue(batch_size=2, flush_interval=10, max_pending=10)
+
+        async def run():
+            for i in range(5):
+                await queue.put('user1', 'user2', f'msg {i}')
+            await queue.close()
+
+        async_to_sync(run)()
+        self.assertEqual(Message.objects.count(), 5)
+        self.assertEqual(queue.stats()['flushed'], 5)
+        self.assertEqual(queue.depth, 0)
+
+    def test_failed_batch_is_retried(self):
+        queue = MessageWriteQueue(batch_size=10, flush_interval=0.01, max_pending=10, retries=2, retry_backoff=0.01)
+        attempts = []
+
+        def flaky_write(batch):
+            attempts.append(len(batch))
+            if len(attempts) == 1:
+                raise RuntimeError('database is down')
+            return write_messages(batch)
+
+        async def run():
+            await queue.put('user1', 'user2', 'Hi')
+            with self.assertLogs('chat.persistence', 'WARNING'):
+                await queue.close()
+
+        with mock.patch('chat.persistence.write_messages', side_effect=flaky_write):
+            async_to_sync(run)()
+        self.assertEqual(attempts, [1, 1])
+        self.assertEqual((queue.stats()['flushed'], queue.stats()['failed']), (1, 0))
+        self.assertEqual(Message.objects.get().content, 'Hi')
+
+    def test_drain_does_not_wait_for_later_messages(self):
+        queue = MessageWriteQueue(batch_size=2, flush_interval=0.01, max_pending=1000)
+
+        async def run():
+            for i in range(3):
+                await queue.put('user1', 'user2', f'before {i}')
+            producing = True
+
+            async def produce():
+                while producing:
+                    await queue.put('user1', 'user2', 'later')
+                    await asyncio.sleep(0.001)
+
+            producer = asyncio.get_running_loop().create_task(produce())
+            await asyncio.sleep(0.01)
+            await asyncio.wait_for(queue.drain(), 2)
+            done = queue._done
+            producing = False
+            await producer
+            await queue.close()
+            return done
+
+        self.assertGreaterEqual(async_to_sync(run)(), 3)
+        self.assertEqual(Message.objects.filter(content__startswith='before').count(), 3)
+
+
+class TokenMiddlewareTest(TestCase):
+    def setUp(self):
+        principal_cache.clear()
+        self.user = User.objects.create_user(username='user1', password='pass123')
+        self.token = Token.objects.create(user=self.user)
+
+    def test_cached_token_skips_database(self):
+        async_to_sync(get_user_from_token)(self.token.key)
+        with self.assertNumQueries(0):
+            user = async_to_sync(get_user_from_token)(self.token.key)
+        self.assertEqual((user.id, user.username), (self.user.id, 'user1'))
+
+    def test_unknown_token_is_anonymous(self):
+        user = async_to_sync(get_user_from_token)('not-a-token')
+        self.assertFalse(user.is_authenticated)
+
+
+class ChatConsumerTest(TestCase):
+    def setUp(self):
+        identity_cache.clear()
+        recent_client_ids.clear()
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+
+    def test_message_is_echoed_and_persisted(self):
+        broadcasts = registry.get('chat_messages_broadcast_total').value
+
+        async def run():
+            communicator = chat_socket(self.user1)
+            await join(communicator)
+            await communicator.send_json_to({'message': 'Hi', 'sender': 'user1', 'clientMsgId': 'c1'})
+            response = await communicator.receive_json_from()
+            await communicator.disconnect()
+            await message_queue.close()
+            return response
+
+        response = async_to_sync(run)()
+        self.assertEqual(response['message'], 'Hi')
+        self.assertEqual(response['clientMsgId'], 'c1')
+        self.assertEqual(registry.get('chat_messages_broadcast_total').value, broadcasts + 1)
+        self.assertEqual(Message.objects.get().content, 'Hi')
+
+    def test_batch_frame(self):
+        async def run():
+            communicator = chat_socket(self.user1)
+            await join(communicator)
+            await communicator.send_json_to([
+                {'type': 'typing', 'sender': 'user1', 'typing': True},
+                {'message': 'one', 'sender': 'user1', 'clientMsgId': 'c1'},
+                {'message': 'two', 'sender': 'user1', 'clientMsgId': 'c2'},
+                {'message': '', 'sender': 'user1', 'clientMsgId': 'c3'},
+            ])
+            # Typing, two echoes and the ack, in any order
+            frames = [await communicator.receive_json_from() for _ in range(4)]
+            await communicator.disconnect()
+            await message_queue.close()
+            return frames
+
+        frames = async_to_sync(run)()
+        ack = next(f for f in frames if f.get('type') == 'ack')
+        self.assertEqual([a['clientMsgId'] for a in ack['acks']], ['c1', 'c2'])
+        self.assertEqual(ack['errors'][0]['clientMsgId'], 'c3')
+        self.assertEqual([f['message'] for f in frames if 'message' in f], ['one', 'two'])
+        self.assertEqual(list(Message.objects.values_list('content', flat=True)), ['one', 'two'])
+
+    def test_retried_send_is_acked_as_duplicate(self):
+        async def run():
+            communicator = chat_socket(self.user1)
+            await join(communicator)
+            await communicator.send_json_to({'message': 'Hi', 'sender': 'user1', 'clientMsgId': 'c1'})
+            echo = await communicator.receive_json_from()
+            first_ack = await communicator.receive_json_from()
+            await communicator.disconnect()
+
+            # Resent after a reconnect: acked, but neither broadcast nor stored again
+            communicator = chat_socket(self.user1)
+            await join(communicator)
+            await communicator.send_json_to({'message': 'Hi', 'sender': 'user1', 'clientMsgId': 'c1'})
+            retry_ack = await communicator.receive_json_from()
+            nothing_else = await communicator.receive_nothing()
+            await communicator.disconnect()
+            await message_queue.close()
+            return echo, first_ack, retry_ack, nothing_else
+
+        echo, first_ack, retry_ack, nothing_else = async_to_sync(run)()
+        self.assertEqual(first_ack['acks'], [
+            {'clientMsgId': 'c1', 'status': 'new', 'timestamp': echo['timestamp'], 'seq': echo['seq']}
+        ])
+        self.assertEqual(retry_ack['acks'], [
+            {'clientMsgId': 'c1', 'status': 'duplicate', 'timestamp': echo['timestamp'], 'seq': echo['seq']}
+        ])
+        self.assertTrue(nothing_else)
+        self.assertEqual(list(Message.objects.values_list('client_msg_id', flat=True)), ['c1'])
+        # Keyed on the authenticated user, not the claimed sender
+        self.assertEqual(recent_client_ids.claim(self.user1.id, 'c1')['seq'], echo['seq'])
+
+    def test_typing_is_attributed_to_the_socket_user(self):
+        async def run():
+            communicator = chat_socket(self.user1)
+            await join(communicator)
+            await communicator.send_json_to({'type': 'typing', 'sender': 'user2', 'typing': True})
+            frame = await communicator.receive_json_from()
+            await communicator.disconnect()
+            await message_queue.close()
+            return frame
+
+        self.assertEqual(async_to_sync(run)(), {'type': 'typing', 'sender': 'user1', 'typing': True})
+
+    def test_sender_is_the_socket_user(self):
+        async def run():
+            communicator = chat_socket(self.user1)
+            await join(communicator)
+            await communicator.send_json_to({'message': 'Hi', 'sender': 'user2', 'clientMsgId': 'c1'})
+            echo = await communicator.receive_json_from()
+            await communicator.disconnect()
+            await message_queue.close()
+            return echo
+
+        self.assertEqual(async_to_sync(run)()['sender'], 'user1')
+        self.assertEqual(Message.objects.get().sender, self.user1)
+
+    def test_failed_send_is_reported_and_can_be_retried(self):
+        async def run():
+            communicator = chat_socket(self.user1)
+            await join(communicator)
+            with mock.patch('chat.consumers.allocate_for_usernames', side_effect=RuntimeError('database is down')):
+                with self.assertLogs('chat.consumers', 'ERROR'):
+                    await communicator.send_json_to({'message': 'Hi', 'sender': 'user1', 'clientMsgId': 'c1'})
+                    error = await communicator.receive_json_from()
+            # The socket survives, and the retry is not mistaken for a duplicate
+            await communicator.send_json_to({'message': 'Hi', 'sender': 'user1', 'clientMsgId': 'c1'})
+            echo = await communicator.receive_json_from()
+            ack = await communicator.receive_json_from()
+            await communicator.disconnect()
+            await message_queue.close()
+            return error, echo, ack
+
+        error, echo, ack = async_to_sync(run)()
+        self.assertEqual(error['clientMsgId'], 'c1')
+        self.assertIn('error', error)
+        self.assertEqual(echo['message'], 'Hi')
+        self.assertEqual(ack['acks'][0]['status'], 'new')
+
+    def test_resume_replays_only_the_gap(self):
+        async def run():
+            communicator = chat_socket(self.user1)
+            await join(communicator)
+            seqs = []
+            for text in ('one', 'two', 'three'):
+                await communicator.send_json_to({'message': text, 'sender': 'user1'})
+                seqs.append((await communicator.receive_json_from())['seq'])
+            await communicator.disconnect()
+
+            communicator = chat_socket(self.user1, f'/ws/chat/user1_user2/?since={seqs[0]}')
+            frames = await join(communicator)
+            await communicator.disconnect()
+            await message_queue.close()
+            return seqs, frames
+
+        seqs, frames = async_to_sync(run)()
+        self.assertEqual(seqs, [seqs[0], seqs[0] + 1, seqs[0] + 2])
+        self.assertEqual([f['message'] for f in frames[:2]], ['two', 'three'])
+        self.assertEqual(frames[2]['type'], 'resume')
+        self.assertEqual(frames[2]['lastSeq'], seqs[2])
+        self.assertEqual(list(Message.objects.order_by('seq').values_list('seq', flat=True)), seqs)
+
+    def test_only_participants_can_join(self):
+        stranger = User.objects.create_user(username='user3', password='pass123')
+
+        async def run():
+            anonymous = WebsocketCommunicator(application, '/ws/chat/user1_user2/?since=0')
+            outsider = chat_socket(stranger, '/ws/chat/user1_user2/?since=0')
+            return await anonymous.connect(), await outsider.connect()
+
+        self.assertEqual(async_to_sync(run)(), ((False, 4001), (False, 4001)))
+
+    def test_read_receipt_reader_is_the_socket_user(self):
+        async def run():
+            communicator = chat_socket(self.user1)
+            await join(communicator)
+            await communicator.send_json_to({'type': 'read_receipt', 'sender': 'user2', 'seq': 5})
+            receipt = await communicator.receive_json_from()
+            pending = dict(read_pointers._pending)
+            await communicator.disconnect()
+            await read_pointers.flush()
+            await message_queue.close()
+            return receipt, pending
+
+        receipt, pending = async_to_sync(run)()
+        self.assertEqual(receipt, {'type': 'read_receipt', 'reader': 'user1', 'seq': 5})
+        self.assertEqual(pending, {(self.user1.id, self.user2.id): 5})
+
+    @override_settings(CHAT_RESUME_RECHECK_DELAY=0.01)
+    def test_resume_stops_before_unwritten_seqs(self):
+        # Seqs 2-3 reserved (broadcast by another worker) but not written yet
+        ConversationSequence.allocate(self.user1.id, self.user2.id, count=4)
+        write_messages([PendingMessage('user1', 'user2', 'one', 1), PendingMessage('user2', 'user1', 'four', 4)])
+
+        async def run():
+            communicator = chat_socket(self.user1, '/ws/chat/user1_user2/?since=0')
+            frames = await join(communicator)
+            await communicator.disconnect()
+            await message_queue.close()
+            return frames
+
+        frames = async_to_sync(run)()
+        self.assertEqual([f['seq'] for f in frames[:2]], [1, 4])
+        self.assertEqual(frames[2]['gaps'], [[2, 3]])
+        self.assertEqual(frames[2]['lastSeq'], 1)
+
+    def test_seq_gaps(self):
+        frames = [{'seq': 5}, {'seq': 8}]
+        self.assertEqual(seq_gaps(frames, 3, 9), [[4, 4], [6, 7], [9, 9]])
+        self.assertEqual(seq_gaps(frames, 4, 8), [[6, 7]])
+        # Nothing written yet after `since`: the whole reserved range is missing
+        self.assertEqual(seq_gaps([], 3, 5), [[4, 5]])
+        self.assertEqual(seq_gaps([], 5, 5), [])
+
+    def test_msgpack_subprotocol(self):
+        async def run():
+            communicator = chat_socket(self.user1, subprotocols=['msgpack'])
+            connected, subprotocol = await communicator.connect()
+            self.assertEqual(subprotocol, 'msgpack')
+            await communicator.receive_from()  # Unread badge
+            await communicator.send_to(bytes_data=msgpack.packb({'m': 'Hi', 's': 'user1', 'id': 'c1'}))
+            response = await communicator.receive_from()
+            await communicator.disconnect()
+            await message_queue.close()
+            return response
+
+        response = msgpack.unpackb(async_to_sync(run)())
+        self.assertEqual((response['m'], response['s'], response['id']), ('Hi', 'user1', 'c1'))
+        self.assertIsInstance(response['t'], int)
+
+
+class RateLimitTest(TestCase):
+    def setUp(self):
+        identity_cache.clear()
+        recent_client_ids.clear()
+        user_buckets.clear()
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        User.objects.create_user(username='user2', password='pass123')
+
+    def test_per_user_bucket_is_shared_across_connections(self):
+        limits = {'CONNECTION': {'chat': (1, 5)}, 'USER': {'chat': (1, 3)}}
+        first, second = ConnectionLimiter(7, limits), ConnectionLimiter(7, limits)
+        self.assertEqual([first.allow('chat') for _ in range(2)], [None, None])
+        self.assertIsNone(second.allow('chat'))
+        self.assertGreater(second.allow('chat'), 0)  # User bucket is empty
+        self.assertIsNone(ConnectionLimiter(8, limits).allow('chat'))
+        self.assertIsNone(first.allow('typing'))  # No limit for the kind
+
+    def test_zero_rate_is_rejected(self):
+        with self.assertRaises(ValueError):
+            ConnectionLimiter(7, {'CONNECTION': {'chat': (0, 5)}, 'USER': {}})
+        with override_settings(CHAT_RATE_LIMITS={'USER': {'read': (0, 1)}}):
+            with self.assertRaises(ValueError):
+                rate_limit_settings()
+
+    @override_settings(CHAT_RATE_LIMITS={'CONNECTION': {'chat': (0.01, 2), 'typing': (0.01, 1)}})
+    def test_chat_flood_gets_rate_limited_notice(self):
+        throttled = registry.get('chat_throttled_chat_total').value
+
+        async def run():
+            communicator = chat_socket(self.user1)
+            await join(communicator)
+            await communicator.send_json_to([
+                {'message': str(i), 'sender': 'user1', 'clientMsgId': f'c{i}'} for i in range(3)
+            ])
+            frames = [await communicator.receive_json_from() for _ in range(3)]
+            await communicator.send_json_to({'message': 'more', 'sender': 'user1', 'clientMsgId': 'c3'})
+            frames.append(await communicator.receive_json_from())
+            # Typing beyond the limit is dropped without a notice
+            for typing in (True, False):
+                await communicator.send_json_to({'type': 'typing', 'sender': 'user1', 'typing': typing})
+            frames.append(await communicator.receive_json_from())
+            nothing_else = await communicator.receive_nothing()
+            await communicator.disconnect()
+            await message_queue.close()
+            return frames, nothing_else
+
+        frames, nothing_else = async_to_sync(run)()
+        ack = next(f for f in frames if f.get('type') == 'ack')
+        self.assertEqual([a['clientMsgId'] for a in ack['acks']], ['c0', 'c1'])
+        self.assertEqual(ack['errors'][0]['code'], 'rate_limited')
+        self.assertEqual(ack['errors'][0]['clientMsgId'], 'c2')
+        notice = frames[-2]
+        self.assertEqual((notice['type'], notice['clientMsgId']), ('rate_limited', 'c3'))
+        self.assertNotIn('error', notice)
+        self.assertGreater(notice['retryAfterMs'], 0)
+        self.assertEqual((frames[-1]['type'], frames[-1]['typing']), ('typing', True))
+        self.assertTrue(nothing_else)
+        self.assertEqual(registry.get('chat_throttled_chat_total').value, throttled + 2)
+        self.assertEqual(Message.objects.count(), 2)
+
+
+class StatusConsumerTest(TestCase):
+    def setUp(self):
+        identity_cache.clear()
+        friend_graph.clear()
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.user3 = User.objects.create_user(username='user3', password='pass123')
+        Invitation.objects.create(sender=self.user1, receiver=self.user2, status='accepted')
+        window, presence_registry.window = presence_registry.window, 0.01
+        self.addCleanup(setattr, presence_registry, 'window', window)
+
+    def status_socket(self, user):
+        communicator = WebsocketCommunicator(application, f'/ws/status/{user.username}/')
+        communicator.scope['user'] = user
+        return communicator
+
+    def test_presence_reaches_friends_only(self):
+        async def run():
+            friend, stranger = self.status_socket(self.user2), self.status_socket(self.user3)
+            await friend.connect()
+            await stranger.connect()
+            await asyncio.sleep(0.05)  # Let their own online transitions flush
+
+            me = self.status_socket(self.user1)
+            await me.connect()
+            snapshot = await me.receive_json_from()
+            online = await friend.receive_json_from()
+            stranger_idle = await stranger.receive_nothing(timeout=0.05)
+
+            await me.disconnect()
+            offline = await friend.receive_json_from()
+            await friend.disconnect()
+            await stranger.disconnect()
+            await asyncio.sleep(0.05)
+            return snapshot, online, stranger_idle, offline
+
+        snapshot, online, stranger_idle, offline = async_to_sync(run)()
+        self.assertEqual(snapshot, {'user': 'user2', 'status': 'online'})
+        self.assertEqual(online, {'user': 'user1', 'status': 'online'})
+        self.assertTrue(stranger_idle)
+        self.assertEqual(offline, {'user': 'user1', 'status': 'offline'})
+        self.assertTrue(self.user1.presence.last_seen)
+
+    def test_anonymous_socket_is_rejected(self):
+        async def run():
+            communicator = WebsocketCommunicator(application, '/ws/status/nobody/')
+            connected, code = await communicator.connect()
+            return connected, code
+
+        self.assertEqual(async_to_sync(run)(), (False, 4001))
+
+
+class MessageHistoryViewTest(TestCase):
+    def setUp(self):
+        identity_cache.clear()
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user1)
+        self.messages = [
+            Message.objects.create(
+                sender=self.user1 if i % 2 else self.user2,
+                receiver=self.user2 if i % 2 else self.user1,
+                content=f'msg {i}'
+            )
+            for i in range(5)
+        ]
+
+    def test_latest_page_is_oldest_first(self):
+        response = self.client.get('/api/chat/messages/user2/?limit=3')
+        self.assertEqual([m['content'] for m in response.data], ['msg 2', 'msg 3', 'msg 4'])
+        self.assertEqual(response['X-Has-More'], 'true')
+
+    def test_before_cursor_pages_back(self):
+        response = self.client.get(f'/api/chat/messages/user2/?limit=3&before={self.messages[2].id}')
+        self.assertEqual([m['content'] for m in response.data], ['msg 0', 'msg 1'])
+        self.assertEqual(response['X-Has-More'], 'false')
+
+    def test_after_cursor_pages_forward(self):
+        response = self.client.get(f'/api/chat/messages/user2/?limit=2&after={self.messages[0].id}')
+        self.assertEqual([m['content'] for m in response.data], ['msg 1', 'msg 2'])
+        self.assertEqual(response['X-Has-More'], 'true')
+
+    def test_has_more_is_readable_cross_origin(self):
+        response = self.client.get('/api/chat/messages/user2/', HTTP_ORIGIN='http://localhost:3000')
+        self.assertEqual(response['Access-Control-Expose-Headers'], 'X-Has-More')
+
+    def test_sender_names_need_no_extra_queries(self):
+        self.client.get('/api/chat/messages/user2/')
+        # One range scan per direction of the conversation, plus the archive
+        # segment lookup because the whole conversation fits in one page
+        with self.assertNumQueries(2 + 1):
+            response = self.client.get('/api/chat/messages/user2/')
+        self.assertEqual(response.data[0]['sender_username'], 'user2')
+
+    def test_history_continues_into_archive(self):
+        old = timezone.now() - timedelta(days=400)
+        for i, message in enumerate(self.messages[:3]):
+            Message.objects.filter(id=message.id).update(timestamp=old + timedelta(days=40 * i))
+        self.assertEqual(archive_before(default_cutoff()), (1, 3))
+        self.assertEqual(Message.objects.count(), 2)
+        self.assertEqual(ArchiveSegment.objects.count(), 3)
+
+        response = self.client.get('/api/chat/messages/user2/?limit=3')
+        self.assertEqual([m['content'] for m in response.data], ['msg 2', 'msg 3', 'msg 4'])
+        self.assertEqual(response['X-Has-More'], 'true')
+        response = self.client.get(f'/api/chat/messages/user2/?before={response.data[0]["id"]}')
+        self.assertEqual([m['content'] for m in response.data], ['msg 0', 'msg 1'])
+        self.assertEqual(response.data[0]['sender_username'], 'user2')
+        response = self.client.get(f'/api/chat/messages/user2/?limit=2&after={self.messages[0].id}')
+        self.assertEqual([m['content'] for m in response.data], ['msg 1', 'msg 2'])
+
+    def test_archive_moves_one_month_per_transaction(self):
+        old = timezone.now() - timedelta(days=400)
+        for i, message in enumerate(self.messages[:3]):
+            Message.objects.filter(id=message.id).update(timestamp=old + timedelta(days=40 * i))
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(archive_before(default_cutoff()), (1, 3))
+        (pairs_sql,) = [q['sql'] for q in captured.captured_queries if 'DISTINCT' in q['sql']]
+        self.assertNotIn('ORDER BY', pairs_sql)  # One row per conversation, not per message
+        self.assertEqual(sum(q['sql'].startswith('SAVEPOINT') for q in captured.captured_queries), 3)
+
+    @override_settings(CHAT_EXPORT={'CHUNK_SIZE': 2})
+    def test_export_streams_archive_then_hot_rows(self):
+        Message.objects.filter(id=self.messages[0].id).update(timestamp=timezone.now() - timedelta(days=400))
+        archive_before(default_cutoff())
+
+        response = self.client.get('/api/chat/export/user2/')
+        self.assertTrue(response.streaming)
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([line['content'] for line in lines], [f'msg {i}' for i in range(5)])
+        self.assertEqual((lines[0]['sender'], lines[0]['receiver']), ('user2', 'user1'))
+
+        chunks = async_to_sync(self._collect)(aiter_chunks(export_chunks(self.user1.id, chunk_size=2)))
+        # One archive segment, then hot rows two at a time
+        self.assertEqual([chunk.count(b'\n') for chunk in chunks], [1, 2, 2])
+
+    @staticmethod
+    async def _collect(chunks):
+        return [chunk async for chunk in chunks]
+
+
+class MessageSearchTest(TestCase):
+    def setUp(self):
+        identity_cache.clear()
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.user3 = User.objects.create_user(username='user3', password='pass123')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user1)
+        write_messages([
+            PendingMessage('user1', 'user2', 'Lunch at noon?'),
+            PendingMessage('user2', 'user1', 'Noon works, lunch it is'),
+            PendingMessage('user3', 'user1', 'lunch tomorrow instead'),
+            PendingMessage('user2', 'user3', 'lunch without user1'),
+        ])
+
+    def test_all_terms_must_match(self):
+        response = self.client.get('/api/chat/search/messages/', {'q': 'LUNCH noon'})
+        self.assertEqual(
+            [(m['content'], m['conversation_with']) for m in response.data],
+            [('Noon works, lunch it is', 'user2'), ('Lunch at noon?', 'user2')]
+        )
+
+    def test_only_own_conversations_are_searched(self):
+        response = self.client.get('/api/chat/search/messages/', {'q': 'lunch'})
+        self.assertEqual(len(response.data), 3)
+        response = self.client.get('/api/chat/search/messages/', {'q': 'lunch', 'with': 'user3'})
+        self.assertEqual([m['content'] for m in response.data], ['lunch tomorrow instead'])
+
+    def test_paging(self):
+        response = self.client.get('/api/chat/search/messages/', {'q': 'lunch', 'limit': 2})
+        self.assertEqual(response['X-Has-More'], 'true')
+        response = self.client.get(
+            '/api/chat/search/messages/', {'q': 'lunch', 'before': response.data[-1]['id']}
+        )
+        self.assertEqual([m['content'] for m in response.data], ['Lunch at noon?'])
+        self.assertEqual(response['X-Has-More'], 'false')
+
+
+class ConversationSummaryTest(TestCase):
+    def setUp(self):
+        identity_cache.clear()
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.user3 = User.objects.create_user(username='user3', password='pass123')
+
+    def test_summaries_follow_persisted_messages(self):
+        write_messages([
+            PendingMessage('user1', 'user2', 'Hi'),
+            PendingMessage('user2', 'user1', 'Hey'),
+        ])
+        Message.objects.create(sender=self.user3, receiver=self.user1, content='Yo')
+
+        summary = ConversationSummary.objects.get(owner=self.user2, counterpart=self.user1)
+        self.assertEqual(summary.last_preview, 'Hey')
+        self.assertEqual(ConversationSummary.objects.filter(owner=self.user1).count(), 2)
+
+    def test_friends_list_is_sorted_by_recency(self):
+        write_messages([PendingMessage('user1', 'user2', 'Hi')])
+        write_messages([PendingMessage('user3', 'user1', 'Yo')])
+
+        client = APIClient()
+        client.force_authenticate(self.user1)
+        client.get('/api/chat/friends/')
+        with self.assertNumQueries(1):
+            response = client.get('/api/chat/friends/')
+        self.assertEqual([f['username'] for f in response.data], ['user3', 'user2'])
+        self.assertEqual(response.data[0]['last_message'], 'Yo')
+        self.assertEqual(response.data[0]['unread_count'], 1)
+
+    @staticmethod
+    def unread(owner, counterpart):
+        return ConversationSummary.objects.values_list('last_read_seq', 'unread_count').get(
+            owner=owner, counterpart=counterpart
+        )
+
+    def test_unread_counts_follow_read_pointers(self):
+        write_messages([PendingMessage('user1', 'user2', text) for text in ('a', 'b', 'c')])
+        seqs = list(Message.objects.order_by('seq').values_list('seq', flat=True))
+        self.assertEqual(self.unread(self.user2, self.user1), (0, 3))
+        self.assertEqual(self.unread(self.user1, self.user2), (0, 0))
+
+        apply_read_pointers({(self.user2.id, self.user1.id): seqs[1]})
+        self.assertEqual(self.unread(self.user2, self.user1), (seqs[1], 1))
+        apply_read_pointers({(self.user2.id, self.user1.id): seqs[0]})  # never moves back
+        self.assertEqual(self.unread(self.user2, self.user1), (seqs[1], 1))
+
+        write_messages([PendingMessage('user1', 'user2', 'd')])
+        self.assertEqual(self.unread(self.user2, self.user1), (seqs[1], 2))
+        apply_read_pointers({(self.user2.id, self.user1.id): None})
+        self.assertEqual(self.unread(self.user2, self.user1), (seqs[2] + 1, 0))
+
+    def test_read_receipts_are_coalesced(self):
+        writes = registry.get('chat_read_pointer_writes_total').value
+
+        async def run():
+            queue = ReadPointerQueue(flush_interval=60)
+            queue.mark_read(self.user2.id, self.user1.id, 1)
+            queue.mark_read(self.user2.id, self.user1.id, 3)
+            queue.mark_read(self.user2.id, self.user1.id, 2)
+            queue.mark_read(self.user3.id, self.user1.id)
+            return queue._pending, await queue.flush()
+
+        pending, _ = async_to_sync(run)()
+        self.assertEqual(pending, {(self.user2.id, self.user1.id): 3, (self.user3.id, self.user1.id): None})
+        self.assertEqual(registry.get('chat_read_pointer_writes_total').value, writes + 2)
+
+
+class TypingCoalescerTest(TestCase):
+    def test_only_transitions_are_forwarded(self):
+        async def run():
+            forwarded = []
+
+            async def forward(sender, typing):
+                forwarded.append((sender, typing))
+
+            typing = TypingCoalescer(forward, refresh_interval=60, expiry=60)
+            decisions = [
+                typing.update('user1', True),
+                typing.update('user1', True),
+                typing.update('user1', True),
+                typing.update('user1', False),
+                typing.update('user1', False),
+            ]
+            await typing.close()
+            return decisions, forwarded
+
+        decisions, forwarded = async_to_sync(run)()
+        self.assertEqual(decisions, [True, False, False, True, False])
+        self.assertEqual(forwarded, [])
+
+    def test_state_is_dropped_once_typing_stops(self):
+        async def run():
+            async def forward(sender, typing):
+                pass
+
+            typing = TypingCoalescer(forward, refresh_interval=60, expiry=0.01)
+            typing.update('user1', True)
+            typing.update('user1', False)
+            typing.update('user2', True)
+            typing.update('someone', False)
+            await asyncio.sleep(0.05)
+            return typing._states
+
+        self.assertEqual(async_to_sync(run)(), {})
+
+    def test_silence_expires_to_not_typing(self):
+        async def run():
+            forwarded = []
+
+            async def forward(sender, typing):
+                forwarded.append((sender, typing))
+
+            typing = TypingCoalescer(forward, refresh_interval=60, expiry=0.01)
+            typing.update('user1', True)
+            await asyncio.sleep(0.05)
+            return forwarded
+
+        self.assertEqual(async_to_sync(run)(), [('user1', False)])
+
+
+class OutboundQueueTest(TestCase):
+    def test_ephemeral_frames_coalesce_and_drop_first(self):
+        async def run():
+            sent = []
+
+            async def send(frame):
+                sent.append(frame)
+
+            queue = OutboundQueue(send, None, max_frames=3, overflow='disconnect', delay_warn_ms=1000)
+            queue.put('m1', 'chat', seq=1)
+            queue.put('typing a', 'typing', key='a')
+            queue.put('typing a again', 'typing', key='a')  # replaces the queued one
+            queue.put('online b', 'presence', key='b')
+            queue.put('m2', 'chat', seq=2)  # full: drops the typing frame
+            queue.start()
+            await asyncio.sleep(0)
+            await queue.close()
+            return sent, queue.last_seq
+
+        sent, last_seq = async_to_sync(run)()
+        self.assertEqual(sent, ['m1', 'online b', 'm2'])
+        self.assertEqual(last_seq, 2)
+
+    def test_overflow_disconnects_with_resume_hint(self):
+        async def run():
+            overflowed = []
+
+            async def on_overflow(last_seq):
+                overflowed.append(last_seq)
+
+            queue = OutboundQueue(None, on_overflow, max_frames=2, overflow='disconnect', delay_warn_ms=1000)
+            queue.last_seq = 7
+            results = [queue.put(f'm{i}', 'chat', seq=8 + i) for i in range(3)]
+            await asyncio.sleep(0)
+            return results, overflowed, queue.put('late', 'chat')
+
+        results, overflowed, late = async_to_sync(run)()
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(overflowed, [7])
+        self.assertFalse(late)
+
+    def test_overflow_before_any_chat_frame_resumes_from_since(self):
+        class Socket(CodecMixin):
+            async def write_frame(self, frame):
+                self.frames.append(json.loads(frame))
+
+            async def close(self, code=None):
+                self.frames.append(code)
+
+        async def run():
+            socket = Socket()
+            socket.frames = []
+            await socket.outbound_overflow(None)
+            socket.resume_seq = 5
+            await socket.outbound_overflow(None)
+            await socket.outbound_overflow(9)
+            return socket.frames
+
+        self.assertEqual(async_to_sync(run)(), [
+            {'type': 'overflow'}, 4008,
+            {'type': 'overflow', 'lastSeq': 5}, 4008,
+            {'type': 'overflow', 'lastSeq': 9}, 4008,
+        ])
+
+    def test_failed_send_closes_the_queue(self):
+        async def run():
+            async def send(frame):
+                raise ConnectionResetError('socket closed')
+
+            queue = OutboundQueue(send, None, max_frames=3, overflow='disconnect', delay_warn_ms=1000)
+            queue.start()
+            queue.put('m1', 'chat', seq=1)
+            queue.put('m2', 'chat', seq=2)
+            with self.assertLogs('chat.outbound', 'WARNING'):
+                await asyncio.sleep(0.01)
+            finished = queue._task.done() and queue._task.exception() is None
+            late = queue.put('m3', 'chat', seq=3)
+            await queue.close()
+            return finished, late, len(queue), queue.last_seq
+
+        self.assertEqual(async_to_sync(run)(), (True, False, 0, None))
+
+
+class FanoutBenchmarkTest(TestCase):
+    def test_bench_fanout_runs(self):
+        out = StringIO()
+        call_command('bench_fanout', sizes=[1, 3], messages=5, stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 3)
+
+
+class RestBenchmarkTest(TestCase):
+    def setUp(self):
+        identity_cache.clear()
+        friend_graph.clear()
+        call_command('seed_data', users=30, friends=6, messages=200, seed=1, stdout=StringIO())
+
+    def test_friend_target_is_capped_by_the_user_count(self):
+        before = Invitation.objects.count()
+        # 4 users can form at most 6 pairs, however many friends each should have
+        call_command('seed_data', users=4, friends=50, messages=0, seed=2, stdout=StringIO())
+        self.assertEqual(Invitation.objects.count() - before, 6)
+
+    def test_seeded_endpoints_stay_within_query_budgets(self):
+        self.assertEqual(Message.objects.count(), 200)
+        # Latency depends on the machine; the query budgets must hold anywhere
+        report, violations = run_benchmarks(sample=4, iterations=1, check_latency=False)
+        self.assertEqual(violations, [])
+        self.assertEqual(set(report), {endpoint.name for endpoint in ENDPOINTS})
@@ -0,0 +1,112 @@
+"""
+Server-side coalescing of typing indicators.
+
+Clients send a `typing` frame on nearly every keystroke. ChatConsumer runs
+them through a TypingCoalescer so that only state changes reach the channel
+layer: the first "typing: true", a repeat at most every REFRESH_INTERVAL
+seconds, and "typing: false". If a sender goes quiet for EXPIRY seconds, or
+the socket closes while they are typing, the coalescer sends the
+"typing: false" on their behalf. A sender's state is only kept while they
+are typing.
+"""
+
+import asyncio
+import time
+
+from django.conf import settings
+
+from core.metrics import registry
+
+DEFAULTS = {
+    'REFRESH_INTERVAL': 3.0,
+    'EXPIRY': 6.0,
+}
+
+TYPING_FRAMES = registry.counter('chat_typing_frames_total', 'Typing frames received')
+TYPING_SUPPRESSED = registry.counter('chat_typing_suppressed_total', 'Typing frames dropped as redundant')
+TYPING_EXPIRED = registry.counter('chat_typing_expired_total', 'Typing indicators cleared by the server after EXPIRY')
+
+
+class _SenderState:
+    __slots__ = ('typing', 'last_forwarded', 'expiry_handle')
+
+    def __init__(self):
+        self.typing = False
+        self.last_forwarded = 0.0
+        self.expiry_handle = None
+
+
+class TypingCoalescer:
+    """
+    Per-connection typing state, keyed by sender.
+    `forward(sender, typing)` is the coroutine that broadcasts a state; it is
+    only called directly by the coalescer for expiry and close().
+    """
+
+    def __init__(self, forward, refresh_interval, expiry):
+        self._forward = forward
+        self.refresh_interval = refresh_interval
+        self.expiry = expiry
+        self._states = {}
+
+    @classmethod
+    def from_settings(cls, forward):
+        conf = {**DEFAULTS, **getattr(settings, 'CHAT_TYPING', {})}
+        return cls(forward, conf['REFRESH_INTERVAL'], conf['EXPIRY'])
+
+    def update(self, sender, typing):
+        """Record a typing frame. Returns True if it should be broadcast."""
+        TYPING_FRAMES.inc()
+        state = self._states.get(sender)
+        if not typing:
+            if state is None or not state.typing:
+                TYPING_SUPPRESSED.inc()
+                return False
+            self.reset(sender)
+            return True
+
+        if state is None:
+            state = self._states[sender] = _SenderState()
+        now = time.monotonic()
+        self._arm_expiry(sender, state)
+        if state.typing and now - state.last_forwarded < self.refresh_interval:
+            TYPING_SUPPRESSED.inc()
+            return False
+        state.typing = True
+        state.last_forwarded = now
+        return True
+
+    def reset(self, sender):
+        """The sender just sent a message, which clients already treat as typing stopped."""
+        state = self._states.pop(sender, None)
+        if state is not None:
+            self._cancel_expiry(state)
+
+    async def close(self):
+        """Clear every indicator still showing for this connection."""
+        states, self._states = self._states, {}
+        for sender, state in states.items():
+            self._cancel_expiry(state)
+            if state.typing:
+                await self._forward(sender, False)
+
+    def _arm_expiry(self, sender, state):
+        self._cancel_expiry(state)
+        loop = asyncio.get_running_loop()
+        state.expiry_handle = loop.call_later(
+            self.expiry, lambda: loop.create_task(self._expire(sender, state))
+        )
+
+    def _cancel_expiry(self, state):
+        if state.expiry_handle is not None:
+            state.expiry_handle.cancel()
+            state.expiry_handle = None
+
+    async def _expire(self, sender, state):
+        state.expiry_handle = None
+        if self._states.get(sender) is not state:
+            return
+        del self._states[sender]
+        if state.typing:
+            TYPING_EXPIRED.inc()
+            await self._forward(sender, False)
@@ -5,6 +5,13 @@ urlpatterns = [
     # Friends list endpoint
     path('friends/', views.get_friends, name='friends_list'),
     
+    # Keyword search across the current user's messages
+    path('search/messages/', views.MessageSearchView, name='message_search'),
+
+    # NDJSON export of all messages, or of one conversation
+    path('export/', views.ConversationExportView, name='export_all'),
+    path('export/<str:username>/', views.ConversationExportView, name='export_conversation'),
+
     # Message history for a specific user
     path('messages/<str:username>/', views.MessageHistoryView, name='chat_history'),
     
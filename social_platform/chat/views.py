@@ -1,9 +1,27 @@
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
-from .models import Message  # Import from chat.models (same app)
+from base.identity import identity_cache
+from base.search import user_search
+from .archive import archived_rows
+from .export import aiter_chunks, export_chunks
+from .models import ConversationSummary, Message  # Import from chat.models (same app)
+from .search import search_messages, serialize_results
+
+HISTORY_DEFAULTS = {
+    'PAGE_SIZE': 50,
+    'MAX_PAGE_SIZE': 200,
+}
+
+SEARCH_DEFAULTS = {
+    'PAGE_SIZE': 20,
+    'MAX_PAGE_SIZE': 100,
+    'MAX_TERMS': 8,
+}
 
 # 1. User Search
 @api_view(['GET'])
@@ -12,8 +30,8 @@ def search_users(request):
     query = request.query_params.get('search', '')
     if query:
         # Finds users that match the search, excluding yourself
-        users = User.objects.filter(username__icontains=query).exclude(id=request.user.id)
-        data = [{"id": u.id, "username": u.username} for u in users]
+        hits = user_search.search(query, exclude_id=request.user.id)
+        data = [{"id": hit.id, "username": hit.username} for hit in hits]
         return Response(data)
     return Response([])
 
@@ -21,47 +39,160 @@ def search_users(request):
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_friends(request):
-    # Logic: Show everyone you've ever talked to
+    # Logic: Show everyone you've ever talked to, most recent conversation first
     user = request.user
-    messages = Message.objects.filter(Q(sender=user) | Q(receiver=user))
-    
-    friend_ids = set()
-    for m in messages:
-        if m.sender == user:
-            friend_ids.add(m.receiver.id)
-        else:
-            friend_ids.add(m.sender.id)
-            
-    friends = User.objects.filter(id__in=friend_ids)
-    
+    summaries = list(
+        ConversationSummary.objects.filter(owner=user)
+        .order_by('-last_activity')
+        .values_list('counterpart_id', 'last_message_id', 'last_preview', 'last_activity', 'unread_count')
+    )
+
     # If the list is empty, show all other users so you have someone to click on initially
-    if not friends.exists():
+    if not summaries:
         friends = User.objects.exclude(id=user.id)
+        data = [{"id": f.id, "username": f.username} for f in friends]
+        return Response(data)
 
-    data = [{"id": f.id, "username": f.username} for f in friends]
+    users = identity_cache.resolve_ids(counterpart_id for counterpart_id, *_ in summaries)
+    data = [
+        {
+            "id": counterpart_id,
+            "username": users[counterpart_id].username,
+            "last_message_id": last_message_id,
+            "last_message": last_preview,
+            "last_activity": last_activity.isoformat(),
+            "unread_count": unread_count,
+        }
+        for counterpart_id, last_message_id, last_preview, last_activity, unread_count in summaries
+        if counterpart_id in users
+    ]
     return Response(data)
 
 # 3. Message History
+def _history_page(sender_id, receiver_id, before, after, limit):
+    """One direction of the conversation, as a range scan on chat_msg_pair_id_idx."""
+    qs = Message.objects.filter(sender_id=sender_id, receiver_id=receiver_id)
+    if before is not None:
+        qs = qs.filter(id__lt=before)
+    if after is not None:
+        return list(qs.filter(id__gt=after).order_by('id').values('id', 'sender_id', 'content', 'timestamp')[:limit])
+    return list(qs.order_by('-id').values('id', 'sender_id', 'content', 'timestamp')[:limit])
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def MessageHistoryView(request, username):
-    try:
-        other_user = User.objects.get(username=username)
-    except User.DoesNotExist:
+    """
+    Keyset-paginated conversation history, oldest first.
+
+    ?before=<id> pages back from a message id, ?after=<id> pages forward,
+    neither returns the latest page. ?limit= is capped at
+    CHAT_HISTORY['MAX_PAGE_SIZE']. The X-Has-More header tells the client
+    whether another page exists in the requested direction. Pages reaching
+    past the oldest message still in chat_message continue into the archive.
+    """
+    other_user = identity_cache.get_by_username(username)
+    if other_user is None:
         return Response({"error": "User not found"}, status=404)
 
-    messages = Message.objects.filter(
-        (Q(sender=request.user) & Q(receiver=other_user)) |
-        (Q(sender=other_user) & Q(receiver=request.user))
-    ).order_by('timestamp')
+    conf = {**HISTORY_DEFAULTS, **getattr(settings, 'CHAT_HISTORY', {})}
+    try:
+        before = int(request.query_params['before']) if 'before' in request.query_params else None
+        after = int(request.query_params['after']) if 'after' in request.query_params else None
+        limit = int(request.query_params.get('limit', conf['PAGE_SIZE']))
+    except ValueError:
+        return Response({"error": "before, after and limit must be integers"}, status=400)
+    limit = max(1, min(limit, conf['MAX_PAGE_SIZE']))
+
+    # Fetch one extra row per direction to know whether there is another page
+    rows = (
+        _history_page(request.user.id, other_user.id, before, after, limit + 1) +
+        _history_page(other_user.id, request.user.id, before, after, limit + 1)
+    )
+    rows.sort(key=lambda m: m['id'], reverse=after is None)
+
+    # Archived messages are all older than the hot ones (see chat/archive.py)
+    if after is not None:
+        rows = archived_rows(request.user.id, other_user.id, after=after, limit=limit + 1) + rows
+    elif len(rows) <= limit:
+        oldest = rows[-1]['id'] if rows else before
+        rows += archived_rows(request.user.id, other_user.id, before=oldest, limit=limit + 1 - len(rows))
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after is None:
+        rows.reverse()
 
+    # Only two participants, so sender names need no per-row lookups
+    usernames = {request.user.id: request.user.username, other_user.id: other_user.username}
     data = [
         {
-            "sender_username": m.sender.username,
-            "content": m.content,
-            "timestamp": m.timestamp.isoformat()
-        } for m in messages
+            "id": m['id'],
+            "sender_username": usernames[m['sender_id']],
+            "content": m['content'],
+            "timestamp": m['timestamp'].isoformat()
+        } for m in rows
     ]
-    
-    print(f"📚 Returning {len(data)} messages for {request.user.username} <-> {username}")
-    return Response(data)
\ No newline at end of file
+
+    response = Response(data)
+    response['X-Has-More'] = 'true' if has_more else 'false'
+    return response
+
+
+# 4. Message Search
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def MessageSearchView(request):
+    """
+    Messages of the current user containing every word of ?q=, newest first.
+
+    ?with=<username> limits the search to one conversation. ?before=<id>
+    pages back and ?limit= is capped at CHAT_SEARCH['MAX_PAGE_SIZE'];
+    X-Has-More works as in MessageHistoryView.
+    """
+    query = request.query_params.get('q', '')
+    conf = {**SEARCH_DEFAULTS, **getattr(settings, 'CHAT_SEARCH', {})}
+    try:
+        before = int(request.query_params['before']) if 'before' in request.query_params else None
+        limit = int(request.query_params.get('limit', conf['PAGE_SIZE']))
+    except ValueError:
+        return Response({"error": "before and limit must be integers"}, status=400)
+    limit = max(1, min(limit, conf['MAX_PAGE_SIZE']))
+
+    counterpart_id = None
+    if 'with' in request.query_params:
+        other_user = identity_cache.get_by_username(request.query_params['with'])
+        if other_user is None:
+            return Response({"error": "User not found"}, status=404)
+        counterpart_id = other_user.id
+
+    rows, has_more = search_messages(
+        request.user.id, query, counterpart_id, before, limit, conf['MAX_TERMS']
+    )
+    response = Response(serialize_results(rows, request.user.id))
+    response['X-Has-More'] = 'true' if has_more else 'false'
+    return response
+
+
+# 5. Export
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def ConversationExportView(request, username=None):
+    """
+    Stream the current user's messages as newline-delimited JSON: every
+    conversation, or only the one with `username`. Rows are read in keyset
+    chunks (see chat/export.py), so memory does not grow with history size.
+    """
+    counterpart_id = None
+    if username is not None:
+        other_user = identity_cache.get_by_username(username)
+        if other_user is None:
+            return Response({"error": "User not found"}, status=404)
+        counterpart_id = other_user.id
+
+    chunks = export_chunks(request.user.id, counterpart_id)
+    if isinstance(request._request, ASGIRequest):
+        chunks = aiter_chunks(chunks)
+    response = StreamingHttpResponse(chunks, content_type='application/x-ndjson')
+    filename = f"messages-{request.user.username}{f'-{username}' if username else ''}.ndjson"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
@@ -40,6 +40,7 @@ from django.core.asgi import get_asgi_application
 # Import routing and middleware AFTER django.setup()
 import chat.routing
 from chat.middleware import TokenAuthMiddlewareStack
+from chat.persistence import lifespan
 
 print("=" * 50)
 print("Loading ASGI application...")
@@ -56,4 +57,6 @@ application = ProtocolTypeRouter({
     "websocket": TokenAuthMiddlewareStack(
         URLRouter(all_websocket_patterns)
     ),
+    # Drains the chat write-behind queue on shutdown (servers with lifespan support)
+    "lifespan": lifespan,
 })
\ No newline at end of file
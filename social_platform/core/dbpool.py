@@ -0,0 +1,38 @@
+"""
+Metrics for the PostgreSQL connection pool (settings.DATABASE_POOL).
+
+Django keeps one psycopg_pool.ConnectionPool per database alias when
+OPTIONS['pool'] is set. These gauges read its statistics at scrape time:
+size and free connections, clients waiting for a connection, and the
+cumulative checkout count, time spent waiting and failed checkouts
+(timeouts included). Without a pool (SQLite, or DB_POOL_ENABLED=0) every
+value is 0.
+"""
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from .metrics import registry
+
+
+def pool_stats(alias=DEFAULT_DB_ALIAS):
+    pool = getattr(connections[alias], 'pool', None)
+    return pool.get_stats() if pool is not None else {}
+
+
+def _stat(name):
+    return lambda: pool_stats().get(name, 0)
+
+
+POOL_GAUGES = {
+    'db_pool_max_size': ('pool_max', 'Largest size the connection pool may grow to'),
+    'db_pool_size': ('pool_size', 'Connections in the pool, in use or free'),
+    'db_pool_available': ('pool_available', 'Free connections in the pool'),
+    'db_pool_waiting': ('requests_waiting', 'Clients waiting for a connection'),
+    'db_pool_checkouts': ('requests_num', 'Connections handed out by the pool (cumulative)'),
+    'db_pool_checkouts_queued': ('requests_queued', 'Checkouts that had to wait for a connection (cumulative)'),
+    'db_pool_checkout_wait_ms': ('requests_wait_ms', 'Time spent waiting for a connection (cumulative)'),
+    'db_pool_checkout_errors': ('requests_errors', 'Checkouts that failed or timed out (cumulative)'),
+}
+
+for metric_name, (stat_name, help_text) in POOL_GAUGES.items():
+    registry.gauge(metric_name, help_text, fn=_stat(stat_name))
@@ -0,0 +1,128 @@
+"""
+In-process metrics registry.
+
+Counters, gauges and fixed-bucket histograms cheap enough to update on every
+WebSocket frame. `registry.render()` produces the Prometheus text format and
+is served at /api/metrics/. Values are per process: scrape each worker.
+"""
+
+import threading
+from bisect import bisect_left
+
+# Upper bounds, in milliseconds / bytes
+LATENCY_BUCKETS_MS = (0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+SIZE_BUCKETS_BYTES = (64, 128, 256, 512, 1024, 2048, 4096, 16384, 65536)
+
+
+def _format(value):
+    if isinstance(value, float):
+        return repr(value) if value != int(value) else str(int(value))
+    return str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+
+class Gauge:
+    """A value that is either set directly or read from `fn` at scrape time."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, fn=None):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        return [(self.name, self.fn() if self.fn is not None else self.value)]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS_MS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+
+        samples, cumulative = [], 0
+        for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += bucket_count
+            samples.append((f'{self.name}_bucket{{le="{_format(bound)}"}}', cumulative))
+        samples.append((f'{self.name}_sum', round(total, 3)))
+        samples.append((f'{self.name}_count', count))
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        # Idempotent so modules can declare their metrics at import time
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name!r} is already registered as a {metric.kind}")
+            return metric
+
+    def counter(self, name, help_text):
+        return self._register(Counter, name, help_text)
+
+    def gauge(self, name, help_text, fn=None):
+        return self._register(Gauge, name, help_text, fn=fn)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS_MS):
+        return self._register(Histogram, name, help_text, buckets=buckets)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            lines.append(f'# HELP {name} {metric.help}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for sample_name, value in metric.samples():
+                lines.append(f'{sample_name} {_format(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
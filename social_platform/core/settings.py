@@ -90,6 +90,17 @@ WSGI_APPLICATION = 'core.wsgi.application'
 # Replace the DATABASES section of your settings.py with this
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# psycopg 3 connection pool for the PostgreSQL database (see core/dbpool.py).
+# Connections closed after each sync_to_async call go back to the pool
+# instead of being torn down. Requires CONN_MAX_AGE = 0 (the default).
+DATABASE_POOL = {
+    'ENABLED': os.getenv('DB_POOL_ENABLED', '1') == '1',
+    'MIN_SIZE': int(os.getenv('DB_POOL_MIN_SIZE', '2')),
+    'MAX_SIZE': int(os.getenv('DB_POOL_MAX_SIZE', '10')),
+    'TIMEOUT': float(os.getenv('DB_POOL_TIMEOUT', '10')),  # seconds to wait for a free connection
+    'MAX_IDLE': float(os.getenv('DB_POOL_MAX_IDLE', '600')),  # seconds before an idle extra connection is closed
+}
+
 if DATABASE_URL:
     # Production: Use PostgreSQL
     tmpPostgres = urlparse(DATABASE_URL)
@@ -100,10 +111,17 @@ if DATABASE_URL:
             'USER': tmpPostgres.username,
             'PASSWORD': tmpPostgres.password,
             'HOST': tmpPostgres.hostname,
-            'PORT': 5432,
+            'PORT': tmpPostgres.port or 5432,
             'OPTIONS': dict(parse_qsl(tmpPostgres.query)),
         }
     }
+    if DATABASE_POOL['ENABLED']:
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': DATABASE_POOL['MIN_SIZE'],
+            'max_size': DATABASE_POOL['MAX_SIZE'],
+            'timeout': DATABASE_POOL['TIMEOUT'],
+            'max_idle': DATABASE_POOL['MAX_IDLE'],
+        }
 else:
     # Local Development: Use SQLite
     DATABASES = {
@@ -157,7 +175,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # REST Framework Configuration
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'base.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
@@ -180,6 +198,9 @@ CORS_ALLOWED_ORIGINS = [
 
 CORS_ALLOW_CREDENTIALS = True
 
+# Paging headers the frontend reads (message history and message search)
+CORS_EXPOSE_HEADERS = ['X-Has-More']
+
 # Channels Configuration (WebSocket)
 # Use Redis in production, InMemory for local development
 REDIS_URL = os.getenv('REDIS_URL', None)
@@ -205,6 +226,119 @@ else:
         },
     }
 
+# Chat message persistence (write-behind queue, see chat/persistence.py)
+CHAT_PERSISTENCE = {
+    'BATCH_SIZE': int(os.getenv('CHAT_PERSIST_BATCH_SIZE', '100')),
+    'FLUSH_INTERVAL': float(os.getenv('CHAT_PERSIST_FLUSH_INTERVAL', '0.05')),  # seconds
+    'MAX_PENDING': int(os.getenv('CHAT_PERSIST_MAX_PENDING', '5000')),
+    'RETRIES': int(os.getenv('CHAT_PERSIST_RETRIES', '3')),
+    'RETRY_BACKOFF': float(os.getenv('CHAT_PERSIST_RETRY_BACKOFF', '0.1')),  # seconds, doubling
+}
+
+# Per-connection send queues for chat/status sockets (see chat/outbound.py)
+CHAT_OUTBOUND = {
+    'MAX_FRAMES': int(os.getenv('CHAT_OUTBOUND_MAX_FRAMES', '256')),
+    'OVERFLOW': os.getenv('CHAT_OUTBOUND_OVERFLOW', 'disconnect'),  # or 'drop'
+    'DELAY_WARN_MS': 1000,
+}
+
+# Token-bucket limits per connection and per user, as (events per second, burst)
+# for each event kind; None disables a limit (see chat/ratelimit.py)
+CHAT_RATE_LIMITS = {
+    'CONNECTION': {
+        'chat': (float(os.getenv('CHAT_RATE_CHAT', '10')), int(os.getenv('CHAT_BURST_CHAT', '50'))),
+        'typing': (5, 10),
+        'read': (10, 30),
+    },
+    'USER': {
+        'chat': (float(os.getenv('CHAT_USER_RATE_CHAT', '20')), int(os.getenv('CHAT_USER_BURST_CHAT', '100'))),
+        'typing': (10, 20),
+        'read': (20, 60),
+    },
+}
+
+# Window in which a resent clientMsgId is acked as a duplicate without
+# broadcasting it again (see chat/dedup.py)
+CHAT_DEDUP = {
+    'WINDOW': int(os.getenv('CHAT_DEDUP_WINDOW', '300')),  # seconds
+    'MAX_ENTRIES': 100000,
+}
+
+# Max events in one batched client frame (see ChatConsumer._receive_batch)
+CHAT_MAX_BATCH_EVENTS = int(os.getenv('CHAT_MAX_BATCH_EVENTS', '100'))
+
+# Max messages replayed on a ?since=<seq> reconnect before the client must refetch history
+CHAT_RESUME_MAX_REPLAY = int(os.getenv('CHAT_RESUME_MAX_REPLAY', '500'))
+
+# Typing indicator coalescing (see chat/typing.py)
+CHAT_TYPING = {
+    'REFRESH_INTERVAL': float(os.getenv('CHAT_TYPING_REFRESH_INTERVAL', '3')),  # seconds between repeated "typing: true"
+    'EXPIRY': float(os.getenv('CHAT_TYPING_EXPIRY', '6')),  # seconds of silence before "typing: false"
+}
+
+# Friend-scoped presence (see chat/presence.py)
+PRESENCE = {
+    'BATCH_WINDOW': float(os.getenv('PRESENCE_BATCH_WINDOW', '0.5')),  # seconds
+}
+
+# Message history pagination (see chat/views.py MessageHistoryView)
+CHAT_HISTORY = {
+    'PAGE_SIZE': 50,
+    'MAX_PAGE_SIZE': 200,
+}
+
+# Read pointers from read_receipt frames, written in batches (see chat/reads.py)
+CHAT_READS = {
+    'FLUSH_INTERVAL': 1.0,  # seconds
+}
+
+# Archival of cold messages (see chat/archive.py, manage.py archive_messages)
+CHAT_ARCHIVE = {
+    'HORIZON_DAYS': int(os.getenv('CHAT_ARCHIVE_HORIZON_DAYS', '180')),
+    'MAX_CONVERSATIONS': 500,  # per run
+    'INTERVAL': 3600,  # seconds between runs with --loop
+}
+
+# Streaming NDJSON export (see chat/export.py)
+CHAT_EXPORT = {
+    'CHUNK_SIZE': 2000,  # rows per query and per streamed chunk
+}
+
+# Message keyword search (see chat/search.py)
+CHAT_SEARCH = {
+    'PAGE_SIZE': 20,
+    'MAX_PAGE_SIZE': 100,
+    'MAX_TERMS': 8,
+}
+
+# Process-local username <-> id cache (see base/identity.py)
+IDENTITY_CACHE = {
+    'MAX_ENTRIES': int(os.getenv('IDENTITY_CACHE_MAX_ENTRIES', '10000')),
+    'TTL': int(os.getenv('IDENTITY_CACHE_TTL', '300')),  # seconds
+}
+
+# Accepted-friendship adjacency cache (see base/friends.py)
+FRIEND_GRAPH = {
+    'MAX_ENTRIES': int(os.getenv('FRIEND_GRAPH_MAX_ENTRIES', '10000')),
+    'TTL': int(os.getenv('FRIEND_GRAPH_TTL', '300')),  # seconds
+}
+
+# Username search index (see base/search.py)
+USER_SEARCH = {
+    'MAX_RESULTS': int(os.getenv('USER_SEARCH_MAX_RESULTS', '20')),
+    'REBUILD_INTERVAL': int(os.getenv('USER_SEARCH_REBUILD_INTERVAL', '300')),  # seconds
+}
+
+# Bearer token Prometheus must send to scrape /api/metrics/ (staff sessions
+# need none); empty means only staff can read the metrics
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Token key -> user cache for REST and WebSocket auth (see base/authentication.py)
+AUTH_TOKEN_CACHE = {
+    'MAX_ENTRIES': int(os.getenv('AUTH_TOKEN_CACHE_MAX_ENTRIES', '10000')),
+    'TTL': int(os.getenv('AUTH_TOKEN_CACHE_TTL', '300')),  # seconds
+}
+
 # WebSocket Allowed Origins (for Django Channels)
 ALLOWED_WEBSOCKET_ORIGINS = os.getenv(
     'WEBSOCKET_ALLOWED_ORIGINS',